@@ -8,12 +8,13 @@ from gi.repository import GLib
 import platform
 import logging
 import sys
-import os, time
+import os, time, math, signal
+from array import array
 
 from traceback import format_exc
 
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), './ext/velib_python'))
-from vedbus import VeDbusService
+from vedbus import VeDbusService, PublishPolicy
 from dbusmonitor import DbusMonitor
 from ve_utils import exit_on_error
 
@@ -24,6 +25,28 @@ LOGPOWER = MAXPOWER * 0.8 # log inverter power above this value
 
 OnTimeout = 3600
 
+PREDICT_HORIZON = 5 # seconds, start mp2 if the power trend reaches ONPOWER within this time
+TREND_TIME_CONSTANT = 3 # seconds, smoothing of main inverter power for the trend
+
+MODE_CONFIRM_TIMEOUT = 10 # seconds to wait for a device to report the /Mode we have set
+MODE_RETRIES = 3 # resend a /Mode command this often if it is not confirmed
+MODE_RESEND_INTERVAL = 5*60 # seconds, after giving up, send the /Mode command again this often
+
+YIELD_PUBLISH_INTERVAL = 10 # seconds, publish /TotalPVYield at most this often
+
+STATS_WINDOWS = (("1m", 60), ("15m", 15*60), ("1h", 3600)) # name, seconds
+STATS_BIN_WIDTH = 50 # watts, resolution of the p95 statistic
+STATS_REFRESH = 10 # seconds, republish the statistics this often while power is flat
+
+POWER_DEADBAND = 25 # watts, power changes smaller than this are not dispatched
+POWER_MAX_STALE = 10 # seconds, but a power held back by the deadband at most this long
+
+# Limits of the signals for the paths we publish
+POWER_PUBLISH = PublishPolicy(maxrate=1, absdelta=10, refresh=10) # /A/P
+STATS_PUBLISH = PublishPolicy(maxrate=0.2) # /Stats/...
+
+SNAPSHOT_FILE = '/run/pvcontrol-dbusmonitor.json' # tmpfs, services and values for a fast restart
+
 servicename='com.victronenergy.pvcontrol'
 
 # To map VEBus, Multiplus, VECan and Inverter RS states and
@@ -66,6 +89,14 @@ victron_state_names = {
 
 
 # Manage on/off mode and state of multiplus, rs inverter and rs mpppt
+#
+# Mode changes are sent asynchronously, with one command in flight per device.
+# A command is done when the device reports the new /Mode. If that does not
+# happen within MODE_CONFIRM_TIMEOUT, the command is resent up to MODE_RETRIES
+# times. Requests for the mode already pending are dropped, a different mode
+# requested meanwhile is sent once the pending command is done. After giving
+# up, the command is sent again every MODE_RESEND_INTERVAL, until the device
+# reports that mode or another mode is requested.
 class DeviceControl(object):
 
     def __init__(self, dbusmonitor, serviceCb, offmode, onmode):
@@ -80,16 +111,102 @@ class DeviceControl(object):
             self.devmode = self.dbusmonitor.get_value(serviceCb(), "/Mode")
             self.state = self.dbusmonitor.get_value(serviceCb(), "/State")
 
+        self.pending = None # mode of the command in flight
+        self.wanted = None # mode to send when the pending command is done
+        self.retries = 0
+        self.timeout = None
+        self.unconfirmed = None # mode given up on, sent again by the resend timer
+        self.resend = None
+
         logging.info(f"initial mode: {self.serviceCb()}:/Mode: {victron_mode_names[self.devmode]}")
         logging.info(f"initial state: {self.serviceCb()}:/State: {victron_state_names[self.state]}")
 
     def turnOff(self):
-        logging.info(f"DeviceControl: Turn off: {self.serviceCb()}:/Mode")
-        self.dbusmonitor.set_value(self.serviceCb(), "/Mode", self.offmode)
+        return self.setMode(self.offmode)
 
     def turnOn(self):
-        logging.info(f"DeviceControl: Turn on: {self.serviceCb()}:/Mode")
-        self.dbusmonitor.set_value(self.serviceCb(), "/Mode", self.onmode)
+        return self.setMode(self.onmode)
+
+    # Returns True if a command was sent right away
+    def setMode(self, mode):
+        if self.pending is not None:
+            self.wanted = mode if mode != self.pending else None
+            return False
+
+        self._cancelResend()
+
+        if mode == self.devmode:
+            return False
+
+        self.retries = 0
+        self._send(mode)
+        return self.pending is not None
+
+    def isPending(self):
+        return self.pending is not None
+
+    def _send(self, mode):
+        service = self.serviceCb()
+        if service is None:
+            logging.info(f"DeviceControl: no service to set /Mode {victron_mode_names[mode]}")
+            self._done()
+            return
+
+        logging.info(f"DeviceControl: Set {service}:/Mode to {victron_mode_names[mode]}")
+        self.pending = mode
+        self.timeout = GLib.timeout_add_seconds(MODE_CONFIRM_TIMEOUT, exit_on_error, self._confirmTimeout)
+        self.dbusmonitor.set_value_async(service, "/Mode", mode,
+                reply_handler=self._reply, error_handler=self._error)
+
+    # Errors are not retried right away, the confirmation timeout takes care
+    # of that, so a device that is gone is not hammered with requests.
+    def _reply(self, r):
+        if r != 0:
+            logging.info(f"DeviceControl: {self.serviceCb()}:/Mode rejected {victron_mode_names[self.pending]}: {r}")
+
+    def _error(self, e):
+        logging.info(f"DeviceControl: {self.serviceCb()}:/Mode error: {e}")
+
+    def _confirmTimeout(self):
+        self.timeout = None
+        if self.retries < MODE_RETRIES:
+            self.retries += 1
+            logging.info(f"DeviceControl: {self.serviceCb()}:/Mode not confirmed, retry {self.retries}")
+            self._send(self.pending)
+        else:
+            logging.info(f"DeviceControl: {self.serviceCb()}:/Mode not confirmed, giving up")
+            mode, wanted = self.pending, self.wanted
+            self._done()
+            if wanted is None:
+                self.unconfirmed = mode
+                self.resend = GLib.timeout_add_seconds(MODE_RESEND_INTERVAL, exit_on_error, self._resendTimeout)
+        return False
+
+    def _resendTimeout(self):
+        self.resend = None
+        mode, self.unconfirmed = self.unconfirmed, None
+        if mode is not None and mode != self.devmode:
+            logging.info(f"DeviceControl: {self.serviceCb()}:/Mode sending {victron_mode_names[mode]} again")
+            self.retries = 0
+            self._send(mode)
+        return False
+
+    def _cancelResend(self):
+        self.unconfirmed = None
+        if self.resend is not None:
+            GLib.source_remove(self.resend)
+            self.resend = None
+
+    def _done(self):
+        if self.timeout is not None:
+            GLib.source_remove(self.timeout)
+            self.timeout = None
+        self.pending = None
+
+        wanted, self.wanted = self.wanted, None
+        if wanted is not None and wanted != self.devmode:
+            self.retries = 0
+            self._send(wanted)
 
     def isOn(self):
         return self.devmode == self.onmode
@@ -103,6 +220,10 @@ class DeviceControl(object):
         if path == "/Mode":
             logging.info(f"watch: {self.serviceCb()}:{path}: changed from {victron_mode_names[self.devmode]} to {victron_mode_names[value]}")
             self.devmode = value
+            if self.pending is not None and value == self.pending:
+                self._done()
+            elif self.unconfirmed is not None and value == self.unconfirmed:
+                self._cancelResend()
         elif path == "/State":
             logging.info(f"watch: {self.serviceCb()}:{path}: changed from {victron_state_names[self.state]} to {victron_state_names[value]}")
             self.state = value
@@ -110,18 +231,313 @@ class DeviceControl(object):
     def getState(self):
         return self.state
 
+# Counts the iterations of the main loop, that is every wakeup of the process:
+# the timers and idle callbacks of all modules, and the D-Bus traffic. prepare
+# is called once per iteration, the source itself never dispatches.
+class WakeupCounter(GLib.Source):
+
+    def __init__(self):
+        super(WakeupCounter, self).__init__()
+        self.wakeups = 0
+
+    def prepare(self):
+        self.wakeups += 1
+        return False, -1
+
+    def check(self):
+        return False
+
+    def dispatch(self, callback, args):
+        return True
+
+# One-shot timer for a deadline on the monotonic clock. Moving the deadline
+# later leaves the armed GLib source alone, the timer re-arms itself for the
+# remaining time when it fires early. Moving it earlier re-arms immediately.
+class DeadlineTimer(object):
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.deadline = None
+        self.source = None
+        self.sourceDeadline = None
+
+        self.idleWakeups = 0
+
+    def arm(self, deadline):
+        self.deadline = deadline
+        if self.source is None or deadline < self.sourceDeadline:
+            self._schedule()
+
+    def cancel(self):
+        self.deadline = None
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+
+    def isArmed(self):
+        return self.deadline is not None
+
+    def _schedule(self):
+        if self.source is not None:
+            GLib.source_remove(self.source)
+        self.sourceDeadline = self.deadline
+        ms = math.ceil(max(0, self.deadline - time.monotonic()) * 1000)
+        self.source = GLib.timeout_add(ms, exit_on_error, self._expired)
+
+    def _expired(self):
+        self.source = None
+
+        if self.deadline is None:
+            self.idleWakeups += 1
+            return False
+
+        if self.deadline > time.monotonic():
+            # Deadline was moved while we were armed
+            self.idleWakeups += 1
+            self._schedule()
+            return False
+
+        self.deadline = None
+        self.callback()
+        return False
+
+# Running total of the pv yield of all chargers, updated by the delta of each
+# change. Publishing is coalesced: changes within one interval are put on the
+# bus once, at the end of the interval.
+class YieldAggregator(object):
+
+    def __init__(self, publishCb, interval):
+        self.publishCb = publishCb
+        self.interval = interval
+        self.yields = {}
+        self.total = 0
+        self.source = None
+
+    def set(self, service, value):
+        value = value or 0
+        self.total += value - self.yields.get(service, 0)
+        self.yields[service] = value
+        self._changed()
+
+    def remove(self, service):
+        if self.yields.pop(service, None) is not None:
+            # Start from scratch to get rid of accumulated rounding errors
+            self.total = sum(self.yields.values())
+            self._changed()
+
+    def _changed(self):
+        if self.source is None:
+            self.source = GLib.timeout_add(int(self.interval * 1000), exit_on_error, self._publish)
+
+    def _publish(self):
+        self.source = None
+        self.publishCb(self.total)
+        return False
+
+# Exponentially weighted moving average and slope of a signal that is
+# sampled at irregular intervals, O(1) per sample.
+class PowerTrend(object):
+
+    def __init__(self, tau):
+        self.tau = tau
+        self.mean = None
+        self.slope = 0.0
+        self.lastTime = None
+
+    def add(self, t, value):
+        if self.lastTime is None:
+            self.mean = value
+            self.lastTime = t
+            return
+
+        dt = t - self.lastTime
+        if dt <= 0:
+            return
+
+        a = 1 - math.exp(-dt / self.tau)
+        prev = self.mean
+        self.mean += a * (value - self.mean)
+        self.slope += a * ((self.mean - prev) / dt - self.slope)
+        self.lastTime = t
+
+    # Projected value in horizon seconds
+    def predict(self, horizon):
+        if self.mean is None:
+            return None
+        return self.mean + self.slope * horizon
+
+# Rolling mean, max and p95 of a power value over the STATS_WINDOWS.
+#
+# The history is a preallocated ring of one sample per second, a new value is
+# held until the next one arrives. Each window keeps a running sum and a
+# histogram of STATS_BIN_WIDTH watt bins, both updated as samples enter and
+# leave the window. The max is only rescanned when the max sample leaves.
+class PowerHistory(object):
+
+    def __init__(self, windows=STATS_WINDOWS, maxpower=2*MAXPOWER):
+        self.windows = windows
+        self.size = max(n for (name, n) in windows)
+        self.samples = array('f', bytes(4 * self.size))
+        self.scratch = array('f', [0])
+        self.nbins = int(maxpower / STATS_BIN_WIDTH) + 1
+
+        self.count = 0 # number of samples ever stored
+        self.lastSecond = None
+        self.lastAdded = None # second of the last real sample
+        self.value = 0
+
+        self.sums = [0.0] * len(windows)
+        self.maxs = [0.0] * len(windows)
+        self.maxValid = [True] * len(windows)
+        self.hists = [array('I', bytes(4 * self.nbins)) for w in windows]
+
+    def _bin(self, v):
+        return min(max(int(v / STATS_BIN_WIDTH), 0), self.nbins - 1)
+
+    def add(self, now, value):
+        # Round to what the ring stores, so the running sums do not drift
+        self.scratch[0] = value
+        value = self.scratch[0]
+
+        second = int(now)
+        if self.lastSecond is None:
+            self._push(value)
+        elif second == self.lastSecond:
+            self._replace(value)
+        else:
+            # Hold the previous value for the seconds without a sample
+            for i in range(min(second - self.lastSecond - 1, self.size)):
+                self._push(self.value)
+            self._push(value)
+        self.lastSecond = second
+        self.lastAdded = second
+        self.value = value
+
+    # Rolls the windows up to now, holding the last value
+    def advance(self, now):
+        second = int(now)
+        if self.lastSecond is None or second <= self.lastSecond:
+            return
+        for i in range(min(second - self.lastSecond, self.size)):
+            self._push(self.value)
+        self.lastSecond = second
+
+    # True while advancing can still change the statistics, that is until the
+    # last value has filled the longest window
+    def isRolling(self, now):
+        return self.lastAdded is not None and int(now) - self.lastAdded < self.size
+
+    def _push(self, v):
+        count = self.count
+        for (i, (name, n)) in enumerate(self.windows):
+            self.sums[i] += v
+            self.hists[i][self._bin(v)] += 1
+            if count >= n:
+                old = self.samples[(count - n) % self.size]
+                self.sums[i] -= old
+                self.hists[i][self._bin(old)] -= 1
+                if old >= self.maxs[i]:
+                    self.maxValid[i] = False
+            if v >= self.maxs[i] or count == 0:
+                self.maxs[i] = v
+                self.maxValid[i] = True
+        self.samples[count % self.size] = v
+        self.count = count + 1
+
+    def _replace(self, v):
+        newest = (self.count - 1) % self.size
+        old = self.samples[newest]
+        self.samples[newest] = v
+        for i in range(len(self.windows)):
+            self.sums[i] += v - old
+            self.hists[i][self._bin(old)] -= 1
+            self.hists[i][self._bin(v)] += 1
+            if v >= self.maxs[i]:
+                self.maxs[i] = v
+                self.maxValid[i] = True
+            elif old >= self.maxs[i]:
+                self.maxValid[i] = False
+
+    def _window(self, n):
+        n = min(n, self.count)
+        end = self.count % self.size
+        start = (self.count - n) % self.size
+        if start < end:
+            return self.samples[start:end]
+        return self.samples[start:] + self.samples[:end]
+
+    # Yields (window name, mean, max, p95)
+    def stats(self):
+        for (i, (name, n)) in enumerate(self.windows):
+            filled = min(n, self.count)
+            if filled == 0:
+                yield (name, None, None, None)
+                continue
+
+            if not self.maxValid[i]:
+                self.maxs[i] = max(self._window(n))
+                self.maxValid[i] = True
+
+            # p95: upper edge of the bin in which the top 5% start
+            above = 0
+            limit = filled * 0.05
+            hist = self.hists[i]
+            for b in range(self.nbins - 1, -1, -1):
+                above += hist[b]
+                if above > limit:
+                    break
+            p95 = min((b + 1) * STATS_BIN_WIDTH, self.maxs[i])
+
+            yield (name, self.sums[i] / filled, self.maxs[i], p95)
+
+# Histogram of latencies with four geometric buckets per octave, starting at
+# 1 us. Percentiles are reported as the upper edge of their bucket.
+class LatencyHistogram(object):
+
+    BUCKETS = 4 * 28 # up to 2^28 us, some 4.5 minutes
+
+    def __init__(self):
+        self.counts = array('I', bytes(4 * self.BUCKETS))
+        self.count = 0
+        self.max = 0
+
+    def add(self, ns):
+        us = ns / 1000
+        b = 0 if us < 1 else min(int(math.log2(us) * 4), self.BUCKETS - 1)
+        self.counts[b] += 1
+        self.count += 1
+        if us > self.max:
+            self.max = us
+
+    # Latency in us below which fraction q of the samples are
+    def percentile(self, q):
+        if self.count == 0:
+            return None
+        limit = q * self.count
+        total = 0
+        for (b, c) in enumerate(self.counts):
+            total += c
+            if total >= limit:
+                break
+        return min(2 ** ((b + 1) / 4), self.max)
+
 class PVControl(object):
 
     def __init__(self, productname='IBR PV Control', connection='pvcontrol'):
 
         logging.debug("Service %s starting... "% servicename)
 
-        self.pvyield = {}
+        self.pvyield = YieldAggregator(self.publishTotalYield, YIELD_PUBLISH_INTERVAL)
 
         dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
+        # The jitter of a few watts does not matter, for the statistics nor for the control. But a
+        # change across ONPOWER or OFFPOWER of the main inverter must never be held back. The
+        # power of the multiplus is not filtered, /A/MaxPMp is the peak of every change of it.
+        power = dict(dummy, deadband=POWER_DEADBAND, maxStale=POWER_MAX_STALE)
+        controlpower = dict(power, thresholds=(OFFPOWER, ONPOWER))
         dbus_tree= {
                 # inverter rs 6000
-                'com.victronenergy.inverter': { '/Mode': dummy, '/State': dummy, '/Ac/Out/L1/P': dummy }  ,
+                'com.victronenergy.inverter': { '/Mode': dummy, '/State': dummy, '/Ac/Out/L1/P': controlpower }  ,
                 # inverter multi rs, solarcharger
                 'com.victronenergy.multi': { '/Mode': dummy, '/State': dummy, '/Yield/User': dummy }  ,
                 # Multiplus 8000
@@ -131,9 +547,11 @@ class PVControl(object):
                 'com.victronenergy.system': { '/Dc/Battery/TimeToGo': dummy},
                 }
 
-        self._dbusmonitor = DbusMonitor(dbus_tree, valueChangedCallback=self.value_changed_wrapper,
-                                        deviceAddedCallback=self.deviceAddedWrapper,
-                                        deviceRemovedCallback=self.deviceRemovedWrapper)
+        self._dbusmonitor = DbusMonitor(dbus_tree, deviceAddedCallback=self.deviceAddedWrapper,
+                                        deviceRemovedCallback=self.deviceRemovedWrapper,
+                                        timestamps=True, asyncScan=True, scopedSignals=True,
+                                        batchDispatch=True, snapshotFile=SNAPSHOT_FILE,
+                                        valueOnly=True)
 
         # Get dynamic servicename for rs6 (ve.can)
         serviceList = self._get_service_having_lowest_instance('com.victronenergy.inverter')
@@ -150,7 +568,7 @@ class PVControl(object):
         serviceList = self._get_service_having_lowest_instance('com.victronenergy.multi')
         if serviceList:
             multi_service = serviceList[0]
-            self.pvyield[multi_service] = self._dbusmonitor.get_value(multi_service, "/Yield/User") or 0
+            self.pvyield.set(multi_service, self._dbusmonitor.get_value(multi_service, "/Yield/User"))
         else:
             multi_service = None
         logging.info(f"service of multi rs: {multi_service}")
@@ -171,9 +589,10 @@ class PVControl(object):
         pvChargerServiceList = self._dbusmonitor.get_service_list(classfilter="com.victronenergy.solarcharger") or []
         for charger in pvChargerServiceList:
             logging.info(f"pvcharger: {charger}")
-            self.pvyield[charger] = self._dbusmonitor.get_value(charger, "/Yield/User") or 0
+            self.pvyield.set(charger, self._dbusmonitor.get_value(charger, "/Yield/User"))
 
-        self._dbusservice = VeDbusService(servicename)
+        # Paths written in one go, by a timer or a handler, are sent as one ItemsChanged
+        self._dbusservice = VeDbusService(servicename, autobatch=True)
 
         # Create the management objects, as specified in the ccgx dbus-api document
         self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
@@ -188,19 +607,46 @@ class PVControl(object):
         self._dbusservice.add_path('/HardwareVersion', 0)
         self._dbusservice.add_path('/Connected', 1)
 
-        self._dbusservice.add_path('/A/P', 1)
-        self._dbusservice.add_path('/A/Timer', 1)
-        self._dbusservice.add_path('/A/MaxPMp', 1)
-        self._dbusservice.add_path('/A/MaxPRs', 1)
-        self._dbusservice.add_path('/A/MaxPon', 1)
-        self._dbusservice.add_path('/TotalPVYield', 1)
+        # Numbers that change often, nobody needs their text with every change.
+        # Powers are sent as double, the devices report them as int or float.
+        self._dbusservice.add_path('/A/P', 1, publishpolicy=POWER_PUBLISH, textinsignals=False,
+                                   valuetype='d')
+        # The power-off timeout of the multiplus: OnTimeout when the timer is (re)started, 0 when
+        # it expires. It does not count down, that would take a wakeup per second.
+        self._dbusservice.add_path('/A/Timer', 1, valuetype='i')
+        self._dbusservice.add_path('/A/MaxPMp', 1, valuetype='d')
+        self._dbusservice.add_path('/A/MaxPRs', 1, valuetype='d')
+        self._dbusservice.add_path('/A/MaxPon', 1, valuetype='d')
+        self._dbusservice.add_path('/TotalPVYield', 1, valuetype='d')
+        self._dbusservice.add_path('/A/WakeupsPerHour', 0, valuetype='i')
+        self._dbusservice.add_path('/A/IdleWakeupsPerHour', 0, valuetype='i')
+        self._dbusservice.add_path('/A/Predict/Hits', 0, valuetype='i')
+        self._dbusservice.add_path('/A/Predict/Misses', 0, valuetype='i')
+        for prefix in ('/Stats/Inverter', '/Stats/Vebus'):
+            for (name, n) in STATS_WINDOWS:
+                for stat in ('Mean', 'Max', 'P95'):
+                    self._dbusservice.add_path(f'{prefix}/{name}/{stat}', None, publishpolicy=STATS_PUBLISH,
+                                               textinsignals=False, valuetype='i')
+
+        # Latencies in us: signal receipt to dispatch in the main loop, dispatch to SetValue
+        # issued, and receipt to SetValue issued.
+        self.latency = {name: LatencyHistogram() for name in ('Dispatch', 'Actuation', 'Total')}
+        for name in self.latency:
+            for stat in ('P50', 'P99', 'Max'):
+                self._dbusservice.add_path(f'/Perf/Latency/{name}/{stat}', None, textinsignals=False,
+                                           valuetype='i')
+
+        # Changes passed and held back by the dbus monitor per hour, see POWER_DEADBAND
+        self.filterStats = self._dbusmonitor.get_filter_stats()
+        for name in self.filterStats:
+            self._dbusservice.add_path(f'/Perf/Filter/{name.capitalize()}', 0, valuetype='i')
 
         self._dbusservice['/A/P'] = 0
         self._dbusservice['/A/Timer'] = 0
         self._dbusservice['/A/MaxPMp'] = 0
         self._dbusservice['/A/MaxPRs'] = 0
         self._dbusservice['/A/MaxPon'] = 0
-        self._dbusservice['/TotalPVYield'] = sum(self.pvyield.values())
+        self._dbusservice['/TotalPVYield'] = self.pvyield.total
 
         # read initial value of rs6000 (or multi rs) output power
         if self.maininverter:
@@ -210,9 +656,12 @@ class PVControl(object):
             logging.info('initial main inverter mode: %d: %s' % (invmode, victron_mode_names[invmode]))
             if invmode not in range(0, 5): # 0..4
                 logging.info(f"unknown main inverter inverter/mode: {victron_mode_names[invmode]}, vecan communication seems dead :-(")
+                # Don't start from this state again
+                self._dbusmonitor.discard_snapshot()
                 sys.exit(0)
         else:
             self.watt = 0
+        self._dbusservice["/A/P"] = self.watt
 
         timetogo = self._dbusmonitor.get_value("com.victronenergy.system", "/Dc/Battery/TimeToGo")
         logging.info(f'initial system:/Dc/Battery/TimeToGo: {timetogo}')
@@ -221,7 +670,7 @@ class PVControl(object):
 
         # DCL/RS6 hack
         self.rsControl = DeviceControl(self._dbusmonitor, self.getRSService, mode_charger_only, mode_on)      # rs6000, 1=Charger only, 3=On
-        self.rsEndTimer = 0
+        self.rsTimer = DeadlineTimer(self.rsTimerExpired)
         if timetogo != None: # No BMS, handled by inverter-timeout
             if timetogo > 0:
                 if not self.rsControl.isOn():
@@ -229,14 +678,107 @@ class PVControl(object):
             else:
                 # if not self.rsControl.isOff():
                     # self.rsControl.turnOff()
-                self.rsEndTimer = time.time() + 3*60
+                self.rsTimer.arm(time.monotonic() + 3*60)
 
-        self.endTimer = time.time() + OnTimeout 
+        self.mp2Timer = DeadlineTimer(self.mp2TimerExpired)
+        self.restartMp2Timer()
         self.maxPon = 0
         self.MaxPMp = 0
         self.MaxPRs = 0
 
-        GLib.timeout_add(1000, exit_on_error, self.update)
+        self.inverterHistory = PowerHistory()
+        self.vebusHistory = PowerHistory()
+        # Rolls the windows on while no power changes come in
+        self.statsTimer = DeadlineTimer(self.statsTimerExpired)
+
+        # Handlers for the main inverter and multiplus follow these services as they
+        # come and go, see bindHandlers
+        self.roleHandlers = {
+                'maininverter': (('/Ac/Out/L1/P', self.inverterPowerChanged),
+                                 ('/Mode', self.rsWatch), ('/State', self.rsWatch)),
+                'vebus': (('/Ac/Out/L1/P', self.vebusPowerChanged),
+                          ('/Mode', self.mp2ModeChanged), ('/State', self.mp2Watch)),
+                }
+        self.boundHandlers = {}
+        self.bindHandlers('maininverter', self.maininverter)
+        self.bindHandlers('vebus', self.vebus_service)
+        self._dbusmonitor.add_handler('com.victronenergy.system', '/Dc/Battery/TimeToGo', self.handler(self.timeToGoChanged))
+        self._dbusmonitor.add_handler('com.victronenergy.solarcharger', '/Yield/User', self.handler(self.yieldChanged))
+        self._dbusmonitor.add_handler('com.victronenergy.multi', '/Yield/User', self.handler(self.yieldChanged))
+
+        # Predictive start of the multiplus
+        self.trend = PowerTrend(TREND_TIME_CONSTANT)
+        self.trend.add(time.monotonic(), self.watt)
+        self.predictionDeadline = None
+        self.predictionTimer = DeadlineTimer(self.predictionExpired)
+        self.predictionHits = 0
+        self.predictionMisses = 0
+
+        self.wakeupCounter = WakeupCounter()
+        self.wakeupCounter.attach(None)
+        GLib.timeout_add_seconds(3600, exit_on_error, self.reportWakeups)
+
+    # A prediction is a hit if power really reaches ONPOWER within the horizon,
+    # and a miss once the horizon has passed without that.
+    def checkPrediction(self, now):
+        if self.predictionDeadline is None:
+            return
+
+        if self.watt >= ONPOWER and now <= self.predictionDeadline:
+            self.predictionHits += 1
+            self._dbusservice["/A/Predict/Hits"] = self.predictionHits
+        elif now >= self.predictionDeadline:
+            self.predictionMisses += 1
+            self._dbusservice["/A/Predict/Misses"] = self.predictionMisses
+            if self.watt < OFFPOWER:
+                # Started for nothing, don't keep it running for OnTimeout
+                logging.info("prediction missed, watt: %d" % self.watt)
+                self.mp2Timer.cancel()
+                self.mp2TimerExpired()
+        else:
+            return
+
+        self.predictionDeadline = None
+        self.predictionTimer.cancel()
+
+    def predictionExpired(self):
+        self.checkPrediction(time.monotonic())
+
+    # Called right after a control decision went out on the bus
+    def actuated(self, changes):
+        if 'Received' not in changes:
+            return
+        now = time.monotonic_ns()
+        self.latency['Actuation'].add(now - changes['Dispatched'])
+        self.latency['Total'].add(now - changes['Received'])
+        self.publishLatency()
+
+    def publishLatency(self):
+        for (name, h) in self.latency.items():
+            p50 = h.percentile(0.5)
+            p99 = h.percentile(0.99)
+            self._dbusservice[f'/Perf/Latency/{name}/P50'] = None if p50 is None else round(p50)
+            self._dbusservice[f'/Perf/Latency/{name}/P99'] = None if p99 is None else round(p99)
+            self._dbusservice[f'/Perf/Latency/{name}/Max'] = None if p50 is None else round(h.max)
+
+    def publishStats(self, prefix, history):
+        for (name, mean, maxp, p95) in history.stats():
+            self._dbusservice[f'{prefix}/{name}/Mean'] = None if mean is None else round(mean)
+            self._dbusservice[f'{prefix}/{name}/Max'] = None if maxp is None else round(maxp)
+            self._dbusservice[f'{prefix}/{name}/P95'] = None if p95 is None else round(p95)
+
+    def statsTimerExpired(self):
+        now = time.monotonic()
+        rolling = False
+        for (prefix, history) in (('/Stats/Inverter', self.inverterHistory), ('/Stats/Vebus', self.vebusHistory)):
+            history.advance(now)
+            self.publishStats(prefix, history)
+            rolling = rolling or history.isRolling(now)
+        if rolling:
+            self.statsTimer.arm(now + STATS_REFRESH)
+
+    def publishTotalYield(self, total):
+        self._dbusservice["/TotalPVYield"] = total
 
     def getRSService(self):
         return self.maininverter
@@ -244,52 +786,64 @@ class PVControl(object):
     def getMultiPlusService(self):
         return self.vebus_service
 
-    def update(self):
+    # (Re-)start power-off timer of the multiplus
+    def restartMp2Timer(self):
+        self.mp2Timer.arm(time.monotonic() + OnTimeout)
+        self._dbusservice["/A/Timer"] = OnTimeout
+
+    def mp2TimerExpired(self):
+        self._dbusservice["/A/Timer"] = 0
+        if self.mp2Control.isOn():
+            # switch off mp2
+            logging.info(f"stopping mp2...")
+            self.mp2Control.turnOff()
 
+    def rsTimerExpired(self):
+        if self.rsControl.isOn():
+            # switch off rs inverter
+            logging.info(f"stopping rs inverter...")
+            self.rsControl.turnOff()
+
+    # Runs once an hour, the only periodic wakeup left. Wakeups are the main loop
+    # iterations, idle wakeups are timer expirations that found their deadline
+    # moved and only re-armed the timer.
+    def reportWakeups(self):
+        timers = (self.mp2Timer, self.rsTimer, self.predictionTimer, self.statsTimer)
+        wakeups, self.wakeupCounter.wakeups = self.wakeupCounter.wakeups, 0
+        idleWakeups = sum(t.idleWakeups for t in timers)
+        for t in timers:
+            t.idleWakeups = 0
+
+        logging.info(f"wakeups in the last hour: {wakeups}, idle: {idleWakeups}")
+        self._dbusservice["/A/WakeupsPerHour"] = wakeups
+        self._dbusservice["/A/IdleWakeupsPerHour"] = idleWakeups
+        self.publishLatency()
+        self.publishFilterStats()
+        return True
+
+    def publishFilterStats(self):
+        stats = self._dbusmonitor.get_filter_stats()
+        for (name, n) in stats.items():
+            self._dbusservice[f'/Perf/Filter/{name.capitalize()}'] = n - self.filterStats[name]
+        self.filterStats = stats
+
+    def updateMaxPower(self, p):
         # log maximum power consumption (rs6 + mp2)
         # Note: /Ac/Out/L1/P of multiplus is none if it was never started
-        p = (self.vebus_service and self._dbusmonitor.get_value(self.vebus_service, "/Ac/Out/L1/P")) or 0
+        p = p or 0
         if p > self.MaxPMp:
             self._dbusservice["/A/MaxPMp"] = p
             self.MaxPMp = p
 
             # State 8: passthrough, state 9: inverting, state 10: assisting
             # if self._dbusmonitor.get_value(self.vebus_service, "/State") == 10:
-            if self.mp2Control.getState() == 10 and self.watt > self.MaxPRs:
-                self._dbusservice["/A/MaxPRs"] = self.watt
-                self.MaxPRs = self.watt
-
-        # test timer timeout and switch off multiplus
-        dt = self.endTimer - time.time()
-
-        # if dt < 0 and self.mp2state != 4:
-        # if self.mp2Control.isOn() and ((inverterState != 9) or (dt < 0)):
-        if self.mp2Control.isOn() and (dt < 0):
-            # switch off mp2
-            logging.info(f"stopping mp2...")
-            self.mp2Control.turnOff()
-
-        if self.rsEndTimer:
-            dt = self.rsEndTimer - time.time()
-            logging.info(f"enddimer: {dt}")
-            if dt < 0:
-                if self.rsControl.isOn():
-                    # switch off rs inverter
-                    logging.info(f"stopping rs inverter...")
-                    self.rsControl.turnOff()
-                self.rsEndTimer = 0
-
-        self._dbusservice["/A/P"] = self.watt
-        if dt > 0:
-            self._dbusservice["/A/Timer"] = int(dt)
-        else:
-            self._dbusservice["/A/Timer"] = 0
-
-        return True
-
-    # Calls value_changed with exception handling
-    def value_changed_wrapper(self, *args, **kwargs):
-        exit_on_error(self.value_changed, *args, **kwargs)
+            # self.watt lags behind by up to the deadband, get_value has the latest power
+            watt = self.watt
+            if self.maininverter is not None:
+                watt = self._dbusmonitor.get_value(self.maininverter, "/Ac/Out/L1/P", watt) or 0
+            if self.mp2Control.getState() == 10 and watt > self.MaxPRs:
+                self._dbusservice["/A/MaxPRs"] = watt
+                self.MaxPRs = watt
 
     def deviceAddedWrapper(self, *args, **kwargs):
         exit_on_error(self.deviceAddedCallback, *args, **kwargs)
@@ -303,18 +857,19 @@ class PVControl(object):
         if service.startswith("com.victronenergy.inverter"):
             logging.info(f"main inverter (rs) added...")
             self.maininverter = service
+            self.bindHandlers('maininverter', service)
         elif service.startswith("com.victronenergy.multi"):
             logging.info(f"main inverter (multi) added...")
             self.maininverter = service
-            self.pvyield[service] = self._dbusmonitor.get_value(service, "/Yield/User") or 0
-            self._dbusservice['/TotalPVYield'] = sum(self.pvyield.values())
+            self.bindHandlers('maininverter', service)
+            self.pvyield.set(service, self._dbusmonitor.get_value(service, "/Yield/User"))
         elif service.startswith("com.victronenergy.vebus"):
             logging.info(f"multiplus added...")
             self.vebus_service = service
+            self.bindHandlers('vebus', service)
         elif service.startswith("com.victronenergy.solarcharger"):
             logging.info(f"solarcharger added...")
-            self.pvyield[service] = self._dbusmonitor.get_value(service, "/Yield/User") or 1
-            self._dbusservice['/TotalPVYield'] = sum(self.pvyield.values())
+            self.pvyield.set(service, self._dbusmonitor.get_value(service, "/Yield/User") or 1)
 
     def deviceRemovedCallback(self, service, instance):
         logging.info(f"dbus device removed: {service}, {type(service)}, {instance}")
@@ -322,70 +877,125 @@ class PVControl(object):
         if service.startswith("com.victronenergy.inverter") or service.startswith("com.victronenergy.multi"):
             logging.info(f"main inverter removed...")
             self.maininverter = None
+            self.bindHandlers('maininverter', None)
         elif service.startswith("com.victronenergy.vebus"):
             logging.info(f"multiplus removed...")
             self.vebus_service = None
+            self.bindHandlers('vebus', None)
+
+        # Drop yield of a solarcharger or multi rs that went away
+        self.pvyield.remove(service)
+
+    # Called on SIGTERM, before the main loop quits
+    def terminate(self):
+        logging.info("terminating, saving dbus snapshot...")
+        self._dbusmonitor.save_snapshot()
+
+    # Wraps a method for DbusMonitor.add_handler
+    def handler(self, f):
+        def wrapper(service, path, options, changes, deviceInstance):
+            if 'Received' in changes:
+                self.latency['Dispatch'].add(changes['Dispatched'] - changes['Received'])
+            exit_on_error(f, service, path, changes)
+        return wrapper
+
+    # Moves the handlers of a role, main inverter or multiplus, to service
+    def bindHandlers(self, role, service):
+        for rule in self.boundHandlers.pop(role, ()):
+            self._dbusmonitor.remove_handler(rule)
+        if service is not None:
+            self.boundHandlers[role] = [self._dbusmonitor.add_handler(service, path, self.handler(f))
+                    for (path, f) in self.roleHandlers[role]]
+
+    def rsWatch(self, service, path, changes):
+        self.rsControl.watch(path, changes["Value"])
+
+    def inverterPowerChanged(self, service, path, changes):
+
+        self.watt = changes["Value"] or 0
+        self._dbusservice["/A/P"] = self.watt
+        # logging.info('update watt: %d' % self.watt)
+
+        now = time.monotonic()
+        self.trend.add(now, self.watt)
+        self.checkPrediction(now)
+        self.inverterHistory.add(now, self.watt)
+        self.publishStats('/Stats/Inverter', self.inverterHistory)
+        if not self.statsTimer.isArmed():
+            self.statsTimer.arm(now + STATS_REFRESH)
+
+        if self.watt >= ONPOWER:
+            if self.mp2Control.isOff():
+                logging.info("Starting mp2..., watt: %d" % self.watt)
+                if self.mp2Control.turnOn():
+                    self.actuated(changes)
+
+                if self.watt > self.maxPon:
+                    self.maxPon = self.watt
+                    self._dbusservice["/A/MaxPon"] = self.watt
+            self.restartMp2Timer() # Start power-off timer
+
+            if self.watt > LOGPOWER:
+                logging.info("inverter power: %d" % self.watt)
 
-    def value_changed(self, service, path, options, changes, deviceInstance):
-        # logging.info('value_changed %s %s %s' % (service, path, str(changes)))
-
-        if service == self.maininverter:
-
-            self.rsControl.watch(path, changes["Value"])
-
-            if path == "/Ac/Out/L1/P":
-
-                self.watt = changes["Value"] or 0
-                # logging.info('update watt: %d' % self.watt)
-
-                if self.watt >= ONPOWER:
-                    if self.mp2Control.isOff():
-                        logging.info("Starting mp2..., watt: %d" % self.watt)
-                        self.mp2Control.turnOn()
-
-                        if self.watt > self.maxPon:
-                            self.maxPon = self.watt
-                            self._dbusservice["/A/MaxPon"] = self.watt
-                    self.endTimer = time.time() + OnTimeout # Start power-off timer
-
-                    if self.watt > LOGPOWER:
-                        logging.info("inverter power: %d" % self.watt)
-
-                elif self.watt >= OFFPOWER:
-                    self.endTimer = time.time() + OnTimeout # Re-Start power-off timer
-
-        elif service == self.vebus_service:
-
-            self.mp2Control.watch(path, changes["Value"])
+        else:
+            if self.watt >= OFFPOWER:
+                self.restartMp2Timer() # Re-Start power-off timer
+
+            if self.mp2Control.isOff() and not self.mp2Control.isPending():
+                projected = self.trend.predict(PREDICT_HORIZON)
+                if projected >= ONPOWER:
+                    logging.info("Starting mp2 ahead of time..., watt: %d, projected: %d" % (self.watt, projected))
+                    if self.mp2Control.turnOn():
+                        self.actuated(changes)
+                    self.restartMp2Timer()
+                    self.predictionDeadline = now + PREDICT_HORIZON
+                    self.predictionTimer.arm(self.predictionDeadline)
+
+    def mp2Watch(self, service, path, changes):
+        self.mp2Control.watch(path, changes["Value"])
+
+    def mp2ModeChanged(self, service, path, changes):
+        self.mp2Control.watch(path, changes["Value"])
+
+        if self.mp2Control.isOn() and not self.mp2Timer.isArmed():
+            # Turned on by someone else after our timer expired
+            logging.info(f"stopping mp2...")
+            self.mp2Control.turnOff()
 
-        elif service == "com.victronenergy.system":
+    def vebusPowerChanged(self, service, path, changes):
+        self.updateMaxPower(changes["Value"])
+        now = time.monotonic()
+        self.vebusHistory.add(now, changes["Value"] or 0)
+        self.publishStats('/Stats/Vebus', self.vebusHistory)
+        if not self.statsTimer.isArmed():
+            self.statsTimer.arm(now + STATS_REFRESH)
 
-            # RS6000 DCL hack:
-            # It is not enough to set DCL to zero to turn off the rs6000, it turns on for short amounts of time
-            # every 2 minutes...
-            # Therefore we turn it of hard here using its /Mode dbus reg.
-            if path == "/Dc/Battery/TimeToGo":
+    # RS6000 DCL hack:
+    # It is not enough to set DCL to zero to turn off the rs6000, it turns on for short amounts of time
+    # every 2 minutes...
+    # Therefore we turn it of hard here using its /Mode dbus reg.
+    def timeToGoChanged(self, service, path, changes):
 
-                timetogo = changes["Value"]
-                logging.info(f'system:/Dc/Battery/TimeToGo changed to: {timetogo}')
+        timetogo = changes["Value"]
+        logging.info(f'system:/Dc/Battery/TimeToGo changed to: {timetogo}')
 
-                if timetogo != None: # No BMS, handled by inverter-timeout
-                    if timetogo > 0:
-                        if not self.rsControl.isOn():
-                            self.rsControl.turnOn()
-                        self.rsEndTimer = 0
-                    else:
-                        # if not self.rsControl.isOff():
-                            # self.rsControl.turnOff()
-                        self.rsEndTimer = time.time() + 3*60
-                else:
-                    self.rsEndTimer = 0
+        if timetogo != None: # No BMS, handled by inverter-timeout
+            if timetogo > 0:
+                if not self.rsControl.isOn():
+                    self.rsControl.turnOn()
+                self.rsTimer.cancel()
+            else:
+                # if not self.rsControl.isOff():
+                    # self.rsControl.turnOff()
+                self.rsTimer.arm(time.monotonic() + 3*60)
+        else:
+            self.rsTimer.cancel()
 
-        # compute total pv yield
-        if path == "/Yield/User":
-            # logging.info(f"pvcharger, {service} yield: {changes['Value']}")
-            self.pvyield[service] = changes["Value"]
-            self._dbusservice["/TotalPVYield"] = sum(self.pvyield.values())
+    # compute total pv yield
+    def yieldChanged(self, service, path, changes):
+        # logging.info(f"pvcharger, {service} yield: {changes['Value']}")
+        self.pvyield.set(service, changes["Value"])
 
     # returns a tuple (servicename, instance)
     def _get_service_having_lowest_instance(self, classfilter=None): 
@@ -409,6 +1019,12 @@ def main():
     logging.info('Connected to dbus, and switching over to GLib.MainLoop() (= event based)')
     mainloop = GLib.MainLoop()
 
+    def terminate():
+        exit_on_error(pvControl.terminate)
+        mainloop.quit()
+        return False
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, terminate)
+
     mainloop.run()
 
 
@@ -25,6 +25,8 @@ import argparse
 import pprint
 import traceback
 import os
+import time
+import json
 from collections import defaultdict
 from functools import partial
 
@@ -32,6 +34,9 @@ from functools import partial
 from ve_utils import exit_on_error, wrap_dbus_value, unwrap_dbus_value
 notfound = object() # For lookups where None is a valid result
 
+# dbusTree options that hold back changes before they are dispatched, see DbusMonitor
+FILTER_OPTIONS = frozenset(('deadband', 'deadbandRel', 'minInterval', 'maxStale'))
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 class SystemBus(dbus.bus.BusConnection):
@@ -42,7 +47,12 @@ class SessionBus(dbus.bus.BusConnection):
 	def __new__(cls):
 		return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SESSION)
 
+# MonitoredValue and Service use __slots__, there is one MonitoredValue per monitored path and
+# an instance dict would be most of its size. The options are the dicts from the dbusTree, shared
+# by all services of a class, and so are the paths used as keys.
 class MonitoredValue(object):
+	__slots__ = ('value', 'text', 'options')
+
 	def __init__(self, value, text, options):
 		super(MonitoredValue, self).__init__()
 		self.value = value
@@ -56,6 +66,8 @@ class MonitoredValue(object):
 class Service(object):
 	whentologoptions = ['configChange', 'onIntervalAlwaysAndOnEvent',
 		'onIntervalOnlyWhenChanged', 'onIntervalAlways', 'never']
+	__slots__ = ['id', 'name', 'paths', '_seen', 'deviceInstance'] + whentologoptions
+
 	def __init__(self, id, serviceName, deviceInstance):
 		super(Service, self).__init__()
 		self.id = id
@@ -64,6 +76,7 @@ class Service(object):
 		self._seen = set()
 		self.deviceInstance = deviceInstance
 
+		# Paths per whenToLog option
 		self.configChange = []
 		self.onIntervalAlwaysAndOnEvent = []
 		self.onIntervalOnlyWhenChanged = []
@@ -73,9 +86,18 @@ class Service(object):
 	# For legacy code, attributes can still be accessed as if keys from a
 	# dictionary.
 	def __setitem__(self, key, value):
-		self.__dict__[key] = value
+		try:
+			setattr(self, key, value)
+		except AttributeError:
+			raise KeyError(key)
 	def __getitem__(self, key):
-		return self.__dict__[key]
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def add_to_log(self, whenToLog, path):
+		getattr(self, whenToLog).append(path)
 
 	def set_seen(self, path):
 		self._seen.add(path)
@@ -87,18 +109,185 @@ class Service(object):
 	def service_class(self):
 		return '.'.join(self.name.split('.')[:3])
 
+# Scans one service with asynchronous calls, the same way DbusMonitor.scan_dbus_service_inner
+# does it with blocking calls. When done, done(scan) is called. scan.service is then a Service
+# without paths, and values and texts hold what was fetched, keyed by path without the leading
+# slash. scan.service is None if the service was skipped or the scan failed. If given,
+# owner(scan) is called as soon as scan.serviceId is known. With valueOnly, texts stays empty.
+# An exception while handling a reply fails the scan of that service only, it is logged and
+# the service is skipped, like the blocking scan does.
+class AsyncServiceScan(object):
+	def __init__(self, dbusConn, serviceName, paths, deviceInstance, timeout, done, owner=None,
+			valueOnly=False):
+		self.dbusConn = dbusConn
+		self.valueOnly = valueOnly
+		self.serviceName = serviceName
+		self.paths = paths
+		self.deviceInstance = deviceInstance
+		self.timeout = timeout
+		self.done = done
+		self.ownerCallback = owner
+
+		self.serviceId = None
+		self.service = None
+		self.values = {}
+		self.texts = {}
+		self._outstanding = 0
+		self._failed = False
+		self._root = False
+
+	def _call(self, path, method, reply_handler, error_handler, bus_name=None, interface=None,
+			signature='', args=[]):
+		self._outstanding += 1
+		self.dbusConn.call_async(bus_name or self.serviceName, path, interface, method, signature, args,
+			reply_handler=partial(self._reply, reply_handler),
+			error_handler=partial(self._reply, error_handler), timeout=self.timeout)
+
+	def _reply(self, handler, *args):
+		self._outstanding -= 1
+		if self._failed:
+			return
+		try:
+			handler(*args)
+			if self._outstanding == 0 and not self._failed:
+				self._finish()
+		except Exception as e:
+			logger.debug(traceback.format_exc())
+			if not self._failed:
+				self._fail(e)
+
+	def _fail(self, e=None):
+		if e is not None:
+			logger.error("Ignoring %s because of error while scanning: %s" % (self.serviceName, e))
+		self._failed = True
+		self.service = None
+		self._done()
+
+	# done is only called once per scan, an exception from it is logged and does not
+	# fail the scan after the fact
+	def _done(self):
+		self._failed = True
+		try:
+			self.done(self)
+		except Exception:
+			logger.error("Error handling the scan result of %s:\n%s" % (self.serviceName,
+				traceback.format_exc()))
+
+	def start(self):
+		logger.info("Found: %s, scanning and storing items" % self.serviceName)
+		self._call('/org/freedesktop/DBus', 'GetNameOwner', self._owner, self._fail,
+			bus_name='org.freedesktop.DBus', interface='org.freedesktop.DBus',
+			signature='s', args=[self.serviceName])
+
+	def _owner(self, owner):
+		self.serviceId = str(owner)
+		if self.ownerCallback is not None:
+			self.ownerCallback(self)
+		if self.deviceInstance is None:
+			self._call('/DeviceInstance', 'GetValue', self._device_instance, self._no_device_instance)
+		else:
+			self._device_instance(self.deviceInstance)
+
+	def _no_device_instance(self, e):
+		logger.info("       %s was skipped because it has no device instance" % self.serviceName)
+		self._done()
+
+	def _device_instance(self, di):
+		di = int(di)
+		logger.info("       %s has device instance %s" % (self.serviceName, di))
+		self.service = Service(self.serviceId, self.serviceName, di)
+
+		# Let's try to fetch everything in one go
+		self._call('/', 'GetValue', partial(self._update, self.values), self._ignore)
+		if not self.valueOnly:
+			self._call('/', 'GetText', partial(self._update, self.texts), self._ignore)
+		self._root = True # _finish does the individual queries after these
+
+	def _update(self, d, items):
+		try:
+			d.update(items)
+		except (TypeError, ValueError):
+			pass
+
+	def _ignore(self, e):
+		pass
+
+	def _path_error(self, path, e):
+		if e.get_dbus_name() in (
+				'org.freedesktop.DBus.Error.ServiceUnknown',
+				'org.freedesktop.DBus.Error.Disconnected'):
+			self._fail(e)
+			return
+		logger.debug("%s %s does not exist (yet)" % (self.serviceName, path))
+
+	def _set(self, d, path, v):
+		d[path[1:]] = v
+
+	def _finish(self):
+		if self._root:
+			# Individual queries for what the bulk fetch didn't find
+			self._root = False
+			for path in self.paths:
+				if path[1:] not in self.values:
+					self._call(path, 'GetValue', partial(self._set, self.values, path),
+						partial(self._path_error, path))
+				if path[1:] not in self.texts and not self.valueOnly:
+					self._call(path, 'GetText', partial(self._set, self.texts, path),
+						partial(self._path_error, path))
+			if self._outstanding > 0:
+				return
+		self._done()
+
 class DbusMonitor(object):
 	## Constructor
 	def __init__(self, dbusTree, valueChangedCallback=None, deviceAddedCallback=None,
-					deviceRemovedCallback=None, vebusDeviceInstance0=False):
+					deviceRemovedCallback=None, vebusDeviceInstance0=False, timestamps=False,
+					asyncScan=False, scanTimeout=5, scanDeadline=10, scopedSignals=False,
+					batchDispatch=False, batchCallback=None, snapshotFile=None, snapshotInterval=300,
+					valueOnly=False):
 		# valueChangedCallback is the callback that we call when something has changed.
 		# def value_changed_on_dbus(dbusServiceName, dbusPath, options, changes, deviceInstance):
 		# in which changes is a tuple with GetText() and GetValue()
+		# When timestamps is True, changes also contains 'Received' and 'Dispatched': the
+		# time.monotonic_ns() at which the signal came in and at which the callback is called.
+		# With asyncScan, the services on the bus are scanned in parallel instead of one by one. Each
+		# call times out after scanTimeout seconds, and the constructor returns after at most
+		# scanDeadline seconds.
+		# With scopedSignals, signals are subscribed to per monitored service, instead of for all
+		# services on the bus, so the dbus-daemon does not send us what we don't monitor.
+		# With batchDispatch, changes are queued per service and path, the latest value winning, and
+		# handed out from a single idle callback. If batchCallback is given, it is called with a list of
+		# (dbusServiceName, dbusPath, options, changes, deviceInstance) tuples instead of calling
+		# valueChangedCallback for each change.
+		# With snapshotFile, the monitored services and their values are saved to that file
+		# snapshotInterval seconds after a service came or went, and by save_snapshot, which the owner
+		# calls on shutdown. Value changes alone don't cause a write, the values are caught up when the
+		# snapshot is verified. A snapshot that cannot be read is removed. Put it on a tmpfs, so it does not
+		# outlive the dbus-daemon. When the file exists at start, the services in it are taken as they
+		# are instead of scanning the bus, and verified against the bus in the background once the
+		# main loop runs. Services whose owner changed or that are gone by then are removed, and
+		# reported through deviceRemovedCallback, values that changed meanwhile through the value
+		# callbacks.
+		# With valueOnly, texts are not fetched nor kept: no GetText calls while scanning, the text
+		# of every monitored value is None, and changes only contains 'Value' (and the timestamps).
+		#
+		# Besides code and whenToLog, the options of a path in the dbusTree can limit the changes
+		# that are dispatched for it, the values returned by get_value are always the latest:
+		#   deadband, deadbandRel: a change smaller than deadband, or than deadbandRel times the
+		#     last dispatched value, is not dispatched. Only for numbers.
+		#   minInterval: seconds between dispatched changes, the latest value held back is
+		#     dispatched when the interval has passed.
+		#   maxStale: seconds after which a change held back by the deadband is dispatched anyway.
+		#   thresholds: values that matter to the owner, a change across one of them, compared to
+		#     the last dispatched value, is always dispatched right away.
+		# get_filter_stats returns how many changes passed and were held back.
 		self.valueChangedCallback = valueChangedCallback
 		self.deviceAddedCallback = deviceAddedCallback
 		self.deviceRemovedCallback = deviceRemovedCallback
 		self.dbusTree = dbusTree
 		self.vebusDeviceInstance0 = vebusDeviceInstance0
+		self.timestamps = timestamps
+		self.valueOnly = valueOnly
 
 		# Lists all tracked services. Stores name, id, device instance, value per path, and whenToLog info
 		# indexed by service name (eg. com.victronenergy.settings).
@@ -113,6 +302,39 @@ class DbusMonitor(object):
 		# Keep track of any additional watches placed on items
 		self.serviceWatches = defaultdict(list)
 
+		# Handlers registered with add_handler. The rules as given, and the dispatch table built from
+		# them for the services present, indexed by (service name, path).
+		self._handlerRules = []
+		self._handlers = {}
+
+		# Changes waiting for the idle callback, with batchDispatch
+		self.batchDispatch = batchDispatch or batchCallback is not None
+		self.batchCallback = batchCallback
+		self._queuedChanges = {}
+		self._drainScheduled = False
+
+		# Last dispatched value, its time and the trailing dispatch timer per (service name, path)
+		# with filter options, and the counters for get_filter_stats.
+		self._filterState = {}
+		self.filterStats = {'passed': 0, 'deadband': 0, 'interval': 0, 'trailing': 0}
+
+		# With scopedSignals, the match rules per service, see _add_matches
+		self.scopedSignals = scopedSignals
+		self.serviceMatches = {}
+
+		# Asynchronous scans still running, by name and, once known, by owner. And the name owner
+		# changes that arrived during the startup scan.
+		self._scansPending = {}
+		self._scansById = {}
+		self._deferredOwnerChanges = []
+		self._scanning = False
+
+		# Services loaded from the snapshot that have not been verified against the bus yet
+		self.snapshotFile = snapshotFile
+		self.snapshotInterval = snapshotInterval
+		self._snapshotScheduled = False
+		self._unverified = set()
+
 		# For a PC, connect to the SessionBus
 		# For a CCGX, connect to the SystemBus
 		self.dbusConn = SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else SystemBus()
@@ -123,24 +345,37 @@ class DbusMonitor(object):
 			self.dbus_name_owner_changed,
 			signal_name='NameOwnerChanged')
 
-		# Subscribe to PropertiesChanged for all services
-		self.dbusConn.add_signal_receiver(self.handler_value_changes,
-			dbus_interface='com.victronenergy.BusItem',
-			signal_name='PropertiesChanged', path_keyword='path',
-			sender_keyword='senderId')
+		if not scopedSignals:
+			# Subscribe to PropertiesChanged for all services
+			self.dbusConn.add_signal_receiver(self.handler_value_changes,
+				dbus_interface='com.victronenergy.BusItem',
+				signal_name='PropertiesChanged', path_keyword='path',
+				sender_keyword='senderId')
 
-		# Subscribe to ItemsChanged for all services
-		self.dbusConn.add_signal_receiver(self.handler_item_changes,
-			dbus_interface='com.victronenergy.BusItem',
-			signal_name='ItemsChanged', path='/',
-			sender_keyword='senderId')
+			# Subscribe to ItemsChanged for all services
+			self.dbusConn.add_signal_receiver(self.handler_item_changes,
+				dbus_interface='com.victronenergy.BusItem',
+				signal_name='ItemsChanged', path='/',
+				sender_keyword='senderId')
+
+		started = time.monotonic()
+		if snapshotFile is not None and self._load_snapshot():
+			logger.info('===== Loaded %d services from %s, verifying in the background =====' % (
+				len(self._unverified), snapshotFile))
+			self._verify_snapshot(scanTimeout)
+			self.scanTime = time.monotonic() - started
+			return
 
 		logger.info('===== Search on dbus for services that we will monitor starting... =====')
 		serviceNames = self.dbusConn.list_names()
-		for serviceName in serviceNames:
-			self.scan_dbus_service(serviceName)
+		if asyncScan:
+			self.scan_dbus_services_async(serviceNames, scanTimeout, scanDeadline)
+		else:
+			for serviceName in serviceNames:
+				self.scan_dbus_service(serviceName)
+		self.scanTime = time.monotonic() - started
 
-		logger.info('===== Search on dbus for services that we will monitor finished =====')
+		logger.info('===== Search on dbus for services that we will monitor finished in %.3f s =====' % self.scanTime)
 
 	def dbus_name_owner_changed(self, name, oldowner, newowner):
 		if not name.startswith("com.victronenergy."):
@@ -150,7 +385,19 @@ class DbusMonitor(object):
 		GLib.idle_add(exit_on_error, self._process_name_owner_changed, name, oldowner, newowner)
 
 	def _process_name_owner_changed(self, name, oldowner, newowner):
+		if self._scanning:
+			self._deferredOwnerChanges.append((name, oldowner, newowner))
+			return
+
 		if newowner != '':
+			service = self.servicesByName.get(name)
+			if service is not None:
+				if service.id == newowner:
+					# Appeared while scanning, the scan found it already
+					return
+				# Taken from the snapshot, but restarted since
+				self._remove_service(name)
+
 			# so we found some new service. Check if we can do something with it.
 			newdeviceadded = self.scan_dbus_service(name)
 			if newdeviceadded and self.deviceAddedCallback is not None:
@@ -159,30 +406,104 @@ class DbusMonitor(object):
 		elif name in self.servicesByName:
 			# it disappeared, we need to remove it.
 			logger.info("%s disappeared from the dbus. Removing it from our lists" % name)
-			service = self.servicesByName[name]
-			deviceInstance = service['deviceInstance']
-			del self.servicesById[service.id]
-			del self.servicesByName[name]
-			for watch in self.serviceWatches[name]:
-				watch.remove()
-			del self.serviceWatches[name]
-			self.servicesByClass[service.service_class].remove(service)
-			if self.deviceRemovedCallback is not None:
-				self.deviceRemovedCallback(name, deviceInstance)
+			self._remove_service(name)
+
+	def _remove_service(self, name):
+		service = self.servicesByName[name]
+		deviceInstance = service['deviceInstance']
+		del self.servicesById[service.id]
+		del self.servicesByName[name]
+		for watch in self.serviceWatches[name]:
+			watch.remove()
+		del self.serviceWatches[name]
+		self._remove_matches(name)
+		for rule in self._handlerRules:
+			if rule[0] in (name, service.service_class):
+				self._handlers.pop((name, rule[1]), None)
+		self.servicesByClass[service.service_class].remove(service)
+		self._discard_filter_state(name)
+		self._unverified.discard(name)
+		self._snapshot_changed()
+		if self.deviceRemovedCallback is not None:
+			self.deviceRemovedCallback(name, deviceInstance)
 
 	def scan_dbus_service(self, serviceName):
 		try:
-			return self.scan_dbus_service_inner(serviceName)
+			if self.scan_dbus_service_inner(serviceName):
+				return True
 		except:
 			logger.error("Ignoring %s because of error while scanning:" % (serviceName))
 			traceback.print_exc()
-			return False
+
+		if str(serviceName) not in self.servicesByName:
+			self._remove_matches(str(serviceName))
+			self._discard_filter_state(str(serviceName))
+		return False
 
 			# Errors 'org.freedesktop.DBus.Error.ServiceUnknown' and
 			# 'org.freedesktop.DBus.Error.Disconnected' seem to happen when the service
 			# disappears while its being scanned. Which might happen, but is not really
 			# normal either, so letting them go into the logs.
 
+	# Returns the monitored paths for a service, or None when it is not in the tree
+	def _service_paths(self, serviceName):
+		return self.dbusTree.get('.'.join(serviceName.split('.')[0:3]), None)
+
+	# Returns the device instance of services that don't have one on the bus, None otherwise
+	def _fixed_device_instance(self, serviceName):
+		# for vebus.ttyO1, this is workaround, since VRM Portal expects the main vebus
+		# devices at instance 0. Not sure how to fix this yet.
+		if serviceName == 'com.victronenergy.vebus.ttyO1' and self.vebusDeviceInstance0:
+			return 0
+		elif serviceName == 'com.victronenergy.settings':
+			return 0
+		elif serviceName.startswith('com.victronenergy.vecan.'):
+			return 0
+		return None
+
+	def _add_path(self, service, path, options, value, text):
+		# path will be the D-Bus path: '/Ac/ActiveIn/L1/V'
+		# options will be a dictionary: {'code': 'V', 'whenToLog': 'onIntervalAlways'}
+		# check that the whenToLog setting is set to something we expect
+		assert options['whenToLog'] is None or options['whenToLog'] in Service.whentologoptions
+
+		a = service.paths[path] = MonitoredValue(unwrap_dbus_value(value), unwrap_dbus_value(text), options)
+
+		# The scanned value counts as dispatched, the owner reads it after the scan
+		if not FILTER_OPTIONS.isdisjoint(options):
+			self._filterState[(service.name, path)] = [a.value, time.monotonic(), None]
+
+		if options['whenToLog']:
+			service.add_to_log(options['whenToLog'], path)
+
+	# Adds the match rule for the signals of one service, scoped to its unique name. One rule for
+	# all its paths and both signals, each rule costs an AddMatch round trip to the dbus-daemon.
+	# Only used with scopedSignals.
+	def _add_matches(self, serviceName, serviceId):
+		if not self.scopedSignals:
+			return
+
+		self._remove_matches(serviceName)
+		self.serviceMatches[serviceName] = self.dbusConn.add_signal_receiver(self.handler_signals,
+			dbus_interface='com.victronenergy.BusItem', bus_name=serviceId,
+			path_keyword='path', member_keyword='member', sender_keyword='senderId')
+
+	def _remove_matches(self, serviceName):
+		match = self.serviceMatches.pop(serviceName, None)
+		if match is not None:
+			match.remove()
+
+	# Adjust self at the end of the scan, so we don't have an incomplete set of
+	# data if an exception occurs during the scan.
+	def _add_service(self, service):
+		self.servicesByName[service.name] = service
+		self.servicesById[service.id] = service
+		self.servicesByClass[service.service_class].append(service)
+		for rule in self._handlerRules:
+			if rule[0] in (service.name, service.service_class):
+				self._bind_handler(service.name, rule[1], rule[2])
+		self._snapshot_changed()
+
 	# Scans the given dbus service to see if it contains anything interesting for us. If it does, add
 	# it to our list of monitored D-Bus services.
 	def scan_dbus_service_inner(self, serviceName):
@@ -190,7 +511,7 @@ class DbusMonitor(object):
 		# make it a normal string instead of dbus string
 		serviceName = str(serviceName)
 
-		paths = self.dbusTree.get('.'.join(serviceName.split('.')[0:3]), None)
+		paths = self._service_paths(serviceName)
 		if paths is None:
 			logger.debug("Ignoring service %s, not in the tree" % serviceName)
 			return False
@@ -203,15 +524,12 @@ class DbusMonitor(object):
 		assert serviceName not in self.servicesByName
 		assert serviceId not in self.servicesById
 
-		# for vebus.ttyO1, this is workaround, since VRM Portal expects the main vebus
-		# devices at instance 0. Not sure how to fix this yet.
-		if serviceName == 'com.victronenergy.vebus.ttyO1' and self.vebusDeviceInstance0:
-			di = 0
-		elif serviceName == 'com.victronenergy.settings':
-			di = 0
-		elif serviceName.startswith('com.victronenergy.vecan.'):
-			di = 0
-		else:
+		# Subscribe before fetching the values. The signals that come in meanwhile are queued
+		# while the calls below block, and handled once the service is added.
+		self._add_matches(serviceName, serviceId)
+
+		di = self._fixed_device_instance(serviceName)
+		if di is None:
 			try:
 				di = self.dbusConn.call_blocking(serviceName,
 					'/DeviceInstance', None, 'GetValue', '', [])
@@ -229,27 +547,24 @@ class DbusMonitor(object):
 		texts = {}
 		try:
 			values.update(self.dbusConn.call_blocking(serviceName, '/', None, 'GetValue', '', []))
-			texts.update(self.dbusConn.call_blocking(serviceName, '/', None, 'GetText', '', []))
+			if not self.valueOnly:
+				texts.update(self.dbusConn.call_blocking(serviceName, '/', None, 'GetText', '', []))
 		except:
 			pass
 
 		for path, options in paths.items():
-			# path will be the D-Bus path: '/Ac/ActiveIn/L1/V'
-			# options will be a dictionary: {'code': 'V', 'whenToLog': 'onIntervalAlways'}
-			# check that the whenToLog setting is set to something we expect
-			assert options['whenToLog'] is None or options['whenToLog'] in Service.whentologoptions
-
 			# Try to obtain the value we want from our bulk fetch. If we
 			# cannot find it there, do an individual query.
 			value = values.get(path[1:], notfound)
 			if value != notfound:
 				service.set_seen(path)
-			text = texts.get(path[1:], notfound)
+			text = None if self.valueOnly else texts.get(path[1:], notfound)
 			if value is notfound or text is notfound:
 				try:
 					value = self.dbusConn.call_blocking(serviceName, path, None, 'GetValue', '', [])
 					service.set_seen(path)
-					text = self.dbusConn.call_blocking(serviceName, path, None, 'GetText', '', [])
+					if not self.valueOnly:
+						text = self.dbusConn.call_blocking(serviceName, path, None, 'GetText', '', [])
 				except dbus.exceptions.DBusException as e:
 					if e.get_dbus_name() in (
 							'org.freedesktop.DBus.Error.ServiceUnknown',
@@ -262,23 +577,236 @@ class DbusMonitor(object):
 					value = None
 					text = None
 
-			service.paths[path] = MonitoredValue(unwrap_dbus_value(value), unwrap_dbus_value(text), options)
+			self._add_path(service, path, options, value, text)
 
-			if options['whenToLog']:
-				service[options['whenToLog']].append(path)
+		logger.debug("Finished scanning and storing items for %s" % serviceName)
+		self._add_service(service)
 
+		return True
 
-		logger.debug("Finished scanning and storing items for %s" % serviceName)
+	# Scans all services in serviceNames at once with asynchronous calls. Returns when all scans
+	# are done or after deadline seconds, scans that are still running then are merged when
+	# they complete, and reported through deviceAddedCallback like a service that appears later.
+	def scan_dbus_services_async(self, serviceNames, timeout, deadline):
+		self._scanning = True
+		for serviceName in serviceNames:
+			serviceName = str(serviceName)
+			paths = self._service_paths(serviceName)
+			if paths is None:
+				logger.debug("Ignoring service %s, not in the tree" % serviceName)
+				continue
+			scan = AsyncServiceScan(self.dbusConn, serviceName, paths,
+				self._fixed_device_instance(serviceName), timeout, self._async_scan_done,
+				owner=self._async_scan_owner, valueOnly=self.valueOnly)
+			self._scansPending[serviceName] = scan
+			scan.start()
+
+		expired = []
+		def expire():
+			expired.append(True)
+			return False
+		timer = GLib.timeout_add(int(deadline * 1000), expire)
+
+		context = GLib.MainContext.default()
+		while self._scansPending and not expired:
+			context.iteration(True)
+
+		if not expired:
+			GLib.source_remove(timer)
+		if self._scansPending:
+			logger.warning("Scan deadline passed, continuing in the background with: %s" % \
+				', '.join(self._scansPending))
+
+		self._scanning = False
+
+		# Name owner changes that came in during the scan are processed now
+		deferred, self._deferredOwnerChanges = self._deferredOwnerChanges, []
+		for args in deferred:
+			GLib.idle_add(exit_on_error, self._process_name_owner_changed, *args)
+
+	def _async_scan_owner(self, scan):
+		# Subscribe before fetching the values. Until the service is added, its changes go
+		# into the scan result, see _scan_value_changes.
+		self._scansById[scan.serviceId] = scan
+		if scan.serviceName not in self.servicesByName:
+			self._add_matches(scan.serviceName, scan.serviceId)
+
+	def _async_scan_done(self, scan):
+		self._scansPending.pop(scan.serviceName, None)
+		self._scansById.pop(scan.serviceId, None)
+		service = scan.service
+		if service is None:
+			if scan.serviceName not in self.servicesByName:
+				self._remove_matches(scan.serviceName)
+			return
+		if service.name in self.servicesByName or service.id in self.servicesById:
+			logger.info("Dropping scan result of %s, already known" % service.name)
+			return
 
-		# Adjust self at the end of the scan, so we don't have an incomplete set of
-		# data if an exception occurs during the scan.
-		self.servicesByName[serviceName] = service
-		self.servicesById[serviceId] = service
-		self.servicesByClass[service.service_class].append(service)
+		for path, options in scan.paths.items():
+			if path[1:] in scan.values:
+				service.set_seen(path)
+			self._add_path(service, path, options, scan.values.get(path[1:]), scan.texts.get(path[1:]))
+		self._add_service(service)
+		logger.debug("Finished scanning and storing items for %s" % service.name)
+
+		if not self._scanning and self.deviceAddedCallback is not None:
+			self.deviceAddedCallback(service.name, service.deviceInstance)
+
+	def _load_snapshot(self):
+		try:
+			with open(self.snapshotFile) as f:
+				snapshot = json.load(f)
+		except FileNotFoundError:
+			return False
+		except (OSError, ValueError) as e:
+			logger.warning("Ignoring snapshot %s: %s" % (self.snapshotFile, e))
+			self._remove_snapshot()
+			return False
+
+		# Read it completely before using any of it, a malformed snapshot is dropped as a whole
+		try:
+			services = []
+			for serviceName, s in snapshot.get('services', {}).items():
+				paths = self._service_paths(serviceName)
+				if paths is None:
+					continue
+				service = Service(str(s['id']), serviceName, int(s['deviceInstance']))
+				values = s['values']
+				for path, options in paths.items():
+					value, text = values.get(path, (None, None))
+					if path in values:
+						service.set_seen(path)
+					self._add_path(service, path, options, value, text)
+				services.append(service)
+		except (AttributeError, KeyError, TypeError, ValueError) as e:
+			logger.warning("Ignoring malformed snapshot %s: %r" % (self.snapshotFile, e))
+			self._filterState.clear()
+			self._remove_snapshot()
+			return False
 
+		for service in services:
+			self._add_matches(service.name, service.id)
+			self._add_service(service)
+			self._unverified.add(service.name)
 		return True
 
+	# Lists the names on the bus and scans those we monitor, without blocking
+	def _verify_snapshot(self, timeout):
+		self.dbusConn.call_async('org.freedesktop.DBus', '/org/freedesktop/DBus',
+			'org.freedesktop.DBus', 'ListNames', '', [],
+			reply_handler=partial(exit_on_error, self._verify_names, timeout),
+			error_handler=partial(exit_on_error, self._verify_failed), timeout=timeout)
+
+	def _verify_failed(self, e):
+		logger.error("Could not verify snapshot, dropping it: %s" % e)
+		for serviceName in list(self._unverified):
+			self._remove_service(serviceName)
+
+	def _verify_names(self, timeout, serviceNames):
+		serviceNames = [str(n) for n in serviceNames]
+		for serviceName in self._unverified - set(serviceNames):
+			logger.info("%s from the snapshot is gone" % serviceName)
+			self._remove_service(serviceName)
+
+		for serviceName in serviceNames:
+			paths = self._service_paths(serviceName)
+			if paths is None or serviceName in self._scansPending:
+				continue
+			scan = AsyncServiceScan(self.dbusConn, serviceName, paths,
+				self._fixed_device_instance(serviceName), timeout, self._verify_done,
+				owner=self._verify_owner, valueOnly=self.valueOnly)
+			self._scansPending[serviceName] = scan
+			scan.start()
+
+	def _verify_owner(self, scan):
+		service = self.servicesByName.get(scan.serviceName)
+		if service is not None and service.id != scan.serviceId:
+			logger.info("%s from the snapshot has a new owner" % scan.serviceName)
+			self._remove_service(scan.serviceName)
+		self._async_scan_owner(scan)
+
+	def _verify_done(self, scan):
+		if scan.serviceName not in self._unverified:
+			# Not in the snapshot, or replaced meanwhile
+			self._async_scan_done(scan)
+			return
+
+		self._scansPending.pop(scan.serviceName, None)
+		self._scansById.pop(scan.serviceId, None)
+		self._unverified.discard(scan.serviceName)
+		service = self.servicesByName[scan.serviceName]
+		if scan.service is None or service.id != scan.serviceId:
+			self._remove_service(scan.serviceName)
+			return
+
+		# Same owner, catch up with what changed while we were gone
+		for path in scan.paths:
+			if path[1:] in scan.values:
+				value = unwrap_dbus_value(scan.values[path[1:]])
+				text = scan.texts.get(path[1:])
+				if text is not None:
+					text = unwrap_dbus_value(text)
+				elif not self.valueOnly:
+					text = str(value)
+				self._handler_value_changes(service, path, value, text)
+
+	def _snapshot_changed(self):
+		if self.snapshotFile is None or self._snapshotScheduled:
+			return
+		self._snapshotScheduled = True
+		GLib.timeout_add(int(self.snapshotInterval * 1000), exit_on_error, self._snapshot_timeout)
+
+	def _snapshot_timeout(self):
+		self._snapshotScheduled = False
+		self.save_snapshot()
+		return False
+
+	# Writes the snapshot now, call it on shutdown
+	def save_snapshot(self):
+		if self.snapshotFile is None:
+			return
+		services = {}
+		for service in self.servicesByName.values():
+			services[service.name] = {
+				'id': service.id,
+				'deviceInstance': service.deviceInstance,
+				'values': {path: (v.value, v.text) for path, v in service.paths.items() \
+					if service.seen(path)}}
+
+		# Write and rename, so a crash never leaves half a snapshot behind
+		tmp = self.snapshotFile + '.tmp'
+		try:
+			with open(tmp, 'w') as f:
+				json.dump({'services': services}, f)
+			os.replace(tmp, self.snapshotFile)
+		except (OSError, TypeError, ValueError) as e:
+			logger.error("Could not write snapshot %s: %s" % (self.snapshotFile, e))
+
+	# Removes the snapshot and stops writing it, for when its contents are known to be bad
+	def discard_snapshot(self):
+		if self.snapshotFile is None:
+			return
+		self._remove_snapshot()
+		self.snapshotFile = None
+
+	def _remove_snapshot(self):
+		try:
+			os.remove(self.snapshotFile)
+		except FileNotFoundError:
+			pass
+		except OSError as e:
+			logger.error("Could not remove snapshot %s: %s" % (self.snapshotFile, e))
+
+	# The signals of a service, with scopedSignals
+	def handler_signals(self, changes, path, member, senderId):
+		if member == 'PropertiesChanged':
+			self.handler_value_changes(changes, path, senderId)
+		elif member == 'ItemsChanged' and path == '/':
+			self.handler_item_changes(changes, senderId)
+
 	def handler_item_changes(self, items, senderId):
+		received = time.monotonic_ns() if self.timestamps else None
 		if not isinstance(items, dict):
 			return
 
@@ -286,6 +814,9 @@ class DbusMonitor(object):
 			service = self.servicesById[senderId]
 		except KeyError:
 			# senderId isn't there, which means it hasn't been scanned yet.
+			for path, changes in items.items():
+				if isinstance(changes, dict) and 'Value' in changes:
+					self._scan_value_changes(senderId, path, changes)
 			return
 
 		for path, changes in items.items():
@@ -294,13 +825,10 @@ class DbusMonitor(object):
 			except (KeyError, TypeError):
 				continue
 
-			try:
-				t = changes['Text']
-			except KeyError:
-				t = str(v)
-			self._handler_value_changes(service, path, v, t)
+			self._handler_value_changes(service, path, v, self._text(changes, v), received)
 
 	def handler_value_changes(self, changes, path, senderId):
+		received = time.monotonic_ns() if self.timestamps else None
 		# If this properyChange does not involve a value, our work is done.
 		if 'Value' not in changes:
 			return
@@ -309,17 +837,33 @@ class DbusMonitor(object):
 			service = self.servicesById[senderId]
 		except KeyError:
 			# senderId isn't there, which means it hasn't been scanned yet.
+			self._scan_value_changes(senderId, path, changes)
 			return
 
 		v = unwrap_dbus_value(changes['Value'])
+		self._handler_value_changes(service, path, v, self._text(changes, v), received)
+
+	# A change of a service that is being scanned asynchronously goes into the scan result, so
+	# the service is added with its latest values. The signals and the replies of one service
+	# arrive in order, a reply that comes later overwrites the change with a newer value.
+	def _scan_value_changes(self, senderId, path, changes):
+		scan = self._scansById.get(senderId)
+		if scan is None or path not in scan.paths:
+			return
+		scan.values[path[1:]] = changes['Value']
+		if not self.valueOnly:
+			scan.texts[path[1:]] = self._text(changes, unwrap_dbus_value(changes['Value']))
+
+	def _text(self, changes, value):
+		if self.valueOnly:
+			return None
 		# Some services don't send Text with their PropertiesChanged events.
 		try:
-			t = changes['Text']
+			return changes['Text']
 		except KeyError:
-			t = str(v)
-		self._handler_value_changes(service, path, v, t)
+			return str(value)
 
-	def _handler_value_changes(self, service, path, value, text):
+	def _handler_value_changes(self, service, path, value, text, received=None):
 		try:
 			a = service.paths[path]
 		except KeyError:
@@ -335,10 +879,135 @@ class DbusMonitor(object):
 		a.value = value
 		a.text = text
 
-		# And do the rest of the processing in on the mainloop
-		if self.valueChangedCallback is not None:
-			GLib.idle_add(exit_on_error, self._execute_value_changes, service.name, path, {
-				'Value': value, 'Text': text}, a.options)
+		# And do the rest of the processing in on the mainloop. During the startup scan the
+		# owner is not ready for callbacks yet, it reads the values after the scan.
+		if (self.valueChangedCallback is None and self.batchCallback is None and not self._handlers) \
+				or self._scanning:
+			return
+
+		if not FILTER_OPTIONS.isdisjoint(a.options) and self._filter(service, path, a, time.monotonic()):
+			return
+
+		self._dispatch(service, path, a, received)
+
+	def _dispatch(self, service, path, a, received=None):
+		changes = {'Value': a.value} if self.valueOnly else {'Value': a.value, 'Text': a.text}
+		if received is not None:
+			changes['Received'] = received
+		if self.batchDispatch:
+			# Collect changes until the idle callback runs, the latest value per path wins
+			self._queuedChanges[(service.name, path)] = (changes, a.options)
+			if not self._drainScheduled:
+				self._drainScheduled = True
+				GLib.idle_add(exit_on_error, self._drain_value_changes)
+		else:
+			GLib.idle_add(exit_on_error, self._execute_value_changes, service.name, path, changes, a.options)
+
+	# Returns True when the change of a path with filter options is held back
+	def _filter(self, service, path, a, now):
+		key = (service.name, path)
+		state = self._filterState.get(key)
+		if state is not None:
+			reason, due = self._filter_reason(a.options, state, a.value, now)
+			if reason is not None:
+				self.filterStats[reason] += 1
+				if due is not None and state[2] is None:
+					state[2] = self._filter_timer(service, path, due - now)
+				return True
+			if state[2] is not None:
+				GLib.source_remove(state[2])
+
+		self._filterState[key] = [a.value, now, None]
+		self.filterStats['passed'] += 1
+		return False
+
+	def _discard_filter_state(self, serviceName):
+		for key in [k for k in self._filterState if k[0] == serviceName]:
+			timer = self._filterState.pop(key)[2]
+			if timer is not None:
+				GLib.source_remove(timer)
+
+	# Returns why a change to value is held back, None if it is not, and when to look at it again.
+	# state is the last dispatched value and its time, as kept in _filterState.
+	@staticmethod
+	def _filter_reason(options, state, value, now):
+		last, lastTime = state[0], state[1]
+		thresholds = options.get('thresholds')
+		if thresholds:
+			try:
+				if any((last < t) != (value < t) for t in thresholds):
+					return None, None
+			except TypeError:
+				pass # Invalid or not a number
+
+		minInterval = options.get('minInterval')
+		if minInterval is not None and now - lastTime < minInterval:
+			return 'interval', lastTime + minInterval
+
+		maxStale = options.get('maxStale')
+		if maxStale is not None and now - lastTime >= maxStale:
+			return None, None
+
+		try:
+			band = max(options.get('deadband', 0), options.get('deadbandRel', 0) * abs(last))
+			if abs(value - last) < band:
+				return 'deadband', None if maxStale is None else lastTime + maxStale
+		except TypeError:
+			pass # Invalid or not a number
+		return None, None
+
+	def _filter_timer(self, service, path, delay):
+		return GLib.timeout_add(int(delay * 1000) + 1, exit_on_error, self._filter_timeout, service, path)
+
+	# Dispatches what was held back, when minInterval or maxStale has passed
+	def _filter_timeout(self, service, path):
+		state = self._filterState.get((service.name, path))
+		if state is None:
+			return False
+		state[2] = None
+
+		a = service.paths[path]
+		if a.value == state[0]:
+			return False
+
+		now = time.monotonic()
+		reason, due = self._filter_reason(a.options, state, a.value, now)
+		if reason is not None:
+			if due is not None:
+				state[2] = self._filter_timer(service, path, due - now)
+			return False
+
+		state[0], state[1] = a.value, now
+		self.filterStats['trailing'] += 1
+		self._dispatch(service, path, a)
+		return False
+
+	def get_filter_stats(self):
+		return dict(self.filterStats)
+
+	def _drain_value_changes(self):
+		self._drainScheduled = False
+		queued, self._queuedChanges = self._queuedChanges, {}
+
+		dispatched = time.monotonic_ns() if self.timestamps else None
+		batch = []
+		for (serviceName, path), (changes, options) in queued.items():
+			# the service might have disappeared since the change was queued
+			if serviceName not in self.servicesByName:
+				continue
+			if dispatched is not None:
+				changes['Dispatched'] = dispatched
+			args = (serviceName, path, options, changes, self.get_device_instance(serviceName))
+			self._call_handlers(*args)
+			batch.append(args)
+
+		if self.batchCallback is not None:
+			if batch:
+				self.batchCallback(batch)
+		elif self.valueChangedCallback is not None:
+			for args in batch:
+				self.valueChangedCallback(*args)
+		return False
 
 	def _execute_value_changes(self, serviceName, objectPath, changes, options):
 		# double check that the service still exists, as it might have
@@ -346,8 +1015,53 @@ class DbusMonitor(object):
 		if serviceName not in self.servicesByName:
 			return
 
-		self.valueChangedCallback(serviceName, objectPath,
-			options, changes, self.get_device_instance(serviceName))
+		if self.timestamps:
+			changes['Dispatched'] = time.monotonic_ns()
+
+		deviceInstance = self.get_device_instance(serviceName)
+		self._call_handlers(serviceName, objectPath, options, changes, deviceInstance)
+		if self.valueChangedCallback is not None:
+			self.valueChangedCallback(serviceName, objectPath, options, changes, deviceInstance)
+
+	def _call_handlers(self, serviceName, objectPath, options, changes, deviceInstance):
+		handlers = self._handlers.get((serviceName, objectPath))
+		if handlers is not None:
+			for handler in handlers:
+				handler(serviceName, objectPath, options, changes, deviceInstance)
+
+	# Registers handler for changes of path on service. service is either a service class, for
+	# example com.victronenergy.solarcharger, or a service name, for example
+	# com.victronenergy.vebus.ttyO1. The handler is called like valueChangedCallback, and follows
+	# services as they come and go. Returns the rule to pass to remove_handler.
+	def add_handler(self, service, path, handler):
+		rule = (service, path, handler)
+		self._handlerRules.append(rule)
+		for s in self._services_matching(service):
+			self._bind_handler(s.name, path, handler)
+		return rule
+
+	def remove_handler(self, rule):
+		self._handlerRules.remove(rule)
+		service, path, handler = rule
+		for s in self._services_matching(service):
+			key = (s.name, path)
+			handlers = list(self._handlers.get(key, ()))
+			if handler in handlers:
+				handlers.remove(handler)
+			if handlers:
+				self._handlers[key] = tuple(handlers)
+			else:
+				self._handlers.pop(key, None)
+
+	def _services_matching(self, service):
+		if service in self.servicesByName:
+			return [self.servicesByName[service]]
+		return list(self.servicesByClass.get(service, ()))
+
+	def _bind_handler(self, serviceName, path, handler):
+		# Tuples, so a handler can add or remove handlers while they are being called
+		key = (serviceName, path)
+		self._handlers[key] = self._handlers.get(key, ()) + (handler, )
 
 	# Gets the value for a certain servicename and path
 	# The default_value is returned when:
@@ -2,9 +2,12 @@ import dbus
 import logging
 import time
 from functools import partial
+from os import _exit as os_exit
+from gi.repository import GLib
 
 # Local imports
 from vedbus import VeDbusItemImport
+from ve_utils import wrap_dbus_value, unwrap_dbus_value, exit_on_error
 
 ## Indexes for the setting dictonary.
 PATH = 0
@@ -34,8 +37,19 @@ class SettingsDevice(object):
 	# be logged by localsettings.
 	# @param eventCallback function that will be called on changes on any of these settings
 	# @param timeout Maximum interval to wait for localsettings. An exception is thrown at the end of the
-	# interval if the localsettings D-Bus service has not appeared yet.
-	def __init__(self, bus, supportedSettings, eventCallback, name='com.victronenergy.settings', timeout=0):
+	# interval if the localsettings D-Bus service has not appeared yet. 0 fails at once when it is not
+	# there, None waits forever.
+	# @param bulk Read all settings with one GetItems, add the missing ones with one AddSettings and
+	# track them all with one pair of signal matches, instead of a VeDbusItemImport per setting. Falls
+	# back to the one by one way when localsettings does not have these methods.
+	# @param readyCallback when set, the constructor does not block: it returns at once and waits for
+	# localsettings by watching NameOwnerChanged from the main loop. The settings are added and
+	# readyCallback(self) is called as soon as the service appears. timeout means the same as without it.
+	# @param errorCallback called with the exception when localsettings did not appear within timeout, or
+	# adding the settings failed. Without it the program exits then, as it would on the exception thrown
+	# by the blocking constructor.
+	def __init__(self, bus, supportedSettings, eventCallback, name='com.victronenergy.settings', timeout=0,
+			bulk=False, readyCallback=None, errorCallback=None):
 		logging.debug("===== Settings device init starting... =====")
 		self._bus = bus
 		self._dbus_name = name
@@ -43,6 +57,16 @@ class SettingsDevice(object):
 		self._values = {} # stored the values, used to pass the old value along on a setting change
 		self._settings = {}
 
+		# With bulk: the setting name per path, the current values and the signal matches
+		self._bulk = bulk
+		self._paths = {}
+		self._current = {}
+		self._matches = []
+
+		if readyCallback is not None:
+			self._waitAsync(supportedSettings, timeout, readyCallback, errorCallback)
+			return
+
 		count = 0
 		while True:
 			if 'com.victronenergy.settings' in self._bus.list_names():
@@ -58,7 +82,83 @@ class SettingsDevice(object):
 
 		logging.debug("===== Settings device init finished =====")
 
+	def _waitAsync(self, supportedSettings, timeout, readyCallback, errorCallback):
+		self._ready = partial(self._settingsAppeared, supportedSettings, readyCallback, errorCallback)
+		self._failAtOnce = timeout == 0
+		self._waitTimer = None
+		if timeout:
+			self._waitTimer = GLib.timeout_add_seconds(timeout, exit_on_error, self._waitTimeout)
+
+		# Subscribe before asking, so the service cannot appear in between unnoticed. The
+		# readyCallback runs from these, an exception in it must not be lost in the main loop.
+		self._waitMatch = self._bus.add_signal_receiver(partial(exit_on_error, self._nameOwnerChanged),
+			signal_name='NameOwnerChanged', dbus_interface='org.freedesktop.DBus',
+			arg0=self._dbus_name)
+		self._bus.call_async('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus',
+			'NameHasOwner', 's', [self._dbus_name],
+			reply_handler=partial(exit_on_error, self._nameHasOwner),
+			error_handler=partial(exit_on_error, self._finishWait))
+		logging.info('waiting for settings')
+
+	def _nameOwnerChanged(self, name, oldowner, newowner):
+		if newowner:
+			self._finishWait()
+
+	def _nameHasOwner(self, owner):
+		if owner:
+			self._finishWait()
+		elif self._failAtOnce:
+			self._finishWait(self._notFound())
+
+	def _waitTimeout(self):
+		self._waitTimer = None
+		self._finishWait(self._notFound())
+		return False
+
+	def _notFound(self):
+		return Exception("The settings service %s does not exist!" % self._dbus_name)
+
+	# Runs once, whichever of the signal, the NameHasOwner reply or the timer comes first
+	def _finishWait(self, error=None):
+		ready, self._ready = self._ready, None
+		if ready is None:
+			return
+		self._waitMatch.remove()
+		if self._waitTimer is not None:
+			GLib.source_remove(self._waitTimer)
+			self._waitTimer = None
+		ready(error)
+
+	def _settingsAppeared(self, supportedSettings, readyCallback, errorCallback, error):
+		if error is None:
+			try:
+				self.addSettings(supportedSettings)
+			except Exception as e:
+				error = e
+		if error is not None:
+			logging.error("Settings device init failed: %s" % error)
+			if errorCallback is None:
+				os_exit(1)
+			else:
+				errorCallback(error)
+			return
+		logging.debug("===== Settings device init finished =====")
+		readyCallback(self)
+
 	def addSettings(self, settings):
+		if self._bulk:
+			try:
+				self._addSettingsBulk(settings)
+				return
+			except dbus.exceptions.DBusException as e:
+				# Older localsettings have no GetItems on the root, or no root object at all
+				if e.get_dbus_name() not in ('org.freedesktop.DBus.Error.UnknownMethod',
+						'org.freedesktop.DBus.Error.UnknownObject'):
+					raise
+				logging.info("%s cannot add settings in bulk, adding them one by one" % self._dbus_name)
+				self._stopTracking()
+				self._importSettings()
+
 		for setting, options in settings.items():
 			silent = len(options) > SILENT and options[SILENT]
 			busitem = self.addSetting(options[PATH], options[VALUE],
@@ -73,14 +173,7 @@ class SettingsDevice(object):
 		else:
 			logging.info("Setting %s does not exist yet or must be adjusted" % path)
 
-			# Prepare to add the setting. Most dbus types extend the python
-			# type so it is only necessary to additionally test for Int64.
-			if isinstance(value, (int, dbus.Int64)):
-				itemType = 'i'
-			elif isinstance(value, float):
-				itemType = 'f'
-			else:
-				itemType = 's'
+			itemType = self._itemType(value)
 
 			# Add the setting
 			# TODO, make an object that inherits VeDbusItemImport, and complete the D-Bus settingsitem interface
@@ -95,6 +188,100 @@ class SettingsDevice(object):
 
 		return busitem
 
+	def _itemType(self, value):
+		# Most dbus types extend the python type so it is only necessary to
+		# additionally test for Int64.
+		if isinstance(value, (int, dbus.Int64)):
+			return 'i'
+		elif isinstance(value, float):
+			return 'f'
+		return 's'
+
+	def _addSettingsBulk(self, settings):
+		# Subscribe before reading, so no change gets lost in between
+		if not self._matches:
+			self._matches = [
+				self._bus.add_signal_receiver(self._itemsChanged,
+					dbus_interface='com.victronenergy.BusItem', signal_name='ItemsChanged',
+					path='/', bus_name=self._dbus_name),
+				self._bus.add_signal_receiver(self._propertiesChanged,
+					dbus_interface='com.victronenergy.BusItem', signal_name='PropertiesChanged',
+					bus_name=self._dbus_name, path_keyword='path')]
+
+		items = self._getItems()
+		missing = []
+		for setting, options in settings.items():
+			silent = len(options) > SILENT and options[SILENT]
+			path = options[PATH]
+			if path in items and self._attributesMatch(path, items[path], options, silent):
+				logging.debug("Setting %s found" % path)
+			else:
+				logging.info("Setting %s does not exist yet or must be adjusted" % path)
+				missing.append({
+					'path': path.replace('/Settings/', '', 1),
+					'default': options[VALUE], 'type': self._itemType(options[VALUE]),
+					'min': options[MINIMUM], 'max': options[MAXIMUM], 'silent': silent})
+
+		if missing:
+			results = self._bus.call_blocking(self._dbus_name, '/Settings', None, 'AddSettings',
+				'aa{sv}', [missing])
+			for r in results:
+				if r.get('error', 0) != 0:
+					logging.error("Adding setting %s failed with error %s" % (r.get('path'), r['error']))
+			items = self._getItems()
+
+		for setting, options in settings.items():
+			path = options[PATH]
+			self._paths[path] = setting
+			self._settings[setting] = path
+			item = items.get(path)
+			self._current[setting] = self._values[setting] = \
+				None if item is None else unwrap_dbus_value(item['Value'])
+
+	def _getItems(self):
+		return self._bus.call_blocking(self._dbus_name, '/', 'com.victronenergy.BusItem', 'GetItems', '', [])
+
+	def _attributesMatch(self, path, item, options, silent):
+		# Older localsettings don't include the attributes in GetItems
+		if 'Default' not in item:
+			return (options[VALUE], options[MINIMUM], options[MAXIMUM], silent) == \
+				self._bus.call_blocking(self._dbus_name, path, None, 'GetAttributes', '', [])
+		return (options[VALUE], options[MINIMUM], options[MAXIMUM]) == \
+			(item['Default'], item.get('Min'), item.get('Max')) and silent == item.get('Silent', silent)
+
+	# Settings added in bulk by an earlier call are known by their path only
+	def _importSettings(self):
+		for setting, path in list(self._settings.items()):
+			busitem = VeDbusItemImport(self._bus, self._dbus_name, path,
+				partial(self.handleChangedSetting, setting))
+			self._settings[setting] = busitem
+			self._values[setting] = busitem.get_value()
+		self._paths.clear()
+		self._current.clear()
+
+	def _stopTracking(self):
+		for match in self._matches:
+			match.remove()
+		self._matches = []
+		self._bulk = False
+
+	def _itemsChanged(self, items):
+		if not isinstance(items, dict):
+			return
+		for path, changes in items.items():
+			self._propertiesChanged(changes, path)
+
+	def _propertiesChanged(self, changes, path):
+		setting = self._paths.get(path)
+		if setting is None or 'Value' not in changes:
+			return
+		value = unwrap_dbus_value(changes['Value'])
+		self._current[setting] = value
+		# Both signals may arrive for one change
+		if setting in self._values and self._values[setting] == value:
+			return
+		self.handleChangedSetting(setting, self._dbus_name, path, {'Value': value, 'Text': changes.get('Text')})
+
 	def handleChangedSetting(self, setting, servicename, path, changes):
 		oldvalue = self._values[setting] if setting in self._values else None
 		self._values[setting] = changes['Value']
@@ -109,10 +296,20 @@ class SettingsDevice(object):
                 item.set_default()
 
 	def __getitem__(self, setting):
+		if self._bulk:
+			return self._current[setting]
 		return self._settings[setting].get_value()
 
 	def __setitem__(self, setting, newvalue):
-		result = self._settings[setting].set_value(newvalue)
+		if self._bulk:
+			path = self._settings[setting]
+			result = self._bus.call_blocking(self._dbus_name, path, 'com.victronenergy.BusItem', 'SetValue',
+				'v', [wrap_dbus_value(newvalue)])
+			# Should localsettings store it as another type, its signal corrects the value
+			if result == 0:
+				self._current[setting] = newvalue
+		else:
+			result = self._settings[setting].set_value(newvalue)
 		if result != 0:
 			# Trying to make some false change to our own settings? How dumb!
 			assert False
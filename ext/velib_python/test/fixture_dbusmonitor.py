@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# A service for the DbusMonitor tests, with /DeviceInstance and /Value. Its replies can be
+# delayed, and it can take its name some time after starting. A line "<path> <value>" on stdin
+# sets a value, and sends PropertiesChanged for it. TextCalls on / returns how many GetText
+# calls it got.
+
+from dbus.mainloop.glib import DBusGMainLoop
+import argparse
+import dbus
+import dbus.service
+import sys
+import os
+
+# our own packages
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
+from gi.repository import GLib
+from ve_utils import wrap_dbus_value
+
+textCalls = 0
+
+class Item(dbus.service.Object):
+	def __init__(self, bus, path, values, delay):
+		super(Item, self).__init__(bus, path)
+		self.path = path
+		self.values = values
+		self.delay = delay
+
+	def value(self):
+		return self.values[self.path]
+
+	def text(self):
+		return str(self.values[self.path])
+
+	# The reply is made when it is sent, a change meanwhile goes out first
+	def reply(self, reply, f):
+		def send():
+			reply(f())
+			return False
+		GLib.timeout_add(self.delay, send)
+
+	@dbus.service.method('com.victronenergy.BusItem', out_signature='v',
+		async_callbacks=('reply', 'error'))
+	def GetValue(self, reply, error):
+		self.reply(reply, lambda: wrap_dbus_value(self.value()))
+
+	@dbus.service.method('com.victronenergy.BusItem', out_signature='v',
+		async_callbacks=('reply', 'error'))
+	def GetText(self, reply, error):
+		global textCalls
+		textCalls += 1
+		self.reply(reply, lambda: wrap_dbus_value(self.text()))
+
+	@dbus.service.signal('com.victronenergy.BusItem', signature='a{sv}')
+	def PropertiesChanged(self, changes):
+		pass
+
+class Root(Item):
+	def value(self):
+		return {p[1:]: v for p, v in self.values.items()}
+
+	def text(self):
+		return {p[1:]: str(v) for p, v in self.values.items()}
+
+	@dbus.service.method('com.victronenergy.Test', out_signature='i')
+	def TextCalls(self):
+		return textCalls
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('name')
+	parser.add_argument('--instance', type=int, default=0)
+	parser.add_argument('--value', type=int, default=1)
+	parser.add_argument('--delay', type=int, default=0, help='ms until a reply is sent')
+	parser.add_argument('--start-after', type=int, default=0, help='ms until the name is taken')
+	args = parser.parse_args()
+
+	DBusGMainLoop(set_as_default=True)
+	dbusConn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+
+	values = {'/DeviceInstance': args.instance, '/Value': args.value}
+	root = Root(dbusConn, '/', values, args.delay)
+	items = {p: Item(dbusConn, p, values, args.delay) for p in values}
+
+	names = []
+	def takename():
+		names.append(dbus.service.BusName(args.name, dbusConn))
+		return False
+	if args.start_after:
+		GLib.timeout_add(args.start_after, takename)
+	else:
+		takename()
+
+	def command(source, condition):
+		line = sys.stdin.readline()
+		if not line:
+			mainloop.quit()
+			return False
+		path, value = line.split()
+		values[path] = int(value)
+		items[path].PropertiesChanged({'Value': wrap_dbus_value(values[path]), 'Text': str(values[path])})
+		return True
+	GLib.io_add_watch(sys.stdin, GLib.IO_IN | GLib.IO_HUP, command)
+
+	mainloop = GLib.MainLoop()
+	print("up and running")
+	sys.stdout.flush()
+	mainloop.run()
+
+main()
@@ -13,7 +13,7 @@ import os
 # our own packages
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
 from gi.repository import GLib
-from vedbus import VeDbusItemExport
+from vedbus import VeDbusService, VeDbusItemExport, PublishPolicy
 
 # Dictionary containing all objects exported to dbus
 dbusObjects = {}
@@ -48,7 +48,12 @@ def main(argv):
 		dbusObjects['negativeInt'] = VeDbusItemExport(dbusConn, '/NegativeInt', -10)
 		dbusObjects['float'] = VeDbusItemExport(dbusConn, '/Float', 1.5)
 		dbusObjects['invalid'] = VeDbusItemExport(dbusConn, '/Invalid', None)
+		dbusObjects['typed'] = VeDbusItemExport(dbusConn, '/Typed', 5, valuetype='d')
 		dbusObjects['byte'] = VeDbusItemExport(dbusConn, '/Byte', dbus.Byte(84))
+		dbusObjects['bool'] = VeDbusItemExport(dbusConn, '/Bool', True)
+		dbusObjects['int64'] = VeDbusItemExport(dbusConn, '/Int64', 2**40)
+		dbusObjects['emptyList'] = VeDbusItemExport(dbusConn, '/EmptyList', [])
+		dbusObjects['dict'] = VeDbusItemExport(dbusConn, '/Dict', {'a': 1, 'b': 'c'})
 		dbusObjects['writeable'] = VeDbusItemExport(dbusConn, '/Writeable', 'original', writeable=True)
 		dbusObjects['not-writeable'] = VeDbusItemExport(dbusConn, '/NotWriteable', 'original', writeable=False)
 
@@ -58,6 +63,46 @@ def main(argv):
 		dbusObjects['gettextcallback'] = VeDbusItemExport(dbusConn, '/Gettextcallback',
 			'10', gettextcallback=gettext, writeable=True)
 
+		# A VeDbusService, for the tests of the service itself. It needs a connection of its own, as
+		# it exports the root object.
+		serviceConn = dbus.SessionBus(private=True) if 'DBUS_SESSION_BUS_ADDRESS' in os.environ \
+			else dbus.SystemBus(private=True)
+		service = VeDbusService('com.victronenergy.dbusexample.service', bus=serviceConn, autobatch=True)
+		dbusObjects['service'] = service
+
+		# Setting /Batch/Set sets /Batch/A, B and C to the same value, in one main loop iteration
+		def setbatch(path, value):
+			for p in ('/Batch/A', '/Batch/B', '/Batch/C'):
+				service[p] = value
+			return True
+		for p in ('/Batch/A', '/Batch/B', '/Batch/C'):
+			service.add_path(p, 0)
+		service.add_path('/Batch/Set', 0, writeable=True, onchangecallback=setbatch)
+
+		# A small tree, for GetValue and GetText on the nodes in between
+		service.add_path('/Tree/A/X', 1)
+		service.add_path('/Tree/A/Y', 2)
+		service.add_path('/Tree/B/Z', 3)
+		service.add_path('/TreeSibling', 4)
+
+		# Changes of less than 10 are not signalled
+		service.add_path('/Policy', 100, writeable=True, publishpolicy=PublishPolicy(absdelta=10))
+
+		# The text of /Lazy is only formatted when asked for, and is not signalled
+		service.add_path('/Lazy', 1, writeable=True, gettextcallback=gettext, textinsignals=False)
+
+		# Setting /Control/AddPath to a path adds it with value 5
+		def addpath(path, value):
+			service.add_path(value, 5)
+			return True
+		service.add_path('/Control/AddPath', '', writeable=True, onchangecallback=addpath)
+
+		# Setting /Control/RemovePaths to a path calls remove_paths with it
+		def removepaths(path, value):
+			service.remove_paths(value)
+			return True
+		service.add_path('/Control/RemovePaths', '', writeable=True, onchangecallback=removepaths)
+
 		mainloop = GLib.MainLoop()
 		print("up and running")
 		sys.stdout.flush()
@@ -13,6 +13,7 @@ class MockDbusMonitor(object):
         self._tree = {}
         self._seen = defaultdict(set)
         self._watches = defaultdict(dict)
+        self._handlers = []
         self._checkPaths = checkPaths
         self._value_changed_callback = valueChangedCallback
         self._device_removed_callback = deviceRemovedCallback
@@ -87,6 +88,7 @@ class MockDbusMonitor(object):
         self.set_seen(serviceName, objectPath)
         if self._value_changed_callback != None:
             self._value_changed_callback(serviceName, objectPath, None, None, None)
+        self._call_handlers(serviceName, objectPath, {'Value': value, 'Text': str(value)})
         if serviceName in self._watches:
             if objectPath in self._watches[serviceName]:
                 self._watches[serviceName][objectPath]({'Value': value, 'Text': str(value)})
@@ -134,6 +136,29 @@ class MockDbusMonitor(object):
     def track_value(self, serviceName, objectPath, callback, *args, **kwargs):
         self._watches[serviceName][objectPath] = partial(callback, *args, **kwargs)
 
+    def add_handler(self, service, path, handler):
+        rule = (service, path, handler)
+        self._handlers.append(rule)
+        return rule
+
+    def remove_handler(self, rule):
+        self._handlers.remove(rule)
+
+    def _call_handlers(self, serviceName, objectPath, changes):
+        for service, path, handler in list(self._handlers):
+            if path == objectPath and service in (serviceName, _class_name(serviceName)):
+                handler(serviceName, objectPath, None, changes, self.get_value(serviceName, '/DeviceInstance', 0))
+
+    # Nothing is filtered here
+    def get_filter_stats(self):
+        return {'passed': 0, 'deadband': 0, 'interval': 0, 'trailing': 0}
+
+    def save_snapshot(self):
+        pass
+
+    def discard_snapshot(self):
+        pass
+
     @property
     def dbusConn(self):
         raise dbus.DBusException("No Connection")
@@ -1,13 +1,13 @@
 # Simulates the busService object without using the D-Bus (intended for unit tests). Data usually stored in
 # D-Bus items is now stored in memory.
 class MockDbusService(object):
-    def __init__(self, servicename):
+    def __init__(self, servicename, bus=None, autobatch=False, typecheck=False):
         self._dbusobjects = {}
         self._callbacks = {}
         self._service_name = servicename
 
     def add_path(self, path, value, description="", writeable=False, onchangecallback=None,
-                 gettextcallback=None):
+                 gettextcallback=None, publishpolicy=None, textinsignals=True, valuetype=None):
         self._dbusobjects[path] = value
         if onchangecallback is not None:
             self._callbacks[path] = onchangecallback
@@ -46,9 +46,20 @@ class MockDbusService(object):
     def __delitem__(self, path):
         del self._dbusobjects[path]
 
+    def remove_paths(self, prefix):
+        base = prefix.rstrip('/')
+        paths = [p for p in self._dbusobjects if p == prefix or p.startswith(base + '/')]
+        for p in paths:
+            del self._dbusobjects[p]
+        return len(paths)
+
     def __contains__(self, path):
         return path in self._dbusobjects
 
+    # Nothing to send
+    def flush(self):
+        pass
+
     def __enter__(self):
         # No batching done in mock object, and we already
         # support the required dict interface.
@@ -1,3 +1,5 @@
+import mock_gobject
+
 PATH = 0
 VALUE = 1
 MINIMUM = 2
@@ -25,10 +27,19 @@ class MockSettingsItem(object):
 # Simulates the SettingsSevice object without using the D-Bus (intended for unit tests). Values passed to
 # __setitem__ (or the [] operator) will be stored in memory for later retrieval by __getitem__.
 class MockSettingsDevice(object):
-    def __init__(self, supported_settings, event_callback, name='com.victronenergy.settings', timeout=0):
+    def __init__(self, supported_settings, event_callback, name='com.victronenergy.settings', timeout=0,
+            bulk=False, readyCallback=None, errorCallback=None):
         self._dbus_name = name
         self._settings = supported_settings
         self._event_callback = event_callback
+        # Settings are always there, an asynchronous construction is ready on the first run of
+        # the mock timers, after the constructor returned, as with SettingsDevice
+        if readyCallback is not None:
+            mock_gobject.timeout_add(0, self._ready, readyCallback)
+
+    def _ready(self, readyCallback):
+        readyCallback(self)
+        return False
 
     def addSetting(self, path, value, _min, _max, silent=False, callback=None):
         # Persist in our settings stash so the settings is available through
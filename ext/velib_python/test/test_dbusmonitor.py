@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Python
+import logging
+import os
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+# Local
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
+import dbusmonitor
+from dbusmonitor import DbusMonitor, Service
+import mock_gobject
+
+logger = logging.getLogger(__file__)
+
+# DbusMonitor subscribes to signals, even when the test does not run the main loop
+DBusGMainLoop(set_as_default=True)
+
+# Stands in for the time module in dbusmonitor, driven by the mock timer manager
+class MockClock(object):
+	@staticmethod
+	def monotonic():
+		return mock_gobject.timer_manager.time / 1000.0
+
+	@staticmethod
+	def monotonic_ns():
+		return mock_gobject.timer_manager.time * 1000000
+
+# The subscriptions of a monitor outlive the test, make it ignore what follows
+def retire(monitor):
+	monitor._process_name_owner_changed = lambda *args: None
+	monitor.valueChangedCallback = monitor.batchCallback = None
+	monitor.deviceAddedCallback = monitor.deviceRemovedCallback = None
+
+def options(**kwargs):
+	return dict({'code': None, 'whenToLog': 'configChange'}, **kwargs)
+
+class ServiceTests(unittest.TestCase):
+	def test_categories(self):
+		# Callers append to them directly, as well as through add_to_log
+		service = Service(':1.999', 'com.victronenergy.test.a', 0)
+		for option in Service.whentologoptions:
+			self.assertEqual([], service[option])
+		service.add_to_log('configChange', '/A')
+		service.configChange.append('/B')
+		service['never'].append('/C')
+		self.assertEqual(['/A', '/B'], service.configChange)
+		self.assertEqual(['/C'], service.never)
+		self.assertEqual([], Service(':1.1000', 'com.victronenergy.test.b', 0).configChange)
+
+class MockedTests(unittest.TestCase):
+	# A monitor with one service of the tree, added without scanning the bus. Timers and time
+	# come from mock_gobject.
+	def setUp(self):
+		mock_gobject.timer_manager.reset()
+		self.glib, dbusmonitor.GLib = dbusmonitor.GLib, mock_gobject
+		self.time, dbusmonitor.time = dbusmonitor.time, MockClock
+		self.monitor = None
+
+	def tearDown(self):
+		if self.monitor is not None:
+			retire(self.monitor)
+		dbusmonitor.GLib = self.glib
+		dbusmonitor.time = self.time
+
+	def create(self, **kwargs):
+		self.monitor = DbusMonitor(self.tree, **kwargs)
+		self.service = Service(':1.999', 'com.victronenergy.test.a', 0)
+		for path, o in self.tree['com.victronenergy.test'].items():
+			self.monitor._add_path(self.service, path, o, 100, None)
+		self.monitor._add_service(self.service)
+		return self.monitor
+
+	def change(self, path, value, at=None):
+		if at is not None:
+			mock_gobject.timer_manager.run(at * 1000 - mock_gobject.timer_manager.time)
+		self.monitor._handler_value_changes(self.service, path, value, str(value))
+		self.assertEqual(self.monitor.get_value(self.service.name, path), value)
+
+class FilterTests(MockedTests):
+	# The filter options of the dbusTree. Dispatched changes are recorded instead of handed to
+	# the main loop.
+	tree = {'com.victronenergy.test': {
+		'/Plain': options(),
+		'/Deadband': options(deadband=10),
+		'/Relative': options(deadbandRel=0.1),
+		'/Interval': options(minInterval=2),
+		'/Stale': options(deadband=10, maxStale=5),
+		'/Thresholds': options(deadband=100, thresholds=(50, )),
+		}}
+
+	def setUp(self):
+		super(FilterTests, self).setUp()
+		self.create(valueChangedCallback=lambda *args: None)
+		self.dispatched = []
+		self.monitor._dispatch = lambda service, path, a, received=None: \
+			self.dispatched.append((path, a.value))
+
+	def stats(self, **kwargs):
+		return dict({'passed': 0, 'deadband': 0, 'interval': 0, 'trailing': 0}, **kwargs)
+
+	def test_unfiltered(self):
+		self.change('/Plain', 101)
+		self.assertEqual(self.dispatched, [('/Plain', 101)])
+		self.assertNotIn((self.service.name, '/Plain'), self.monitor._filterState)
+		self.assertEqual(self.monitor.get_filter_stats(), self.stats())
+
+	def test_seeded_by_scan(self):
+		# The first change after the scan is compared with the scanned value
+		self.assertEqual(self.monitor._filterState[(self.service.name, '/Deadband')], [100, 0, None])
+		self.change('/Deadband', 105)
+		self.assertEqual(self.dispatched, [])
+		self.assertEqual(self.monitor.get_filter_stats(), self.stats(deadband=1))
+
+	def test_deadband(self):
+		self.change('/Deadband', 109)
+		self.change('/Deadband', 91)
+		self.assertEqual(self.dispatched, [])
+		self.change('/Deadband', 110)
+		self.assertEqual(self.dispatched, [('/Deadband', 110)])
+
+		# Compared with the last dispatched value, not with the last change
+		self.change('/Deadband', 115)
+		self.change('/Deadband', 120)
+		self.assertEqual(self.dispatched, [('/Deadband', 110), ('/Deadband', 120)])
+		self.assertEqual(self.monitor.get_filter_stats(), self.stats(passed=2, deadband=3))
+
+		# Without maxStale nothing held back is dispatched later
+		mock_gobject.timer_manager.run()
+		self.assertEqual(len(self.dispatched), 2)
+
+	def test_deadband_not_a_number(self):
+		self.change('/Deadband', None)
+		self.change('/Deadband', 101)
+		self.assertEqual(self.dispatched, [('/Deadband', None), ('/Deadband', 101)])
+
+	def test_deadband_relative(self):
+		self.change('/Relative', 109)
+		self.assertEqual(self.dispatched, [])
+		self.change('/Relative', 110)
+		self.assertEqual(self.dispatched, [('/Relative', 110)])
+
+		# The band follows the last dispatched value
+		self.change('/Relative', 120)
+		self.change('/Relative', 121)
+		self.assertEqual(self.dispatched, [('/Relative', 110), ('/Relative', 121)])
+
+	def test_min_interval(self):
+		# The scanned value counts as dispatched at 0
+		self.change('/Interval', 1, at=1)
+		self.change('/Interval', 2, at=1.5)
+		self.assertEqual(self.dispatched, [])
+		self.assertEqual(self.monitor.get_filter_stats(), self.stats(interval=2))
+
+		# The latest value is dispatched when the interval has passed
+		mock_gobject.timer_manager.run(1000)
+		self.assertEqual(self.dispatched, [('/Interval', 2)])
+		self.assertEqual(self.monitor.get_filter_stats(), self.stats(interval=2, trailing=1))
+
+		# The interval starts again at that dispatch
+		self.change('/Interval', 3, at=3)
+		self.assertEqual(len(self.dispatched), 1)
+		mock_gobject.timer_manager.run(1100)
+		self.assertEqual(self.dispatched, [('/Interval', 2), ('/Interval', 3)])
+
+	def test_min_interval_back_to_dispatched(self):
+		# A value that went back to the dispatched one is not dispatched again
+		self.change('/Interval', 1, at=1)
+		self.change('/Interval', 100, at=1.5)
+		mock_gobject.timer_manager.run()
+		self.assertEqual(self.dispatched, [])
+		self.assertEqual(self.monitor.get_filter_stats()['trailing'], 0)
+
+	def test_max_stale(self):
+		self.change('/Stale', 105, at=1)
+		self.assertEqual(self.dispatched, [])
+
+		# Held back by the deadband, but dispatched when maxStale has passed since the scan
+		mock_gobject.timer_manager.run(3900)
+		self.assertEqual(self.dispatched, [])
+		mock_gobject.timer_manager.run(200)
+		self.assertEqual(self.dispatched, [('/Stale', 105)])
+		self.assertEqual(self.monitor.get_filter_stats(), self.stats(deadband=1, trailing=1))
+
+		# A change after maxStale passes right away
+		self.change('/Stale', 106, at=20)
+		self.assertEqual(self.dispatched, [('/Stale', 105), ('/Stale', 106)])
+
+	def test_trailing_timer_cancelled(self):
+		self.change('/Stale', 105, at=1)
+		self.change('/Stale', 120, at=2)
+		self.assertEqual(self.dispatched, [('/Stale', 120)])
+		self.assertEqual(mock_gobject.timer_manager._resources, [])
+
+		mock_gobject.timer_manager.run()
+		self.assertEqual(self.dispatched, [('/Stale', 120)])
+		self.assertEqual(self.monitor.get_filter_stats(), self.stats(passed=1, deadband=1))
+
+	def test_thresholds(self):
+		# Within the deadband, but crossing a threshold
+		self.change('/Thresholds', 49)
+		self.change('/Thresholds', 20)
+		self.change('/Thresholds', 50)
+		self.change('/Thresholds', 149)
+		self.assertEqual(self.dispatched, [('/Thresholds', 49), ('/Thresholds', 50)])
+		self.assertEqual(self.monitor.get_filter_stats(), self.stats(passed=2, deadband=2))
+
+	def test_remove_service(self):
+		self.change('/Stale', 105, at=1)
+		self.monitor._remove_service(self.service.name)
+		self.assertEqual(self.monitor._filterState, {})
+		self.assertEqual(mock_gobject.timer_manager._resources, [])
+
+class DispatchTests(MockedTests):
+	tree = {'com.victronenergy.test': {
+		'/A': options(),
+		'/B': options(),
+		}}
+
+	def setUp(self):
+		super(DispatchTests, self).setUp()
+		self.calls = []
+
+	def callback(self, service, path, options, changes, deviceInstance):
+		self.calls.append(('callback', path, changes['Value']))
+
+	def batch(self, changes):
+		self.calls.append(('batch', [(path, c['Value']) for s, path, o, c, d in changes]))
+
+	def handler(self, name, f=None):
+		def h(service, path, options, changes, deviceInstance):
+			self.calls.append((name, path, changes['Value']))
+			if f is not None:
+				f()
+		return h
+
+	def dispatch(self):
+		mock_gobject.timer_manager.run()
+
+	def test_unbatched(self):
+		self.create(valueChangedCallback=self.callback)
+		self.change('/A', 1)
+		self.change('/B', 2)
+		self.change('/A', 3)
+		self.dispatch()
+		self.assertEqual(self.calls, [('callback', '/A', 1), ('callback', '/B', 2), ('callback', '/A', 3)])
+
+	def test_batched(self):
+		self.create(batchCallback=self.batch)
+		self.change('/A', 1)
+		self.change('/B', 2)
+		self.change('/A', 3)
+		self.assertEqual(self.calls, [])
+		self.assertEqual(len(mock_gobject.timer_manager._resources), 1)
+
+		# The latest value per path, in the order the paths first changed
+		self.dispatch()
+		self.assertEqual(self.calls, [('batch', [('/A', 3), ('/B', 2)])])
+
+		# The order starts over with the next batch
+		self.change('/B', 4)
+		self.change('/A', 5)
+		self.dispatch()
+		self.assertEqual(self.calls[1:], [('batch', [('/B', 4), ('/A', 5)])])
+
+	def test_batched_handlers_first(self):
+		self.create(valueChangedCallback=self.callback, batchDispatch=True)
+		self.monitor.add_handler('com.victronenergy.test', '/B', self.handler('handler'))
+		self.change('/A', 1)
+		self.change('/B', 2)
+		self.dispatch()
+		self.assertEqual(self.calls, [('handler', '/B', 2), ('callback', '/A', 1), ('callback', '/B', 2)])
+
+	def test_batched_service_gone(self):
+		self.create(batchCallback=self.batch)
+		self.change('/A', 1)
+		self.monitor._remove_service(self.service.name)
+		self.dispatch()
+		self.assertEqual(self.calls, [])
+
+	def test_unchanged(self):
+		self.create(batchCallback=self.batch)
+		self.change('/A', 100)
+		self.assertEqual(mock_gobject.timer_manager._resources, [])
+
+	def test_add_handler_during_dispatch(self):
+		# A handler added while dispatching gets the next change, not the current one
+		self.create(batchDispatch=True)
+		def add():
+			if len(self.calls) == 1:
+				self.monitor.add_handler(self.service.name, '/A', self.handler('second'))
+		self.monitor.add_handler(self.service.name, '/A', self.handler('first', add))
+		self.change('/A', 1)
+		self.dispatch()
+		self.assertEqual(self.calls, [('first', '/A', 1)])
+		self.change('/A', 2)
+		self.dispatch()
+		self.assertEqual(self.calls[1:], [('first', '/A', 2), ('second', '/A', 2)])
+
+	def test_remove_handler_during_dispatch(self):
+		# The handlers of a change are taken when it is dispatched, removing one, itself or
+		# another, takes effect from the next change
+		self.create(batchDispatch=True)
+		rules = []
+		def remove():
+			while rules:
+				self.monitor.remove_handler(rules.pop())
+		rules.append(self.monitor.add_handler(self.service.name, '/A', self.handler('first', remove)))
+		rules.append(self.monitor.add_handler(self.service.name, '/A', self.handler('second')))
+		self.monitor.add_handler('com.victronenergy.test', '/A', self.handler('third'))
+		self.change('/A', 1)
+		self.dispatch()
+		self.assertEqual(self.calls, [('first', '/A', 1), ('second', '/A', 1), ('third', '/A', 1)])
+		self.change('/A', 2)
+		self.dispatch()
+		self.assertEqual(self.calls[3:], [('third', '/A', 2)])
+
+class ValueOnlyTests(MockedTests):
+	tree = {'com.victronenergy.test': {
+		'/A': options(),
+		}}
+
+	def received(self, valueOnly):
+		changes = []
+		self.create(valueChangedCallback=lambda s, p, o, c, d: changes.append(c), valueOnly=valueOnly)
+		self.monitor.handler_value_changes({'Value': dbus.Int32(5), 'Text': '5 W'}, '/A', self.service.id)
+		self.monitor.handler_item_changes({'/A': {'Value': dbus.Int32(6), 'Text': '6 W'}}, self.service.id)
+		mock_gobject.timer_manager.run()
+		return changes, self.service.paths['/A'].text
+
+	def test_value_only(self):
+		self.assertEqual(self.received(True), ([{'Value': 5}, {'Value': 6}], None))
+
+	def test_with_text(self):
+		self.assertEqual(self.received(False), ([{'Value': 5, 'Text': '5 W'}, {'Value': 6, 'Text': '6 W'}], '6 W'))
+
+class FixtureTests(unittest.TestCase):
+	# Runs fixture_dbusmonitor.py as a subprocess per service
+
+	tree = {'com.victronenergy.test': {
+		'/Value': options(),
+		}}
+
+	def setUp(self):
+		self.fixtures = []
+		self.monitors = []
+		self.changes = []
+		self.added = []
+		self.removed = []
+		self.dbusConn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+
+	def tearDown(self):
+		for m in self.monitors:
+			retire(m)
+		for sp in self.fixtures:
+			sp.kill()
+			sp.wait()
+			sp.stdin.close()
+			sp.stdout.close()
+		self.run_until(lambda: not any(n.startswith('com.victronenergy.test.') for n in self.dbusConn.list_names()))
+		self.run_until(lambda: False, 0.1)
+
+	def start(self, name, *args, wait=True):
+		sp = subprocess.Popen([sys.executable, 'fixture_dbusmonitor.py', name] + list(args),
+			stdout=subprocess.PIPE, stdin=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+		self.fixtures.append(sp)
+		while (sp.stdout.readline().rstrip() != b'up and running'):
+			pass
+		if wait:
+			self.assertTrue(self.run_until(lambda: self.dbusConn.name_has_owner(name)))
+		return sp
+
+	def monitor(self, **kwargs):
+		m = DbusMonitor(self.tree,
+			valueChangedCallback=lambda s, p, o, changes, d: self.changes.append((s, p, changes['Value'])),
+			deviceAddedCallback=lambda *args: self.added.append(args),
+			deviceRemovedCallback=lambda *args: self.removed.append(args), **kwargs)
+		self.monitors.append(m)
+		return m
+
+	# Sets a value in the fixture, it sends PropertiesChanged for it
+	def set_value(self, sp, path, value):
+		sp.stdin.write(('%s %d\n' % (path, value)).encode())
+		sp.stdin.flush()
+
+	# Runs the main loop until cond() is true, returns False if that did not happen in time
+	def run_until(self, cond, timeout=5):
+		context = GLib.MainContext.default()
+		end = time.monotonic() + timeout
+		while not cond():
+			if time.monotonic() > end:
+				return False
+			if not context.iteration(False):
+				time.sleep(0.01)
+		return True
+
+class AsyncScanTests(FixtureTests):
+	def test_scan(self):
+		self.start('com.victronenergy.test.a', '--instance', '3', '--value', '10')
+		self.start('com.victronenergy.test.b', '--instance', '4', '--value', '20')
+		m = self.monitor(asyncScan=True)
+		self.assertEqual(m.get_service_list(), {'com.victronenergy.test.a': 3, 'com.victronenergy.test.b': 4})
+		self.assertEqual(m.get_value('com.victronenergy.test.a', '/Value'), 10)
+		self.assertEqual(m.get_value('com.victronenergy.test.b', '/Value'), 20)
+		self.assertTrue(m.seen('com.victronenergy.test.b', '/Value'))
+
+		# Found by the startup scan, not reported as added
+		self.run_until(lambda: False, 0.2)
+		self.assertEqual(self.added, [])
+
+	def test_slow_service(self):
+		# A slow service within the deadline is part of the startup scan
+		self.start('com.victronenergy.test.slow', '--delay', '300')
+		self.start('com.victronenergy.test.a')
+		m = self.monitor(asyncScan=True, scanDeadline=5)
+		self.assertGreaterEqual(m.scanTime, 0.3)
+		self.assertEqual(set(m.get_service_list()), {'com.victronenergy.test.slow', 'com.victronenergy.test.a'})
+		self.run_until(lambda: False, 0.2)
+		self.assertEqual(self.added, [])
+
+	def test_deadline(self):
+		# The constructor does not wait for the slow service, it is merged later
+		self.start('com.victronenergy.test.slow', '--delay', '1500', '--instance', '7', '--value', '5')
+		self.start('com.victronenergy.test.a')
+		m = self.monitor(asyncScan=True, scanDeadline=0.5)
+		self.assertLess(m.scanTime, 1.5)
+		self.assertEqual(set(m.get_service_list()), {'com.victronenergy.test.a'})
+
+		self.assertTrue(self.run_until(lambda: 'com.victronenergy.test.slow' in m.get_service_list()))
+		self.assertEqual(self.added, [('com.victronenergy.test.slow', 7)])
+		self.assertEqual(m.get_value('com.victronenergy.test.slow', '/Value'), 5)
+
+	def test_late_service_changes(self):
+		# A change while the slow service is still scanned is not lost
+		sp = self.start('com.victronenergy.test.slow', '--delay', '1000', '--value', '5')
+		m = self.monitor(asyncScan=True, scopedSignals=True, scanDeadline=0.3)
+		self.assertEqual(m.get_service_list(), {})
+		self.set_value(sp, '/Value', 6)
+		self.assertTrue(self.run_until(lambda: 'com.victronenergy.test.slow' in m.get_service_list()))
+		self.assertEqual(m.get_value('com.victronenergy.test.slow', '/Value'), 6)
+
+	def test_scan_timeout(self):
+		# A service that does not answer within scanTimeout is skipped by the scan
+		self.start('com.victronenergy.test.slow', '--delay', '1500')
+		m = self.monitor(asyncScan=True, scanTimeout=0.3, scanDeadline=5)
+		self.assertLess(m.scanTime, 1.5)
+		self.assertEqual(m.get_service_list(), {})
+
+	def test_known_owner(self):
+		# The NameOwnerChanged of a service that appeared while scanning, after the scan found it
+		self.start('com.victronenergy.test.a')
+		m = self.monitor(asyncScan=True)
+		owner = m.servicesByName['com.victronenergy.test.a'].id
+		m._process_name_owner_changed('com.victronenergy.test.a', '', owner)
+		self.assertEqual(m.servicesByName['com.victronenergy.test.a'].id, owner)
+		self.assertEqual((self.added, self.removed), ([], []))
+
+	def test_appears_during_scan(self):
+		# Taking its name while the slow service is scanned, the other one is reported as added
+		self.start('com.victronenergy.test.slow', '--delay', '1000')
+		self.start('com.victronenergy.test.late', '--start-after', '300', '--instance', '2', wait=False)
+		m = self.monitor(asyncScan=True, scanDeadline=5)
+		self.assertGreaterEqual(m.scanTime, 1)
+		self.assertTrue(self.run_until(lambda: 'com.victronenergy.test.late' in m.get_service_list()))
+		self.assertEqual(self.added, [('com.victronenergy.test.late', 2)])
+
+	def test_removed(self):
+		sp = self.start('com.victronenergy.test.a', '--instance', '3')
+		m = self.monitor(asyncScan=True)
+		sp.kill()
+		self.assertTrue(self.run_until(lambda: not m.get_service_list()))
+		self.assertEqual(self.removed, [('com.victronenergy.test.a', 3)])
+
+class ValueOnlyScanTests(FixtureTests):
+	def text_calls(self, name):
+		return self.dbusConn.call_blocking(name, '/', 'com.victronenergy.Test', 'TextCalls', '', [])
+
+	def scan(self, **kwargs):
+		self.start('com.victronenergy.test.a', '--value', '5')
+		m = self.monitor(**kwargs)
+		self.assertEqual(m.get_value('com.victronenergy.test.a', '/Value'), 5)
+		return m.servicesByName['com.victronenergy.test.a'].paths['/Value'].text, \
+			self.text_calls('com.victronenergy.test.a')
+
+	def test_blocking(self):
+		self.assertEqual(self.scan(valueOnly=True), (None, 0))
+
+	def test_async(self):
+		self.assertEqual(self.scan(asyncScan=True, valueOnly=True), (None, 0))
+
+	def test_with_text(self):
+		text, calls = self.scan(asyncScan=True)
+		self.assertEqual(text, '5')
+		self.assertGreater(calls, 0)
+
+class ScopedSignalsTests(FixtureTests):
+	# The match rules the dbus-daemon has for the connection of the monitor, per service. dbus-python
+	# adds a NameOwnerChanged rule for the sender of each match, so two for one match.
+	def match_rules(self, m):
+		stats = self.dbusConn.call_blocking('org.freedesktop.DBus', '/org/freedesktop/DBus',
+			'org.freedesktop.DBus.Debug.Stats', 'GetConnectionStats', 's', [m.dbusConn.get_unique_name()])
+		return int(stats['MatchRules']) / 2
+
+	def one_match_per_service(self, **kwargs):
+		a = self.start('com.victronenergy.test.a')
+		self.start('com.victronenergy.test.b')
+		self.start('com.victronenergy.other.c')
+		m = self.monitor(scopedSignals=True, **kwargs)
+		self.assertEqual(set(m.serviceMatches), {'com.victronenergy.test.a', 'com.victronenergy.test.b'})
+		self.assertEqual(self.match_rules(m), 2)
+
+		self.set_value(a, '/Value', 42)
+		self.assertTrue(self.run_until(lambda: self.changes))
+		self.assertEqual(self.changes, [('com.victronenergy.test.a', '/Value', 42)])
+
+	def test_one_match_per_service(self):
+		self.one_match_per_service()
+
+	def test_one_match_per_service_async(self):
+		self.one_match_per_service(asyncScan=True)
+
+	def test_service_lost(self):
+		a = self.start('com.victronenergy.test.a')
+		b = self.start('com.victronenergy.test.b')
+		m = self.monitor(asyncScan=True, scopedSignals=True)
+		self.assertEqual(self.match_rules(m), 2)
+
+		a.kill()
+		self.assertTrue(self.run_until(lambda: 'com.victronenergy.test.a' not in m.get_service_list()))
+		self.assertEqual(set(m.serviceMatches), {'com.victronenergy.test.b'})
+		self.assertEqual(self.match_rules(m), 1)
+
+		# Subscribed again for the new owner
+		a = self.start('com.victronenergy.test.a', '--value', '3')
+		self.assertTrue(self.run_until(lambda: 'com.victronenergy.test.a' in m.get_service_list()))
+		self.assertEqual(self.match_rules(m), 2)
+		self.set_value(a, '/Value', 4)
+		self.set_value(b, '/Value', 5)
+		self.assertTrue(self.run_until(lambda: len(self.changes) == 2))
+		self.assertEqual(sorted(self.changes), [
+			('com.victronenergy.test.a', '/Value', 4), ('com.victronenergy.test.b', '/Value', 5)])
+
+class SnapshotTests(FixtureTests):
+	def setUp(self):
+		super(SnapshotTests, self).setUp()
+		self.tmp = tempfile.mkdtemp()
+		self.snapshot = os.path.join(self.tmp, 'snapshot.json')
+
+	def tearDown(self):
+		super(SnapshotTests, self).tearDown()
+		shutil.rmtree(self.tmp)
+
+	def write(self, content):
+		with open(self.snapshot, 'w') as f:
+			f.write(content)
+
+	def saved(self):
+		m = self.monitor(asyncScan=True, snapshotFile=self.snapshot)
+		m.save_snapshot()
+		retire(m)
+		with open(self.snapshot) as f:
+			return json.load(f)
+
+	def test_verified(self):
+		a = self.start('com.victronenergy.test.a', '--instance', '3', '--value', '5')
+		snapshot = self.saved()
+		self.assertEqual(snapshot['services']['com.victronenergy.test.a']['values'], {'/Value': [5, '5']})
+
+		# Taken from the snapshot, the value that changed meanwhile is caught up with
+		self.set_value(a, '/Value', 6)
+		self.assertTrue(self.run_until(lambda: self.dbusConn.call_blocking(
+			'com.victronenergy.test.a', '/Value', None, 'GetValue', '', []) == 6))
+		m = self.monitor(asyncScan=True, snapshotFile=self.snapshot)
+		self.assertEqual(m.get_service_list(), {'com.victronenergy.test.a': 3})
+		self.assertEqual(m.get_value('com.victronenergy.test.a', '/Value'), 5)
+		self.assertTrue(self.run_until(lambda: not m._unverified))
+		self.assertTrue(self.run_until(lambda: self.changes))
+		self.assertEqual(self.changes, [('com.victronenergy.test.a', '/Value', 6)])
+		self.assertEqual((self.added, self.removed), ([], []))
+
+	def test_gone(self):
+		a = self.start('com.victronenergy.test.a', '--instance', '3')
+		self.saved()
+		a.kill()
+		self.assertTrue(self.run_until(lambda: not self.dbusConn.name_has_owner('com.victronenergy.test.a')))
+
+		m = self.monitor(asyncScan=True, snapshotFile=self.snapshot)
+		self.assertEqual(m.get_service_list(), {'com.victronenergy.test.a': 3})
+		self.assertTrue(self.run_until(lambda: not m.get_service_list()))
+		self.assertEqual(self.removed, [('com.victronenergy.test.a', 3)])
+
+	def test_new_owner(self):
+		# Restarted since the snapshot: the stale service is removed, the new one added
+		a = self.start('com.victronenergy.test.a', '--instance', '3', '--value', '5')
+		self.saved()
+		a.kill()
+		self.assertTrue(self.run_until(lambda: not self.dbusConn.name_has_owner('com.victronenergy.test.a')))
+		self.start('com.victronenergy.test.a', '--instance', '4', '--value', '7')
+
+		m = self.monitor(asyncScan=True, snapshotFile=self.snapshot)
+		self.assertTrue(self.run_until(lambda: self.added))
+		self.assertEqual(self.removed, [('com.victronenergy.test.a', 3)])
+		self.assertEqual(self.added, [('com.victronenergy.test.a', 4)])
+		self.assertEqual(m.get_value('com.victronenergy.test.a', '/Value'), 7)
+		self.assertEqual(m.servicesByName['com.victronenergy.test.a'].id,
+			self.dbusConn.get_name_owner('com.victronenergy.test.a'))
+
+	def test_corrupt(self):
+		self.start('com.victronenergy.test.a', '--value', '5')
+		self.write('{"services": {"com.victronenergy.test.a": ')
+		m = self.monitor(asyncScan=True, snapshotFile=self.snapshot)
+
+		# Scanned from the bus instead, and the snapshot is removed
+		self.assertFalse(os.path.exists(self.snapshot))
+		self.assertEqual(m.get_value('com.victronenergy.test.a', '/Value'), 5)
+		self.assertEqual(m._unverified, set())
+
+	def test_malformed(self):
+		self.start('com.victronenergy.test.a', '--value', '5')
+		self.write(json.dumps({'services': {
+			'com.victronenergy.test.b': {'id': ':1.1', 'deviceInstance': 0, 'values': {'/Value': [3, '3']}},
+			'com.victronenergy.test.a': {'id': ':1.2', 'values': {}},
+			}}))
+		m = self.monitor(asyncScan=True, snapshotFile=self.snapshot)
+
+		# Dropped as a whole, the valid service in it too
+		self.assertFalse(os.path.exists(self.snapshot))
+		self.assertEqual(m.get_service_list(), {'com.victronenergy.test.a': 0})
+		self.assertEqual(m.get_value('com.victronenergy.test.a', '/Value'), 5)
+
+if __name__ == "__main__":
+	unittest.main()
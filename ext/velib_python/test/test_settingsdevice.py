@@ -16,7 +16,11 @@ from dbus.mainloop.glib import DBusGMainLoop
 
 # Local
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
+import settingsdevice
+import ve_utils
 from settingsdevice import SettingsDevice
+from mock_settings_device import MockSettingsDevice
+import mock_gobject
 
 logger = logging.getLogger(__file__)
 
@@ -57,6 +61,390 @@ class CreateSettingsTest(unittest.TestCase):
 	def handle_changed_setting(setting, oldvalue, newvalue):
 		pass
 
+class FakeMatch(object):
+	def __init__(self, receivers, handler, signal_name, path, path_keyword):
+		self._receivers = receivers
+		self.handler = handler
+		self.signal_name = signal_name
+		self.path = path
+		self.path_keyword = path_keyword
+
+	def remove(self):
+		self._receivers.remove(self)
+
+class FakeSettingsObject(object):
+	# The part of a localsettings object that VeDbusItemImport and addSetting use
+	def __init__(self, bus, path):
+		self._bus = bus
+		self._path = path
+
+	def connect_to_signal(self, signal_name, handler):
+		return self._bus.add_signal_receiver(handler, signal_name=signal_name, path=self._path)
+
+	def GetValue(self):
+		return self._bus.call_blocking(None, self._path, None, 'GetValue', '', [])
+
+	def GetAttributes(self):
+		return self._bus.call_blocking(None, self._path, None, 'GetAttributes', '', [])
+
+	def AddSetting(self, group, path, value, itemtype, _min, _max):
+		self._bus.add('/Settings/' + path, value, _min, _max, False)
+
+	def AddSilentSetting(self, group, path, value, itemtype, _min, _max):
+		self._bus.add('/Settings/' + path, value, _min, _max, True)
+
+	def SetValue(self, value):
+		return self._bus.call_blocking(None, self._path, None, 'SetValue', 'v', [value])
+
+class FakeSettingsBus(object):
+	# A bus with a fake localsettings on it. settings maps the paths to [value, default, min, max, silent].
+	# Without bulk, GetItems and AddSettings fail with error, like older localsettings. Without
+	# attributes, GetItems leaves out Default, Min, Max and Silent.
+	# Paths in addErrors are refused by AddSettings.
+	def __init__(self, settings=None, bulk=True, attributes=True, error='org.freedesktop.DBus.Error.UnknownMethod',
+			addErrors=()):
+		self.settings = dict(settings or {})
+		self.bulk = bulk
+		self.attributes = attributes
+		self.error = error
+		self.addErrors = addErrors
+		self.owned = True
+		self.receivers = []
+		self.calls = []
+
+	def list_names(self):
+		return ['com.victronenergy.settings'] if self.owned else []
+
+	def add_signal_receiver(self, handler, signal_name=None, path=None, path_keyword=None, **kwargs):
+		match = FakeMatch(self.receivers, handler, signal_name, path, path_keyword)
+		self.receivers.append(match)
+		return match
+
+	def emit(self, signal_name, path, *args):
+		for match in list(self.receivers):
+			if match.signal_name == signal_name and match.path in (None, path):
+				if match.path_keyword is None:
+					match.handler(*args)
+				else:
+					match.handler(*args, **{match.path_keyword: path})
+
+	def get_object(self, name, path, introspect=True):
+		return FakeSettingsObject(self, path)
+
+	def call_async(self, name, path, interface, method, signature, args, reply_handler, error_handler):
+		# NameHasOwner, the only method called asynchronously
+		reply_handler(self.owned)
+
+	def call_blocking(self, name, path, interface, method, signature, args):
+		self.calls.append(method)
+		if method in ('GetItems', 'AddSettings') and not self.bulk:
+			raise dbus.exceptions.DBusException('No %s' % method, name=self.error)
+		if method == 'AddSettings':
+			assert signature == 'aa{sv}'
+		return getattr(self, method)(path, *args)
+
+	def add(self, path, value, _min, _max, silent):
+		self.settings[path] = [value, value, _min, _max, silent]
+
+	def GetItems(self, path):
+		items = {}
+		for p, (value, default, _min, _max, silent) in self.settings.items():
+			items[p] = {'Value': value, 'Text': str(value)}
+			if self.attributes:
+				items[p].update(Default=default, Min=_min, Max=_max, Silent=silent)
+		return items
+
+	# As in localsettings: a method of /Settings, in and out signature aa{sv}. Each setting has
+	# its path below /Settings and the default, optionally the type, min, max and silent. The
+	# reply has a dict for each setting with its path and an error, 0 when it was added.
+	def AddSettings(self, path, settings):
+		assert path == '/Settings'
+		results = []
+		for s in settings:
+			assert set(s) <= {'path', 'default', 'type', 'min', 'max', 'silent'}
+			error = 1 if '/Settings/' + s['path'] in self.addErrors else 0
+			if error == 0:
+				self.add('/Settings/' + s['path'], s['default'], s.get('min', 0), s.get('max', 0),
+					s.get('silent', False))
+			results.append(dbus.Dictionary({'path': dbus.String(s['path']), 'error': dbus.Int32(error)},
+				signature='sv'))
+		return dbus.Array(results, signature='a{sv}')
+
+	def GetAttributes(self, path):
+		value, default, _min, _max, silent = self.settings[path]
+		return (default, _min, _max, silent)
+
+	def GetValue(self, path):
+		if path not in self.settings:
+			raise dbus.exceptions.DBusException('No %s' % path, name='org.freedesktop.DBus.Error.UnknownObject')
+		return self.settings[path][0]
+
+	def SetValue(self, path, value):
+		# localsettings signals a change on the path as well as on the root
+		self.settings[path][0] = value
+		changes = {'Value': value, 'Text': str(value)}
+		self.emit('PropertiesChanged', path, changes)
+		self.emit('ItemsChanged', '/', {path: changes})
+		return 0
+
+class BulkSettingsTest(unittest.TestCase):
+	supported = {
+		'a': ['/Settings/Test/A', 1, 0, 10],
+		'b': ['/Settings/Test/B', 'x', 0, 0],
+		'c': ['/Settings/Test/C', 2.5, 0, 5, True]}
+
+	def setUp(self):
+		self.changes = []
+
+	def handle_changed_setting(self, setting, oldvalue, newvalue):
+		self.changes.append((setting, oldvalue, newvalue))
+
+	def create(self, bus):
+		return SettingsDevice(bus, self.supported, self.handle_changed_setting, bulk=True)
+
+	def existing(self):
+		return {
+			'/Settings/Test/A': [5, 1, 0, 10, False],
+			'/Settings/Test/B': ['y', 'x', 0, 0, False],
+			'/Settings/Test/C': [3.5, 2.5, 0, 5, True]}
+
+	def test_settings_exist(self):
+		bus = FakeSettingsBus(self.existing())
+		settings = self.create(bus)
+		self.assertEqual(['GetItems'], bus.calls)
+		self.assertEqual((5, 'y', 3.5), (settings['a'], settings['b'], settings['c']))
+
+	def test_settings_missing_or_changed(self):
+		existing = self.existing()
+		del existing['/Settings/Test/B']
+		existing['/Settings/Test/C'][4] = False
+		bus = FakeSettingsBus(existing)
+		settings = self.create(bus)
+
+		self.assertEqual(['GetItems', 'AddSettings', 'GetItems'], bus.calls)
+		self.assertEqual(['x', 'x', 0, 0, False], bus.settings['/Settings/Test/B'])
+		self.assertEqual(True, bus.settings['/Settings/Test/C'][4])
+		self.assertEqual((5, 'x'), (settings['a'], settings['b']))
+
+	def test_attributes_not_in_get_items(self):
+		existing = self.existing()
+		existing['/Settings/Test/A'][3] = 20
+		bus = FakeSettingsBus(existing, attributes=False)
+		settings = self.create(bus)
+
+		# Asked one by one, only A is added again with the new maximum
+		self.assertEqual(['GetItems', 'GetAttributes', 'GetAttributes', 'GetAttributes',
+			'AddSettings', 'GetItems'], bus.calls)
+		self.assertEqual(10, bus.settings['/Settings/Test/A'][3])
+		self.assertEqual('y', settings['b'])
+
+	def fallback(self, error):
+		bus = FakeSettingsBus(self.existing(), bulk=False, error=error)
+		settings = self.create(bus)
+
+		self.assertFalse(settings._bulk)
+		self.assertEqual([], [m for m in bus.receivers
+			if m.handler in (settings._itemsChanged, settings._propertiesChanged)])
+		self.assertEqual((5, 'y', 3.5), (settings['a'], settings['b'], settings['c']))
+
+	def test_fallback_unknown_method(self):
+		self.fallback('org.freedesktop.DBus.Error.UnknownMethod')
+
+	def test_fallback_unknown_object(self):
+		self.fallback('org.freedesktop.DBus.Error.UnknownObject')
+
+	def test_other_errors_are_raised(self):
+		bus = FakeSettingsBus(self.existing(), bulk=False, error='org.freedesktop.DBus.Error.NoReply')
+		with self.assertRaises(dbus.exceptions.DBusException):
+			self.create(bus)
+
+	def test_change_signalled_once(self):
+		bus = FakeSettingsBus(self.existing())
+		settings = self.create(bus)
+
+		# Both PropertiesChanged and ItemsChanged come in for this change
+		bus.SetValue('/Settings/Test/A', 7)
+		self.assertEqual([('a', 5, 7)], self.changes)
+		self.assertEqual(7, settings['a'])
+
+		bus.SetValue('/Settings/Test/A', 7)
+		self.assertEqual([('a', 5, 7)], self.changes)
+
+	def test_set_item(self):
+		bus = FakeSettingsBus(self.existing())
+		settings = self.create(bus)
+		del bus.calls[:]
+
+		settings['b'] = 'z'
+		self.assertEqual(['SetValue'], bus.calls)
+		self.assertEqual('z', bus.settings['/Settings/Test/B'][0])
+		self.assertEqual('z', settings['b'])
+		self.assertEqual([('b', 'y', 'z')], self.changes)
+
+	def test_add_error(self):
+		existing = self.existing()
+		del existing['/Settings/Test/B']
+		bus = FakeSettingsBus(existing, addErrors=('/Settings/Test/B',))
+		settings = self.create(bus)
+		self.assertNotIn('/Settings/Test/B', bus.settings)
+		self.assertIsNone(settings['b'])
+		self.assertEqual(5, settings['a'])
+
+	def test_fallback_after_bulk(self):
+		# Settings added in bulk before are still there when a later call falls back
+		bus = FakeSettingsBus(self.existing())
+		settings = self.create(bus)
+		bus.bulk = False
+		settings.addSettings({'d': ['/Settings/Test/D', 4, 0, 10]})
+
+		self.assertFalse(settings._bulk)
+		self.assertEqual((5, 'y', 3.5, 4), (settings['a'], settings['b'], settings['c'], settings['d']))
+		settings['a'] = 6
+		self.assertEqual(6, bus.settings['/Settings/Test/A'][0])
+		self.assertEqual(6, settings['a'])
+		self.assertEqual([('a', 5, 6)], self.changes)
+
+class AsyncSettingsTest(unittest.TestCase):
+	# The asynchronous constructor, with the timers of mock_gobject
+	supported = {'a': ['/Settings/Test/A', 1, 0, 10]}
+
+	def setUp(self):
+		self.ready = []
+		self.errors = []
+		self.exits = []
+		mock_gobject.timer_manager.reset()
+		self._glib, settingsdevice.GLib = settingsdevice.GLib, mock_gobject
+		self._os_exit, settingsdevice.os_exit = settingsdevice.os_exit, self.exits.append
+		self._utils_exit, ve_utils.os_exit = ve_utils.os_exit, self.exits.append
+
+	def tearDown(self):
+		settingsdevice.GLib = self._glib
+		settingsdevice.os_exit = self._os_exit
+		ve_utils.os_exit = self._utils_exit
+
+	def create(self, bus, timeout=10, errorCallback=True):
+		return SettingsDevice(bus, self.supported, None, timeout=timeout, bulk=True,
+			readyCallback=self.ready.append, errorCallback=self.errors.append if errorCallback else None)
+
+	def appear(self, bus):
+		bus.owned = True
+		bus.emit('NameOwnerChanged', None, 'com.victronenergy.settings', '', ':1.10')
+
+	def waiting(self, bus):
+		return [m for m in bus.receivers if m.signal_name == 'NameOwnerChanged']
+
+	def test_already_owned(self):
+		bus = FakeSettingsBus({'/Settings/Test/A': [5, 1, 0, 10, False]})
+		settings = self.create(bus)
+		self.assertEqual([settings], self.ready)
+		self.assertEqual(5, settings['a'])
+		self.assertEqual([], self.waiting(bus))
+
+		mock_gobject.timer_manager.run(20000)
+		self.assertEqual([], self.errors)
+
+	def test_appears_later(self):
+		bus = FakeSettingsBus()
+		bus.owned = False
+		settings = self.create(bus)
+		mock_gobject.timer_manager.run(5000)
+		self.assertEqual([], self.ready)
+
+		self.appear(bus)
+		self.assertEqual([settings], self.ready)
+		self.assertEqual(1, settings['a'])
+		self.assertEqual([], self.waiting(bus))
+
+		# The timeout is off
+		mock_gobject.timer_manager.run(20000)
+		self.assertEqual([], self.errors)
+
+	def test_times_out(self):
+		bus = FakeSettingsBus()
+		bus.owned = False
+		self.create(bus)
+		mock_gobject.timer_manager.run(9000)
+		self.assertEqual([], self.errors)
+
+		mock_gobject.timer_manager.run(2000)
+		self.assertEqual(1, len(self.errors))
+		self.assertEqual([], self.waiting(bus))
+
+		self.appear(bus)
+		self.assertEqual([], self.ready)
+		self.assertEqual(1, len(self.errors))
+
+	def test_timeout_zero_fails_at_once(self):
+		bus = FakeSettingsBus()
+		bus.owned = False
+		self.create(bus, timeout=0)
+		self.assertEqual(1, len(self.errors))
+		self.assertEqual([], self.waiting(bus))
+
+	def test_timeout_none_waits_forever(self):
+		bus = FakeSettingsBus()
+		bus.owned = False
+		settings = self.create(bus, timeout=None)
+		mock_gobject.timer_manager.run(3600 * 1000)
+		self.assertEqual([], self.errors)
+
+		self.appear(bus)
+		self.assertEqual([settings], self.ready)
+
+	def test_add_settings_fails(self):
+		bus = FakeSettingsBus()
+		def getitems(path):
+			raise KeyError(path)
+		bus.GetItems = getitems
+		self.create(bus)
+		self.assertEqual([], self.ready)
+		self.assertEqual(1, len(self.errors))
+		self.assertIsInstance(self.errors[0], KeyError)
+
+	def test_exits_without_error_callback(self):
+		bus = FakeSettingsBus()
+		bus.owned = False
+		self.create(bus, errorCallback=False)
+		mock_gobject.timer_manager.run(11000)
+		self.assertEqual([1], self.exits)
+		self.assertEqual([], self.ready)
+
+	def test_ready_callback_raises(self):
+		# Called from a D-Bus signal handler, the exception ends the process
+		def ready(settings):
+			raise ValueError()
+		bus = FakeSettingsBus()
+		bus.owned = False
+		SettingsDevice(bus, self.supported, None, timeout=10, readyCallback=ready)
+		self.appear(bus)
+		self.assertEqual([1], self.exits)
+
+	def test_error_callback_raises(self):
+		# Called from the timer
+		def error(e):
+			raise ValueError()
+		bus = FakeSettingsBus()
+		bus.owned = False
+		SettingsDevice(bus, self.supported, None, timeout=10, readyCallback=self.ready.append,
+			errorCallback=error)
+		mock_gobject.timer_manager.run(11000)
+		self.assertEqual([1], self.exits)
+
+class MockSettingsDeviceTest(unittest.TestCase):
+	def setUp(self):
+		mock_gobject.timer_manager.reset()
+
+	def test_ready_deferred(self):
+		ready = []
+		settings = MockSettingsDevice({'a': ['/Settings/Test/A', 1, 0, 10]}, None,
+			readyCallback=ready.append)
+		self.assertEqual([], ready)
+
+		mock_gobject.timer_manager.run(1000)
+		self.assertEqual([settings], ready)
+		self.assertEqual(1, settings['a'])
+		self.assertEqual([], mock_gobject.timer_manager._resources)
+
 if __name__ == "__main__":
 	logging.basicConfig(stream=sys.stderr)
 	logging.getLogger('').setLevel(logging.WARNING)
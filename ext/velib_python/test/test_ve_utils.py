@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Python
+import os
+import sys
+import unittest
+from collections import OrderedDict
+import dbus
+
+# Local
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
+from ve_utils import wrap_dbus_value, unwrap_dbus_value, VEDBUS_INVALID
+
+class MyInt(int):
+	pass
+
+class MyStr(str):
+	pass
+
+class MyList(list):
+	pass
+
+class WrapDbusValueTests(unittest.TestCase):
+	def wrapped(self, value, dbustype, expected):
+		v = wrap_dbus_value(value)
+		self.assertIs(type(v), dbustype)
+		self.assertEqual(v, expected)
+		self.assertEqual(v.variant_level, 1)
+		return v
+
+	def test_none(self):
+		self.assertIs(wrap_dbus_value(None), VEDBUS_INVALID)
+
+	def test_float(self):
+		self.wrapped(1.5, dbus.Double, 1.5)
+
+	def test_bool(self):
+		# bool is an int as well, it must not end up as Int32
+		self.wrapped(True, dbus.Boolean, True)
+		self.wrapped(False, dbus.Boolean, False)
+
+	def test_int(self):
+		self.wrapped(40000, dbus.Int32, 40000)
+		self.wrapped(-10, dbus.Int32, -10)
+
+	def test_int_overflow(self):
+		self.wrapped(2**31, dbus.Int64, 2**31)
+		self.wrapped(-2**31 - 1, dbus.Int64, -2**31 - 1)
+
+		# The handler is kept per type, the overflow is still per value
+		self.wrapped(1, dbus.Int32, 1)
+
+	def test_str(self):
+		self.wrapped('a string', dbus.String, 'a string')
+
+	def test_empty_list(self):
+		v = self.wrapped([], dbus.Array, [])
+		self.assertEqual(v.signature, 'u')
+		self.assertNotEqual(v.signature, VEDBUS_INVALID.signature)
+
+	def test_list(self):
+		v = self.wrapped([1, 'a', 2**40], dbus.Array, [1, 'a', 2**40])
+		self.assertEqual([dbus.Int32, dbus.String, dbus.Int64], [type(x) for x in v])
+
+	def test_dict(self):
+		v = self.wrapped({'a': 1, 'b': 2.5}, dbus.Dictionary, {'a': 1, 'b': 2.5})
+		self.assertIs(type(v['a']), dbus.Int32)
+		self.assertIs(type(v['b']), dbus.Double)
+
+		# The keys are not wrapped
+		self.assertIs(type(list(v.keys())[0]), str)
+
+	def test_subclasses(self):
+		self.wrapped(MyInt(3), dbus.Int32, 3)
+		self.wrapped(MyStr('b'), dbus.String, 'b')
+		self.wrapped(MyList(), dbus.Array, [])
+		self.wrapped(OrderedDict(a=1), dbus.Dictionary, {'a': 1})
+
+	def test_other(self):
+		# Anything else is passed on as it is
+		v = (1, 2)
+		self.assertIs(wrap_dbus_value(v), v)
+
+class UnwrapDbusValueTests(unittest.TestCase):
+	def unwrapped(self, value, pytype, expected):
+		v = unwrap_dbus_value(value)
+		self.assertIs(type(v), pytype)
+		self.assertEqual(v, expected)
+		return v
+
+	def test_ints(self):
+		for t in (dbus.Byte, dbus.Int16, dbus.UInt16, dbus.Int32, dbus.UInt32, dbus.Int64, dbus.UInt64):
+			self.unwrapped(t(84), int, 84)
+		self.unwrapped(dbus.Int64(2**40), int, 2**40)
+
+	def test_double(self):
+		self.unwrapped(dbus.Double(1.5), float, 1.5)
+
+	def test_bool(self):
+		self.unwrapped(dbus.Boolean(True), bool, True)
+		self.unwrapped(dbus.Boolean(False), bool, False)
+
+	def test_string(self):
+		self.unwrapped(dbus.String('a string'), str, 'a string')
+
+	def test_invalid(self):
+		self.assertIsNone(unwrap_dbus_value(VEDBUS_INVALID))
+		self.assertIsNone(unwrap_dbus_value(dbus.Array([], signature=dbus.Signature('u'))))
+
+	def test_array(self):
+		v = self.unwrapped(dbus.Array([dbus.Int32(1), dbus.Double(2.5)]), list, [1, 2.5])
+		self.assertEqual([int, float], [type(x) for x in v])
+
+	def test_byte_array(self):
+		self.unwrapped(dbus.ByteArray(b''), str, '')
+
+	def test_struct(self):
+		self.unwrapped(dbus.Struct((dbus.Int32(1), dbus.String('a'))), list, [1, 'a'])
+
+	def test_dict(self):
+		v = self.unwrapped(dbus.Dictionary({'a': dbus.Int32(1)}), dict, {'a': 1})
+		self.assertIs(type(v['a']), int)
+
+	def test_roundtrip(self):
+		for value in (True, 5, 2**40, 1.5, 'a', [1, 'a'], {'a': True}):
+			self.assertEqual(unwrap_dbus_value(wrap_dbus_value(value)), value)
+
+	def test_other(self):
+		v = object()
+		self.assertIs(unwrap_dbus_value(v), v)
+
+if __name__ == "__main__":
+	unittest.main()
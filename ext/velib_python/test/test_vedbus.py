@@ -15,7 +15,7 @@ from dbus.mainloop.glib import DBusGMainLoop
 
 # Local
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../'))
-from vedbus import VeDbusService, VeDbusItemImport
+from vedbus import VeDbusService, VeDbusItemImport, PathTrie, PublishPolicy
 
 logger = logging.getLogger(__file__)
 """
@@ -45,10 +45,8 @@ class VeDbusServiceTests(unittest.TestCase):
 """
 
 
-class VeDbusItemExportTests(unittest.TestCase):
-	# The actual code calling VeDbusItemExport is in fixture_vedbus.py, which is ran as a subprocess. That
-	# code exports several values to the dbus. And then below test cases check if the exported values are
-	# what the should be, by using the bare dbus import objects and functions.
+class FixtureTests(unittest.TestCase):
+	# Runs fixture_vedbus.py as a subprocess for each test
 
 	def setUp(self):
 		self.sp = subprocess.Popen([sys.executable, "fixture_vedbus.py"], stdout=subprocess.PIPE)
@@ -64,6 +62,24 @@ class VeDbusItemExportTests(unittest.TestCase):
 		self.sp.wait()
 		self.sp.stdout.close()
 
+	# Returns what dbus-monitor prints for the BusItem signals of sender while action runs
+	def signals(self, sender, action):
+		process = subprocess.Popen(['dbus-monitor', "type='signal',sender='%s',interface='com.victronenergy.BusItem'" % sender],
+			stdout=subprocess.PIPE)
+
+		# wait for dbus-monitor to start up, and for the signals to come in
+		time.sleep(0.5)
+		action()
+		time.sleep(0.5)
+
+		process.terminate()
+		return process.communicate()[0]
+
+class VeDbusItemExportTests(FixtureTests):
+	# The actual code calling VeDbusItemExport is in fixture_vedbus.py, which is ran as a subprocess. That
+	# code exports several values to the dbus. And then below test cases check if the exported values are
+	# what the should be, by using the bare dbus import objects and functions.
+
 	def test_get_value_invalid(self):
 		v = self.dbusConn.get_object('com.victronenergy.dbusexample', '/Invalid').GetValue()
 		self.assertEqual(v, dbus.Array([], signature=dbus.Signature('i'), variant_level=1))
@@ -94,6 +110,12 @@ class VeDbusItemExportTests(unittest.TestCase):
 		self.assertIs(type(v), dbus.Double)
 		self.assertEqual(self.dbusConn.get_object('com.victronenergy.dbusexample', '/Float').GetText(), '1.5')
 
+	def test_get_value_typed(self):
+		v = self.dbusConn.get_object('com.victronenergy.dbusexample', '/Typed').GetValue()
+		self.assertEqual(v, 5.0)
+		self.assertIs(type(v), dbus.Double)
+		self.assertEqual(self.dbusConn.get_object('com.victronenergy.dbusexample', '/Typed').GetText(), '5')
+
 	def test_get_text_byte(self):
 		v = self.dbusConn.get_object('com.victronenergy.dbusexample', '/Byte').GetText()
 		self.assertEqual('84', v)
@@ -102,6 +124,28 @@ class VeDbusItemExportTests(unittest.TestCase):
 		v = self.dbusConn.get_object('com.victronenergy.dbusexample', '/Byte').GetValue()
 		self.assertEqual(84, v)
 
+	def test_get_value_bool(self):
+		v = self.dbusConn.get_object('com.victronenergy.dbusexample', '/Bool').GetValue()
+		self.assertEqual(v, True)
+		self.assertIs(type(v), dbus.Boolean)
+
+	def test_get_value_int64(self):
+		v = self.dbusConn.get_object('com.victronenergy.dbusexample', '/Int64').GetValue()
+		self.assertEqual(v, 2**40)
+		self.assertIs(type(v), dbus.Int64)
+
+	def test_get_value_empty_list(self):
+		# Not the signature of an invalid value
+		v = self.dbusConn.get_object('com.victronenergy.dbusexample', '/EmptyList').GetValue()
+		self.assertEqual(v, dbus.Array([], signature=dbus.Signature('u'), variant_level=1))
+		self.assertEqual(v.signature, 'u')
+
+	def test_get_value_dict(self):
+		v = self.dbusConn.get_object('com.victronenergy.dbusexample', '/Dict').GetValue()
+		self.assertEqual(v, {'a': 1, 'b': 'c'})
+		self.assertIs(type(v), dbus.Dictionary)
+		self.assertIs(type(v['a']), dbus.Int32)
+
 	def test_set_value(self):
 		self.assertNotEqual(0, self.dbusConn.get_object('com.victronenergy.dbusexample', '/NotWriteable').SetValue(12))
 		self.assertEqual('original', self.dbusConn.get_object('com.victronenergy.dbusexample', '/NotWriteable').GetValue())
@@ -162,6 +206,151 @@ class VeDbusItemExportTests(unittest.TestCase):
 
 		thread.join()
 
+class VeDbusServiceTests(FixtureTests):
+	# Tests VeDbusService the same way, against the service exported by fixture_vedbus.py.
+
+	service = 'com.victronenergy.dbusexample.service'
+
+	def get_object(self, path):
+		return self.dbusConn.get_object(self.service, path)
+
+	def test_autobatch(self):
+		t = self.signals(self.service, lambda: self.get_object('/Batch/Set').SetValue(7))
+
+		# The three paths set by the onchangecallback go out as a single ItemsChanged on the root
+		self.assertEqual(1, t.count(b"member=ItemsChanged"))
+		for p in (b"/Batch/A", b"/Batch/B", b"/Batch/C"):
+			self.assertNotEqual(-1, t.find(b"string \"" + p + b"\""))
+			self.assertEqual(7, self.get_object(p.decode()).GetValue())
+
+	def test_get_value_node(self):
+		self.assertEqual({'A/X': 1, 'A/Y': 2, 'B/Z': 3}, self.get_object('/Tree').GetValue())
+		self.assertEqual({'X': 1, 'Y': 2}, self.get_object('/Tree/A').GetValue())
+		self.assertEqual({'X': '1', 'Y': '2'}, self.get_object('/Tree/A').GetText())
+
+		v = self.get_object('/').GetValue()
+		self.assertEqual(1, v['Tree/A/X'])
+		self.assertEqual(4, v['TreeSibling'])
+
+	def test_remove_paths(self):
+		self.assertEqual(0, self.get_object('/Control/RemovePaths').SetValue('/Tree/A'))
+		self.assertEqual({'B/Z': 3}, self.get_object('/Tree').GetValue())
+		self.assertNotIn('Tree/A/X', self.get_object('/').GetValue())
+		self.assertEqual(4, self.get_object('/TreeSibling').GetValue())
+
+		# The node in between is gone with the paths below it
+		for path in ('/Tree/A', '/Tree/A/X'):
+			with self.assertRaises(dbus.exceptions.DBusException):
+				self.get_object(path).GetValue()
+
+	def test_get_items(self):
+		items = self.get_object('/').GetItems()
+		self.assertEqual({'Value': 1, 'Text': '1'}, items['/Tree/A/X'])
+		self.assertEqual({'Value': 0, 'Text': '0'}, items['/Batch/A'])
+
+		# The reply is built once, and then kept up to date on add, change and remove
+		self.get_object('/Control/AddPath').SetValue('/Added')
+		self.get_object('/Batch/Set').SetValue(7)
+		self.get_object('/Control/RemovePaths').SetValue('/Tree/A')
+
+		items = self.get_object('/').GetItems()
+		self.assertEqual({'Value': 5, 'Text': '5'}, items['/Added'])
+		self.assertEqual({'Value': 7, 'Text': '7'}, items['/Batch/A'])
+		self.assertEqual({'Value': 7, 'Text': '7'}, items['/Batch/Set'])
+		self.assertNotIn('/Tree/A/X', items)
+		self.assertNotIn('/Tree/A/Y', items)
+		self.assertEqual({'Value': 3, 'Text': '3'}, items['/Tree/B/Z'])
+
+	def test_publish_policy(self):
+		o = self.get_object('/Policy')
+		t = self.signals(self.service, lambda: o.SetValue(105))
+		self.assertEqual(-1, t.find(b"member=PropertiesChanged"))
+		self.assertEqual(105, o.GetValue())
+
+		t = self.signals(self.service, lambda: o.SetValue(115))
+		self.assertEqual(1, t.count(b"member=PropertiesChanged"))
+
+	def test_text_not_in_signals(self):
+		o = self.get_object('/Lazy')
+		self.assertEqual('gettexted /Lazy 1', o.GetText())
+		self.assertEqual('gettexted /Lazy 1', self.get_object('/').GetItems()['/Lazy']['Text'])
+
+		t = self.signals(self.service, lambda: o.SetValue(7))
+		self.assertEqual(1, t.count(b"member=PropertiesChanged"))
+		self.assertNotEqual(-1, t.find(b"path=/Lazy;"))
+		self.assertEqual(-1, t.find(b"string \"Text\""))
+
+		# The text cached before the change is not handed out anymore
+		self.assertEqual('gettexted /Lazy 7', o.GetText())
+		self.assertEqual({'Value': 7, 'Text': 'gettexted /Lazy 7'}, self.get_object('/').GetItems()['/Lazy'])
+
+class PublishPolicyTests(unittest.TestCase):
+	def test_first_change(self):
+		# The initial value counts as signalled when the item is created
+		self.assertEqual((True, None), PublishPolicy(absdelta=10).hold(100, 105, 0))
+		self.assertEqual((True, 1.0), PublishPolicy(maxrate=1).hold(100, 105, 0))
+
+	def test_maxrate(self):
+		policy = PublishPolicy(maxrate=4)
+		self.assertEqual((True, 0.25), policy.hold(1, 2, 0.1))
+		self.assertEqual((False, None), policy.hold(1, 2, 0.25))
+
+	def test_absdelta(self):
+		policy = PublishPolicy(absdelta=10)
+		self.assertEqual((True, None), policy.hold(100, 109, 5))
+		self.assertEqual((True, None), policy.hold(100, 91, 5))
+		self.assertEqual((False, None), policy.hold(100, 110, 5))
+
+	def test_reldelta(self):
+		policy = PublishPolicy(absdelta=1, reldelta=0.1)
+		self.assertEqual((True, None), policy.hold(100, 109, 5))
+		self.assertEqual((False, None), policy.hold(100, 110, 5))
+		self.assertEqual((True, None), policy.hold(-5, -5.5, 5))
+
+	def test_refresh(self):
+		policy = PublishPolicy(absdelta=10, refresh=60)
+		self.assertEqual((True, 60), policy.hold(100, 101, 5))
+		self.assertEqual((False, None), policy.hold(100, 101, 60))
+
+	def test_not_a_number(self):
+		policy = PublishPolicy(absdelta=10)
+		self.assertEqual((False, None), policy.hold(100, None, 5))
+		self.assertEqual((False, None), policy.hold('a', 'b', 5))
+
+class PathTrieTests(unittest.TestCase):
+	def setUp(self):
+		self.trie = PathTrie()
+		for path in ('/Ac/L1/P', '/Ac/L1/V', '/Ac/L2/P', '/Dc/V', '/Acx'):
+			self.trie.add(path, path)
+
+	def test_find(self):
+		self.assertEqual('/Ac/L1/P', self.trie.find('/Ac/L1/P').item)
+		self.assertIsNone(self.trie.find('/Ac').item)
+		self.assertIsNone(self.trie.find('/Ac/L3'))
+		self.assertIsNone(self.trie.find('/Nothing/Here'))
+		self.assertIs(self.trie, self.trie.find('/'))
+
+	def test_items(self):
+		self.assertEqual({'L1/P': '/Ac/L1/P', 'L1/V': '/Ac/L1/V', 'L2/P': '/Ac/L2/P'},
+			dict(self.trie.find('/Ac').items()))
+		self.assertEqual({'P': '/Ac/L1/P', 'V': '/Ac/L1/V'}, dict(self.trie.find('/Ac/L1').items()))
+		self.assertEqual(5, len(list(self.trie.items())))
+
+	def test_remove(self):
+		# Returns the paths above that have nothing below them anymore, deepest first
+		self.assertEqual(['/Ac/L2'], self.trie.remove('/Ac/L2/P'))
+		self.assertEqual([], self.trie.remove('/Ac/L1/P'))
+		self.assertEqual(['/Ac/L1', '/Ac'], self.trie.remove('/Ac/L1/V'))
+		self.assertIsNone(self.trie.find('/Ac'))
+		self.assertEqual('/Acx', self.trie.find('/Acx').item)
+
+	def test_remove_keeps_item_with_children(self):
+		self.trie.add('/Dc', '/Dc')
+		self.assertEqual([], self.trie.remove('/Dc/V'))
+		self.assertEqual('/Dc', self.trie.find('/Dc').item)
+		self.assertEqual([], self.trie.remove('/Dc'))
+		self.assertIsNone(self.trie.find('/Dc'))
+
 """
 MVA 2014-08-30: this test of VEDbusItemImport doesn't work, since there is no gobject-mainloop.
 Probably making some automated functional test, using bash and some scripts, will work much
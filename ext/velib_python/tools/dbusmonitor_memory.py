@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures the memory used per monitored path by the DbusMonitor Service and MonitoredValue
+# classes, compared to the classes with an instance dict they replaced.
+#
+# usage: dbusmonitor_memory.py [services] [paths per service]
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from dbusmonitor import Service, MonitoredValue
+
+# The classes as they were before __slots__
+class LegacyMonitoredValue(object):
+	def __init__(self, value, text, options):
+		super(LegacyMonitoredValue, self).__init__()
+		self.value = value
+		self.text = text
+		self.options = options
+
+class LegacyService(object):
+	def __init__(self, id, serviceName, deviceInstance):
+		super(LegacyService, self).__init__()
+		self.id = id
+		self.name = serviceName
+		self.paths = {}
+		self._seen = set()
+		self.deviceInstance = deviceInstance
+
+		self.configChange = []
+		self.onIntervalAlwaysAndOnEvent = []
+		self.onIntervalOnlyWhenChanged = []
+		self.onIntervalAlways = []
+		self.never = []
+
+	def __getitem__(self, key):
+		return self.__dict__[key]
+
+	def add_to_log(self, whenToLog, path):
+		self[whenToLog].append(path)
+
+	def set_seen(self, path):
+		self._seen.add(path)
+
+# Builds what a scan builds, the tree is allocated before measuring as it is shared
+def build(serviceClass, valueClass, tree, nservices):
+	services = []
+	for i in range(nservices):
+		service = serviceClass(':1.%d' % (100 + i), 'com.victronenergy.battery.tty%d' % i, i)
+		for path, options in tree.items():
+			service.paths[path] = valueClass(float(i), '%d V' % i, options)
+			service.set_seen(path)
+			if options['whenToLog']:
+				service.add_to_log(options['whenToLog'], path)
+		services.append(service)
+	return services
+
+def measure(serviceClass, valueClass, tree, nservices):
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	services = build(serviceClass, valueClass, tree, nservices)
+	used = tracemalloc.get_traced_memory()[0] - before
+	tracemalloc.stop()
+	del services
+	return used
+
+def main():
+	nservices = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	npaths = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+	tree = {}
+	for j in range(npaths):
+		tree['/Path/%d' % j] = {'code': 'P%d' % j,
+			'whenToLog': 'configChange' if j % 10 == 0 else None}
+
+	total = nservices * npaths
+	print("%d services, %d paths each" % (nservices, npaths))
+	results = []
+	for name, serviceClass, valueClass in (
+			('dict', LegacyService, LegacyMonitoredValue),
+			('__slots__', Service, MonitoredValue)):
+		used = measure(serviceClass, valueClass, tree, nservices)
+		results.append(used)
+		print("%-10s %9d bytes, %6.1f bytes per path" % (name, used, float(used) / total))
+	print("saved %.1f%%" % (100.0 * (results[0] - results[1]) / results[0]))
+
+if __name__ == "__main__":
+	main()
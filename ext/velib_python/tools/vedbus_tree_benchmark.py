@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Times GetValue on the root and on an intermediate node of a VeDbusService with 10, 100
+# and 1000 exported paths, as exported now (the flat dict for the root, the path trie for
+# the nodes below it) and with the scan over all exported objects it replaced. Calls the tree export directly, so only the lookup is measured, not D-Bus.
+#
+# Needs a bus to register the service on, for example: dbus-run-session ./vedbus_tree_benchmark.py
+
+import os
+import sys
+import timeit
+from dbus.mainloop.glib import DBusGMainLoop
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from vedbus import VeDbusService
+from ve_utils import wrap_dbus_value
+
+# _get_value_handler as it was, walking all exported objects
+def linear_get_value(service, path):
+	r = {}
+	px = path
+	if not px.endswith('/'):
+		px += '/'
+	for p, item in service._dbusobjects.items():
+		if p.startswith(px):
+			r[p[len(px):]] = wrap_dbus_value(item.local_get_value())
+	return r
+
+def main():
+	DBusGMainLoop(set_as_default=True)
+	repeat = 200
+
+	print("%6s %-8s %12s %12s" % ('paths', 'node', 'scan us', 'export us'))
+	for n in (10, 100, 1000):
+		service = VeDbusService('com.victronenergy.benchmark%d' % n)
+		# 10 groups, like /Stats/Inverter/..., and one small one that is queried
+		for i in range(n):
+			service.add_path('/Group%d/Sub%d/Value%d' % (i % 10, i % 3, i), i)
+		service.add_path('/Small/A', 1)
+		service.add_path('/Small/B', 2)
+
+		for node in ('/', '/Small'):
+			export = service._dbusnodes[node]
+			assert linear_get_value(service, node) == export._get_value_handler(node)
+			scan = timeit.timeit(lambda: linear_get_value(service, node), number=repeat)
+			exported = timeit.timeit(lambda: export._get_value_handler(node), number=repeat)
+			print("%6d %-8s %12.1f %12.1f" % (n, node, scan * 1e6 / repeat, exported * 1e6 / repeat))
+		service.__del__()
+
+if __name__ == "__main__":
+	main()
@@ -203,62 +203,131 @@ def read_file(path):
 	return content
 
 
+# wrap_dbus_value and unwrap_dbus_value run for every value sent and received. Instead of
+# going through their chain of isinstance checks for each value, the chain is run once per
+# type, in _wrap_handler and _unwrap_handler, and the function found is kept in a table
+# indexed by type. Only containers recurse. Floats and ints, most of what goes over the
+# bus, are handled before the table is looked at.
+
+def _identity(value):
+	return value
+
+def _wrap_float(value):
+	return dbus.Double(value, variant_level=1)
+
+def _wrap_bool(value):
+	return dbus.Boolean(value, variant_level=1)
+
+def _wrap_int(value):
+	try:
+		return dbus.Int32(value, variant_level=1)
+	except OverflowError:
+		return dbus.Int64(value, variant_level=1)
+
+def _wrap_str(value):
+	return dbus.String(value, variant_level=1)
+
+def _wrap_list(value):
+	if len(value) == 0:
+		# If the list is empty we cannot infer the type of the contents. So assume unsigned integer.
+		# A (signed) integer is dangerous, because an empty list of signed integers is used to encode
+		# an invalid value.
+		return dbus.Array([], signature=dbus.Signature('u'), variant_level=1)
+	return dbus.Array([wrap_dbus_value(x) for x in value], variant_level=1)
+
+def _wrap_dict(value):
+	# Wrapping the keys of the dictionary causes D-Bus errors like:
+	# 'arguments to dbus_message_iter_open_container() were incorrect,
+	# assertion "(type == DBUS_TYPE_ARRAY && contained_signature &&
+	# *contained_signature == DBUS_DICT_ENTRY_BEGIN_CHAR) || (contained_signature == NULL ||
+	# _dbus_check_is_valid_signature (contained_signature))" failed in file ...'
+	return dbus.Dictionary({(k, wrap_dbus_value(v)) for k, v in value.items()}, variant_level=1)
+
+def _wrap_handler(t):
+	if issubclass(t, float):
+		return _wrap_float
+	if issubclass(t, bool):
+		return _wrap_bool
+	if issubclass(t, int):
+		return _wrap_int
+	if issubclass(t, str):
+		return _wrap_str
+	if issubclass(t, list):
+		return _wrap_list
+	if issubclass(t, dict):
+		return _wrap_dict
+	return _identity
+
+_wrap_handlers = {}
+
 def wrap_dbus_value(value):
 	if value is None:
 		return VEDBUS_INVALID
-	if isinstance(value, float):
+	t = type(value)
+	if t is float:
 		return dbus.Double(value, variant_level=1)
-	if isinstance(value, bool):
-		return dbus.Boolean(value, variant_level=1)
-	if isinstance(value, int):
+	if t is int:
 		try:
 			return dbus.Int32(value, variant_level=1)
 		except OverflowError:
 			return dbus.Int64(value, variant_level=1)
-	if isinstance(value, str):
-		return dbus.String(value, variant_level=1)
-	if isinstance(value, list):
-		if len(value) == 0:
-			# If the list is empty we cannot infer the type of the contents. So assume unsigned integer.
-			# A (signed) integer is dangerous, because an empty list of signed integers is used to encode
-			# an invalid value.
-			return dbus.Array([], signature=dbus.Signature('u'), variant_level=1)
-		return dbus.Array([wrap_dbus_value(x) for x in value], variant_level=1)
-	if isinstance(value, dict):
-		# Wrapping the keys of the dictionary causes D-Bus errors like:
-		# 'arguments to dbus_message_iter_open_container() were incorrect,
-		# assertion "(type == DBUS_TYPE_ARRAY && contained_signature &&
-		# *contained_signature == DBUS_DICT_ENTRY_BEGIN_CHAR) || (contained_signature == NULL ||
-		# _dbus_check_is_valid_signature (contained_signature))" failed in file ...'
-		return dbus.Dictionary({(k, wrap_dbus_value(v)) for k, v in value.items()}, variant_level=1)
-	return value
+	try:
+		handler = _wrap_handlers[t]
+	except KeyError:
+		handler = _wrap_handlers[t] = _wrap_handler(t)
+	return handler(value)
 
 
 dbus_int_types = (dbus.Int32, dbus.UInt32, dbus.Byte, dbus.Int16, dbus.UInt16, dbus.UInt32, dbus.Int64, dbus.UInt64)
 
+def _unwrap_array(val):
+	v = [unwrap_dbus_value(x) for x in val]
+	return None if len(v) == 0 else v
+
+def _unwrap_byte_array(val):
+	return "".join([bytes(x) for x in val])
+
+def _unwrap_list(val):
+	return [unwrap_dbus_value(x) for x in val]
+
+def _unwrap_dict(val):
+	# Do not unwrap the keys, see comment in wrap_dbus_value
+	return dict([(x, unwrap_dbus_value(y)) for x, y in val.items()])
+
+def _unwrap_handler(t):
+	if issubclass(t, dbus_int_types):
+		return int
+	if issubclass(t, dbus.Double):
+		return float
+	if issubclass(t, dbus.Array):
+		return _unwrap_array
+	if issubclass(t, (dbus.Signature, dbus.String)):
+		return str
+	# Python has no byte type, so we convert to an integer.
+	if issubclass(t, dbus.Byte):
+		return int
+	if issubclass(t, dbus.ByteArray):
+		return _unwrap_byte_array
+	if issubclass(t, (list, tuple)):
+		return _unwrap_list
+	if issubclass(t, (dbus.Dictionary, dict)):
+		return _unwrap_dict
+	if issubclass(t, dbus.Boolean):
+		return bool
+	return _identity
+
+_unwrap_handlers = {}
 
 def unwrap_dbus_value(val):
 	"""Converts D-Bus values back to the original type. For example if val is of type DBus.Double,
 	a float will be returned."""
-	if isinstance(val, dbus_int_types):
+	t = type(val)
+	if t is dbus.Int32:
 		return int(val)
-	if isinstance(val, dbus.Double):
+	if t is dbus.Double:
 		return float(val)
-	if isinstance(val, dbus.Array):
-		v = [unwrap_dbus_value(x) for x in val]
-		return None if len(v) == 0 else v
-	if isinstance(val, (dbus.Signature, dbus.String)):
-		return str(val)
-	# Python has no byte type, so we convert to an integer.
-	if isinstance(val, dbus.Byte):
-		return int(val)
-	if isinstance(val, dbus.ByteArray):
-		return "".join([bytes(x) for x in val])
-	if isinstance(val, (list, tuple)):
-		return [unwrap_dbus_value(x) for x in val]
-	if isinstance(val, (dbus.Dictionary, dict)):
-		# Do not unwrap the keys, see comment in wrap_dbus_value
-		return dict([(x, unwrap_dbus_value(y)) for x, y in val.items()])
-	if isinstance(val, dbus.Boolean):
-		return bool(val)
-	return val
+	try:
+		handler = _unwrap_handlers[t]
+	except KeyError:
+		handler = _unwrap_handlers[t] = _unwrap_handler(t)
+	return handler(val)
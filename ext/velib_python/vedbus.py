@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import dbus.service
+from gi.repository import GLib
 import logging
 import traceback
 import os
+import time
 import weakref
 from collections import defaultdict
-from ve_utils import wrap_dbus_value, unwrap_dbus_value
+from functools import partial
+from ve_utils import exit_on_error, wrap_dbus_value, unwrap_dbus_value, VEDBUS_INVALID
 
 # vedbus contains three classes:
 # VeDbusItemImport -> use this to read data from the dbus, ie import
@@ -57,13 +60,27 @@ from ve_utils import wrap_dbus_value, unwrap_dbus_value
 #   The signature of a variant is 'v'.
 
 # Export ourselves as a D-Bus service.
+# With autobatch, values set with service[path] = value are not signalled one by one, but
+# collected until the main loop is idle and then sent as one ItemsChanged on the root, like
+# a with block does. Call flush to send them right away.
+# With typecheck, values set on paths with a valuetype are checked against it, see add_path.
 class VeDbusService(object):
-	def __init__(self, servicename, bus=None):
+	def __init__(self, servicename, bus=None, autobatch=False, typecheck=False):
 		# dict containing the VeDbusItemExport objects, with their path as the key.
 		self._dbusobjects = {}
 		self._dbusnodes = {}
 		self._ratelimiters = []
 
+		# The same VeDbusItemExport objects, in a tree along the parts of their path
+		self._paths = PathTrie()
+
+		self._typecheck = typecheck
+
+		# Changes waiting for the idle callback, with autobatch
+		self._autobatch = autobatch
+		self._batch = {}
+		self._flushScheduled = False
+
 		# dict containing the onchange callbacks, for each object. Object path is the key
 		self._onchangecallbacks = {}
 
@@ -97,15 +114,24 @@ class VeDbusService(object):
 	# @param callbackonchange	function that will be called when this value is changed. First parameter will
 	#							be the path of the object, second the new value. This callback should return
 	#							True to accept the change, False to reject it.
+	# @param publishpolicy		PublishPolicy that limits the signals sent for this path.
+	# @param textinsignals		False to leave the text out of the signals, it is then only
+	#							formatted when asked for.
+	# @param valuetype			D-Bus type of the value, a type like dbus.Double or its signature
+	#							like 'd'. The value is then always sent as that type, instead of
+	#							one depending on the python type of the value.
 	def add_path(self, path, value, description="", writeable=False,
-					onchangecallback=None, gettextcallback=None):
+					onchangecallback=None, gettextcallback=None, publishpolicy=None,
+					textinsignals=True, valuetype=None):
 
 		if onchangecallback is not None:
 			self._onchangecallbacks[path] = onchangecallback
 
 		item = VeDbusItemExport(
 				self._dbusconn, path, value, description, writeable,
-				self._value_changed, gettextcallback, deletecallback=self._item_deleted)
+				self._value_changed, gettextcallback, deletecallback=self._item_deleted,
+				changedcallback=self._item_changed, publishpolicy=publishpolicy,
+				textinsignals=textinsignals, valuetype=valuetype, typecheck=self._typecheck)
 
 		spl = path.split('/')
 		for i in range(2, len(spl)):
@@ -113,6 +139,8 @@ class VeDbusService(object):
 			if subPath not in self._dbusnodes and subPath not in self._dbusobjects:
 				self._dbusnodes[subPath] = VeDbusTreeExport(self._dbusconn, subPath, self)
 		self._dbusobjects[path] = item
+		self._paths.add(path, item)
+		self._dbusnodes['/']._item_added(path, item)
 		logging.debug('added %s with start value %s. Writeable is %s' % (path, value, writeable))
 
 	# Add the mandatory paths, as per victron dbus api doc
@@ -138,22 +166,62 @@ class VeDbusService(object):
 
 		return self._onchangecallbacks[path](path, newvalue)
 
+	# Called by the items after their value changed, changes is None when it is not signalled
+	def _item_changed(self, path, changes):
+		if changes is not None:
+			# An older value waiting with autobatch must not follow this one
+			self._batch.pop(path, None)
+		if '/' in self._dbusnodes:
+			self._dbusnodes['/']._item_changed(path, changes)
+
 	def _item_deleted(self, path):
 		self._dbusobjects.pop(path)
-		for np in list(self._dbusnodes.keys()):
-			if np != '/':
-				for ip in self._dbusobjects:
-					if ip.startswith(np + '/'):
-						break
-				else:
-					self._dbusnodes[np].__del__()
-					self._dbusnodes.pop(np)
+		self._batch.pop(path, None)
+		if '/' in self._dbusnodes:
+			self._dbusnodes['/']._item_removed(path)
+		for np in self._paths.remove(path):
+			node = self._dbusnodes.pop(np, None)
+			if node is not None:
+				node.__del__()
+
+	# Removes the path prefix and everything below it. Returns the number of paths removed.
+	def remove_paths(self, prefix):
+		node = self._paths.find(prefix)
+		if node is None:
+			return 0
+		base = prefix.rstrip('/')
+		paths = [base + '/' + p for p, item in node.items()]
+		if node.item is not None:
+			paths.append(prefix)
+		for path in paths:
+			del self[path]
+		return len(paths)
 
 	def __getitem__(self, path):
 		return self._dbusobjects[path].local_get_value()
 
 	def __setitem__(self, path, newvalue):
-		self._dbusobjects[path].local_set_value(newvalue)
+		if not self._autobatch:
+			self._dbusobjects[path].local_set_value(newvalue)
+			return
+
+		c = self._dbusobjects[path]._local_set_value(newvalue)
+		if c is not None:
+			self._batch[path] = c
+			if not self._flushScheduled:
+				self._flushScheduled = True
+				GLib.idle_add(exit_on_error, self._flush_idle)
+
+	def _flush_idle(self):
+		self._flushScheduled = False
+		self.flush()
+		return False
+
+	# Sends the changes collected with autobatch
+	def flush(self):
+		if self._batch:
+			changes, self._batch = self._batch, {}
+			self._dbusnodes['/'].ItemsChanged(changes)
 
 	def __delitem__(self, path):
 		self._dbusobjects[path].__del__()  # Invalidates and then removes the object path
@@ -190,6 +258,63 @@ class ServiceContext(object):
 		if self.changes:
 			self.parent._dbusnodes['/'].ItemsChanged(self.changes)
 
+class PathTrie(object):
+	""" Items indexed by the parts of their path, so the items below a path are
+	    found without looking at all others. """
+	__slots__ = ('children', 'item')
+
+	def __init__(self):
+		self.children = {}
+		self.item = None
+
+	def add(self, path, item):
+		node = self
+		for name in path.split('/')[1:]:
+			child = node.children.get(name)
+			if child is None:
+				child = node.children[name] = PathTrie()
+			node = child
+		node.item = item
+
+	def remove(self, path):
+		""" Removes the item at path. Returns the paths above it that have nothing
+		    below them anymore, deepest first. Costs O(depth). """
+		names = path.split('/')[1:]
+		nodes = [self]
+		for name in names:
+			nodes.append(nodes[-1].children[name])
+		nodes[-1].item = None
+
+		# Drop the nodes that are empty now, going up until one still has children
+		empty = []
+		for i in range(len(names), 0, -1):
+			node = nodes[i]
+			if node.children or node.item is not None:
+				break
+			if i < len(names):
+				empty.append('/'.join([''] + names[:i]))
+			del nodes[i - 1].children[names[i - 1]]
+		return empty
+
+	def find(self, path):
+		node = self
+		for name in path.split('/')[1:]:
+			if name == '':
+				continue # The root, '/'
+			node = node.children.get(name)
+			if node is None:
+				return None
+		return node
+
+	def items(self, prefix=''):
+		""" Yields all (path relative to this node, item) below this node. """
+		for name, child in self.children.items():
+			path = prefix + name
+			if child.item is not None:
+				yield path, child.item
+			for i in child.items(path + '/'):
+				yield i
+
 class TrackerDict(defaultdict):
 	""" Same as defaultdict, but passes the key to default_factory. """
 	def __missing__(self, key):
@@ -409,16 +534,24 @@ class VeDbusTreeExport(dbus.service.Object):
 		return self._locations[0][1]
 
 	def _get_value_handler(self, path, get_text=False):
-		logging.debug("_get_value_handler called for %s" % path)
+		logging.debug("_get_value_handler called for %s", path)
 		r = {}
-		px = path
-		if not px.endswith('/'):
-			px += '/'
-		for p, item in self._service._dbusobjects.items():
-			if p.startswith(px):
-				v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
-				r[p[len(px):]] = v
-		logging.debug(r)
+		if path == '/':
+			# Everything is below the root, the flat dict is faster than the trie
+			items = self._service._dbusobjects.items()
+			if get_text:
+				for p, item in items:
+					r[p[1:]] = item.GetText()
+			else:
+				for p, item in items:
+					r[p[1:]] = wrap_dbus_value(item.local_get_value())
+			return r
+
+		node = self._service._paths.find(path)
+		if node is None:
+			return r
+		for p, item in node.items():
+			r[p] = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
 		return r
 
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='v')
@@ -434,19 +567,85 @@ class VeDbusTreeExport(dbus.service.Object):
 		return self._get_value_handler(self.path)
 
 class VeDbusRootExport(VeDbusTreeExport):
+	def __init__(self, bus, objectPath, service):
+		VeDbusTreeExport.__init__(self, bus, objectPath, service)
+		# The GetItems reply, built on the first call and then kept up to date per item. Paths
+		# with a change that was not signalled are refreshed on the next call.
+		self._items = None
+		self._stale = set()
+
+	def _item_added(self, path, item):
+		if self._items is not None:
+			self._items[path] = item._get_item()
+
+	def _item_changed(self, path, changes):
+		# Deleted items are invalidated after they are removed, don't add them back
+		if self._items is not None and path in self._items:
+			if changes is None or 'Text' not in changes:
+				self._stale.add(path)
+			else:
+				self._items[path] = changes
+				self._stale.discard(path)
+
+	def _item_removed(self, path):
+		if self._items is not None:
+			self._items.pop(path, None)
+			self._stale.discard(path)
+
 	@dbus.service.signal('com.victronenergy.BusItem', signature='a{sa{sv}}')
 	def ItemsChanged(self, changes):
 		pass
 
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='a{sa{sv}}')
 	def GetItems(self):
-		return {
-			path: {
-				'Value': wrap_dbus_value(item.local_get_value()),
-				'Text': item.GetText() }
-			for path, item in self._service._dbusobjects.items()
-		}
-
+		if self._items is None:
+			self._items = {
+				path: item._get_item()
+				for path, item in self._service._dbusobjects.items()
+			}
+		for path in self._stale:
+			self._items[path] = self._service._dbusobjects[path]._get_item()
+		self._stale.clear()
+		return self._items
+
+
+class PublishPolicy(object):
+	""" Limits the PropertiesChanged signals of a VeDbusItemExport. A value held back is
+	    not lost, the latest value is signalled as soon as the policy allows it.
+	    maxrate: at most this many signals per second.
+	    absdelta, reldelta: no signal for a change smaller than absdelta, or than reldelta
+	      times the last signalled value. Only for numbers.
+	    refresh: seconds after which a change held back by absdelta or reldelta is
+	      signalled anyway. """
+	def __init__(self, maxrate=None, absdelta=None, reldelta=None, refresh=None):
+		self.maxrate = maxrate
+		self.absdelta = absdelta
+		self.reldelta = reldelta
+		self.refresh = refresh
+
+	def hold(self, published, value, elapsed):
+		""" Returns whether value is to be held back, elapsed seconds after published was
+		    signalled, and at what elapsed time to look again, None to wait for a change. """
+		if self.maxrate and elapsed < 1.0 / self.maxrate:
+			return True, 1.0 / self.maxrate
+		if self.refresh is not None and elapsed >= self.refresh:
+			return False, None
+		try:
+			band = max(self.absdelta or 0, (self.reldelta or 0) * abs(published))
+			if abs(value - published) < band:
+				return True, self.refresh
+		except TypeError:
+			pass # Invalid or not a number
+		return False, None
+
+# The D-Bus types for a valuetype given as signature, and the python types accepted for them
+# with typecheck
+dbus_value_types = {
+	'y': dbus.Byte, 'b': dbus.Boolean, 'n': dbus.Int16, 'q': dbus.UInt16, 'i': dbus.Int32,
+	'u': dbus.UInt32, 'x': dbus.Int64, 't': dbus.UInt64, 'd': dbus.Double, 's': dbus.String }
+python_value_types = {
+	dbus.Byte: int, dbus.Boolean: int, dbus.Int16: int, dbus.UInt16: int, dbus.Int32: int,
+	dbus.UInt32: int, dbus.Int64: int, dbus.UInt64: int, dbus.Double: (int, float), dbus.String: str }
 
 class VeDbusItemExport(dbus.service.Object):
 	## Constructor of VeDbusItemExport
@@ -461,10 +660,38 @@ class VeDbusItemExport(dbus.service.Object):
 	# @param callback	  Function that will be called when someone else changes the value of this VeBusItem
 	#                     over the dbus. First parameter passed to callback will be our path, second the new
 	#					  value. This callback should return True to accept the change, False to reject it.
+	# @param changedcallback  Function that will be called after the value changed, by us or over the dbus,
+	#                     with our path and the changes as they are signalled, None if not signalled.
+	# @param publishpolicy  PublishPolicy that limits the signals, local_get_value and GetValue always
+	#                     return the latest value.
+	# @param textinsignals  False to leave the text out of PropertiesChanged. The text is formatted on
+	#                     first use after a change either way, and kept until the next change.
+	# @param valuetype	  D-Bus type, or its signature, to send the value as. None to infer it from the
+	#                     value each time.
+	# @param typecheck	  Raise a TypeError when a value is set that does not fit valuetype.
 	def __init__(self, bus, objectPath, value=None, description=None, writeable=False,
-					onchangecallback=None, gettextcallback=None, deletecallback=None):
+					onchangecallback=None, gettextcallback=None, deletecallback=None,
+					changedcallback=None, publishpolicy=None, textinsignals=True,
+					valuetype=None, typecheck=False):
 		dbus.service.Object.__init__(self, bus, objectPath)
+		self._valuetype = dbus_value_types.get(valuetype, valuetype)
+		self._typecheck = typecheck and valuetype is not None
+		if self._valuetype is not None:
+			self._construct = partial(self._valuetype, variant_level=1)
+			self._wrap = self._wrap_typed
+		else:
+			self._wrap = wrap_dbus_value
+		if self._typecheck:
+			self._check_type(value)
+		self._text = None # Cached GetText, None until asked for
+		self._textinsignals = textinsignals
 		self._onchangecallback = onchangecallback
+		self._changedcallback = changedcallback
+		self._publishpolicy = publishpolicy
+		# The initial value counts as signalled, it is what GetValue and GetItems return
+		self._published = value
+		self._publishedat = time.monotonic()
+		self._publishtimer = None
 		self._gettextcallback = gettextcallback
 		self._value = value
 		self._description = description
@@ -480,6 +707,11 @@ class VeDbusItemExport(dbus.service.Object):
 			return
 		if self._deletecallback is not None:
 			self._deletecallback(path)
+		# Invalidate right away, whatever the publish policy
+		if self._publishtimer is not None:
+			GLib.source_remove(self._publishtimer)
+			self._publishtimer = None
+		self._publishpolicy = None
 		self.local_set_value(None)
 		self.remove_from_connection()
 		logging.debug("VeDbusItemExport %s has been removed" % path)
@@ -502,12 +734,65 @@ class VeDbusItemExport(dbus.service.Object):
 		if self._value == newvalue:
 			return None
 
+		if self._typecheck:
+			self._check_type(newvalue)
+
 		self._value = newvalue
+		self._text = None
+		if self._publishpolicy is not None and self._hold():
+			if self._changedcallback is not None:
+				self._changedcallback(self.__dbus_object_path__, None)
+			return None
+		return self._publish()
+
+	def _publish(self):
+		self._published = self._value
+		self._publishedat = time.monotonic()
+		if self._textinsignals:
+			changes = self._get_item()
+		else:
+			changes = {'Value': self._wrap(self._value)}
+		if self._changedcallback is not None:
+			self._changedcallback(self.__dbus_object_path__, changes)
+		return changes
+
+	# Returns whether the publish policy holds back the value, and sees to it that the
+	# latest value is signalled when the policy allows it.
+	def _hold(self):
+		elapsed = time.monotonic() - self._publishedat
+		hold, due = self._publishpolicy.hold(self._published, self._value, elapsed)
+		if not hold:
+			if self._publishtimer is not None:
+				GLib.source_remove(self._publishtimer)
+				self._publishtimer = None
+		elif due is not None and self._publishtimer is None:
+			self._publishtimer = GLib.timeout_add(int((due - elapsed) * 1000) + 1,
+				exit_on_error, self._publish_timeout)
+		return hold
+
+	def _publish_timeout(self):
+		self._publishtimer = None
+		if self._value != self._published and not self._hold():
+			self.PropertiesChanged(self._publish())
+		return False
+
+	def _get_item(self):
 		return {
-			'Value': wrap_dbus_value(newvalue),
+			'Value': self._wrap(self._value),
 			'Text': self.GetText()
 		}
 
+	def _wrap_typed(self, value):
+		if value is None:
+			return VEDBUS_INVALID
+		return self._construct(value)
+
+	def _check_type(self, value):
+		if value is not None and (isinstance(value, bool) and self._valuetype is not dbus.Boolean or
+				not isinstance(value, python_value_types.get(self._valuetype, object))):
+			raise TypeError('%s: %r does not fit %s' % (self.__dbus_object_path__, value,
+				self._valuetype.__name__))
+
 	def local_get_value(self):
 		return self._value
 
@@ -552,13 +837,18 @@ class VeDbusItemExport(dbus.service.Object):
 	# @return the value when valid, and otherwise an empty array
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='v')
 	def GetValue(self):
-		return wrap_dbus_value(self._value)
+		return self._wrap(self._value)
 
 	## Dbus exported method GetText
 	# Returns the value as string of the dbus-object-path.
 	# @return text A text-value. '---' when local value is invalid
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='s')
 	def GetText(self):
+		if self._text is None:
+			self._text = self._format_text()
+		return self._text
+
+	def _format_text(self):
 		if self._value is None:
 			return '---'
 
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""
+Replay a recorded trace through PVControl, faster than real time.
+
+The trace is a csv file, one event per line:
+
+    timestamp,service,path,value
+
+timestamp is in seconds (unix time or relative), value is empty for an
+invalid value. All events carrying the first timestamp form the initial
+state of the bus, the services in it exist before PVControl starts. A
+service seen later is added at that moment, a line with path '-' removes it.
+
+PVControl runs against test/mock_dbus_monitor and test/mock_gobject from
+velib_python, the clock it sees is the virtual time of the trace. Every
+DeviceControl.turnOn/turnOff decision is written out as
+
+    timestamp,device,action,watt
+"""
+import argparse
+import csv
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), './ext/velib_python'))
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), './ext/velib_python/test'))
+import mock_gobject
+from dbusmonitor import DbusMonitor, FILTER_OPTIONS
+from mock_dbus_monitor import MockDbusMonitor
+from mock_dbus_service import MockDbusService
+
+def load_pvcontrol():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dbus-pvcontrol.py')
+    spec = importlib.util.spec_from_file_location('pvcontrol', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Stands in for the time module in pvcontrol, driven by the mock timer manager
+class VirtualClock(object):
+
+    def __init__(self, start):
+        self.start = start
+
+    def monotonic(self):
+        return mock_gobject.timer_manager.time / 1000.0
+
+    def monotonic_ns(self):
+        return int(mock_gobject.timer_manager.time * 1000000)
+
+    def time(self):
+        return self.start + self.monotonic()
+
+# MockDbusMonitor that dispatches changes the way DbusMonitor does: only when
+# the value really changed, with a changes dict, and held back by the filter
+# options of the path in the dbusTree. Values written by pvcontrol are echoed
+# back by the simulated device after echoDelay ms. With timestamps, changes
+# carries 'Received' and 'Dispatched' on the virtual clock, which does not move
+# while a change is handled: the latencies are all 0. DbusMonitor options that
+# only tune D-Bus traffic are ignored.
+class ReplayDbusMonitor(MockDbusMonitor):
+
+    def __init__(self, dbusTree, echoDelay=100, valueChangedCallback=None,
+            deviceAddedCallback=None, deviceRemovedCallback=None, timestamps=False, **options):
+        super(ReplayDbusMonitor, self).__init__(dbusTree, valueChangedCallback=valueChangedCallback,
+            deviceAddedCallback=deviceAddedCallback, deviceRemovedCallback=deviceRemovedCallback)
+        self.dbusTree = dbusTree
+        self.echoDelay = echoDelay
+        self.timestamps = timestamps
+        # Last dispatched value, its time and the trailing timer per (service, path), as in DbusMonitor
+        self._filterState = {}
+        self.filterStats = {'passed': 0, 'deadband': 0, 'interval': 0, 'trailing': 0}
+
+    def known(self, service):
+        return '.'.join(service.split('.')[:3]) in self.dbusTree
+
+    def monitored(self, service, path):
+        return self.known(service) and path in self._tree['.'.join(service.split('.')[:3])]
+
+    def options(self, service, path):
+        return self.dbusTree['.'.join(service.split('.')[:3])].get(path) or {}
+
+    def add_value(self, service, path, value):
+        super(ReplayDbusMonitor, self).add_value(service, path, value)
+        if self.known(service) and not FILTER_OPTIONS.isdisjoint(self.options(service, path)):
+            self._filterState[(service, path)] = [value, mock_gobject.timer_manager.time / 1000.0, None]
+
+    def remove_service(self, service):
+        for key in [k for k in self._filterState if k[0] == service]:
+            timer = self._filterState.pop(key)[2]
+            if timer is not None:
+                mock_gobject.source_remove(timer)
+        super(ReplayDbusMonitor, self).remove_service(service)
+
+    def get_filter_stats(self):
+        return dict(self.filterStats)
+
+    # Adds a service found by the initial scan. DbusMonitor does not report
+    # those as added, and PVControl is still being constructed at that point.
+    def seed(self, service, values):
+        callback, self._device_added_callback = self._device_added_callback, None
+        try:
+            self.add_service(service, values)
+        finally:
+            self._device_added_callback = callback
+
+    def update(self, service, path, value):
+        item = self._get_item(service, path)
+        if item is None:
+            return
+        self.set_seen(service, path)
+        if item.get_value() == value:
+            return
+        item.set_value(value)
+
+        state = self._filterState.get((service, path))
+        if state is not None:
+            now = mock_gobject.timer_manager.time / 1000.0
+            reason, due = DbusMonitor._filter_reason(self.options(service, path), state, value, now)
+            if reason is not None:
+                self.filterStats[reason] += 1
+                if due is not None and state[2] is None:
+                    state[2] = mock_gobject.timeout_add(int((due - now) * 1000) + 1,
+                        self._filter_timeout, service, path)
+                return
+            if state[2] is not None:
+                mock_gobject.source_remove(state[2])
+            state[:] = [value, now, None]
+            self.filterStats['passed'] += 1
+        self._dispatch(service, path, value)
+
+    def _filter_timeout(self, service, path):
+        state = self._filterState.get((service, path))
+        if state is None:
+            return False
+        state[2] = None
+        value = self.get_value(service, path)
+        if value == state[0]:
+            return False
+        now = mock_gobject.timer_manager.time / 1000.0
+        reason, due = DbusMonitor._filter_reason(self.options(service, path), state, value, now)
+        if reason is not None:
+            if due is not None:
+                state[2] = mock_gobject.timeout_add(int((due - now) * 1000) + 1,
+                    self._filter_timeout, service, path)
+            return False
+        state[0], state[1] = value, now
+        self.filterStats['trailing'] += 1
+        self._dispatch(service, path, value)
+        return False
+
+    def _dispatch(self, service, path, value):
+        changes = {'Value': value, 'Text': str(value)}
+        if self.timestamps:
+            changes['Received'] = changes['Dispatched'] = int(mock_gobject.timer_manager.time * 1000000)
+        if self._value_changed_callback is not None:
+            self._value_changed_callback(service, path, self.options(service, path), changes,
+                self.get_value(service, '/DeviceInstance', 0))
+        self._call_handlers(service, path, changes)
+
+    def _echo(self, service, path, value):
+        self.update(service, path, value)
+        return False
+
+    def set_value(self, serviceName, objectPath, value):
+        if self._get_item(serviceName, objectPath) is None:
+            return -1
+        mock_gobject.timeout_add(self.echoDelay, self._echo, serviceName, objectPath, value)
+        return 0
+
+    def set_value_async(self, serviceName, objectPath, value,
+            reply_handler=None, error_handler=None):
+        r = self.set_value(serviceName, objectPath, value)
+        if r == 0:
+            if reply_handler is not None:
+                reply_handler(0)
+        elif error_handler is not None:
+            error_handler(TypeError('Service or path not found, '
+                        'service=%s, path=%s' % (serviceName, objectPath)))
+
+def parse_value(text):
+    if text == '':
+        return None
+    for conv in (int, float):
+        try:
+            return conv(text)
+        except ValueError:
+            pass
+    return text
+
+def read_trace(f):
+    for row in csv.reader(f):
+        if not row or row[0].startswith('#'):
+            continue
+        timestamp, service, path, value = (row + [''])[:4]
+        yield float(timestamp), service.strip(), path.strip(), parse_value(value.strip())
+
+class Replay(object):
+
+    def __init__(self, pvcontrol, events, out, echoDelay=100):
+        self.pvcontrol = pvcontrol
+        self.events = events
+        self.out = out
+        self.echoDelay = echoDelay
+        self.decisions = 0
+        self.clock = None
+        self.monitor = None
+        self.pvc = None
+
+    def _create_monitor(self, dbusTree, **kwargs):
+        self.monitor = ReplayDbusMonitor(dbusTree, echoDelay=self.echoDelay, **kwargs)
+        for service, values in self.initial.items():
+            if not self.monitor.known(service):
+                continue
+            values.setdefault('/DeviceInstance', 0)
+            self.monitor.seed(service, {p: v for p, v in values.items() if self.monitor.monitored(service, p)})
+        return self.monitor
+
+    def _record(self, action, f):
+        def wrapper(control, *args, **kwargs):
+            self.decisions += 1
+            self.out.writerow(['%.3f' % self.clock.time(), control.serviceCb(), action,
+                getattr(self.pvc, 'watt', '')])
+            return f(control, *args, **kwargs)
+        return wrapper
+
+    def run(self, tail=0):
+        events = iter(self.events)
+        first = next(events, None)
+        if first is None:
+            return 0
+
+        start = first[0]
+        self.initial = {}
+        pending = first
+        count = 0
+        while pending is not None and pending[0] == start:
+            self.initial.setdefault(pending[1], {})[pending[2]] = pending[3]
+            count += 1
+            pending = next(events, None)
+
+        mock_gobject.timer_manager.reset()
+        mock_gobject.patch_gobject(self.pvcontrol.GLib)
+        self.clock = VirtualClock(start)
+        self.pvcontrol.time = self.clock
+        self.pvcontrol.DbusMonitor = self._create_monitor
+        self.pvcontrol.VeDbusService = MockDbusService
+        DeviceControl = self.pvcontrol.DeviceControl
+        DeviceControl.turnOn = self._record('on', DeviceControl.turnOn)
+        DeviceControl.turnOff = self._record('off', DeviceControl.turnOff)
+
+        self.pvc = self.pvcontrol.PVControl()
+
+        while pending is not None:
+            timestamp, service, path, value = pending
+            self._advance(timestamp - start)
+            if path == '-':
+                self.monitor.remove_service(service)
+            elif not self.monitor.known(service):
+                pass
+            elif service not in self.monitor.get_service_list():
+                values = {'/DeviceInstance': 0}
+                if self.monitor.monitored(service, path):
+                    values[path] = value
+                self.monitor.add_service(service, values)
+            elif self.monitor.monitored(service, path):
+                self.monitor.update(service, path, value)
+            count += 1
+            pending = next(events, None)
+
+        if tail:
+            mock_gobject.timer_manager.run(tail * 1000)
+        return count
+
+    def _advance(self, seconds):
+        delta = seconds * 1000 - mock_gobject.timer_manager.time
+        if delta > 0:
+            mock_gobject.timer_manager.run(delta)
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded trace through PVControl')
+    parser.add_argument('trace', help='csv file with timestamp,service,path,value lines, - for stdin')
+    parser.add_argument('-o', '--output', help='write decisions to this file instead of stdout')
+    parser.add_argument('--tail', type=float, default=0, help='seconds to keep running after the last event')
+    parser.add_argument('--echo-delay', type=int, default=100, help='ms until a device reports a new /Mode')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the pvcontrol log')
+    args = parser.parse_args()
+
+    format = "%(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format=format)
+
+    pvcontrol = load_pvcontrol()
+
+    fin = sys.stdin if args.trace == '-' else open(args.trace, newline='')
+    fout = open(args.output, 'w', newline='') if args.output else sys.stdout
+
+    replay = Replay(pvcontrol, read_trace(fin), csv.writer(fout), echoDelay=args.echo_delay)
+    started = time.monotonic()
+    count = replay.run(tail=args.tail)
+    wall = time.monotonic() - started
+    virtual = mock_gobject.timer_manager.time / 1000.0
+
+    fout.flush()
+    sys.stderr.write("%d events, %d decisions, %.0f s virtual in %.2f s wall (%.0fx real time)\n" % (
+        count, replay.decisions, virtual, wall, virtual / wall if wall else 0))
+
+if __name__ == "__main__":
+    main()
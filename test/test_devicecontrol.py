@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Tests DeviceControl against a device that confirms a /Mode command only
+# when the test says so, and against one that rejects every command.
+
+import importlib.util
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, os.path.join(here, '..', 'ext', 'velib_python', 'test'))
+import mock_gobject
+
+def load_pvcontrol():
+    path = os.path.join(here, '..', 'dbus-pvcontrol.py')
+    spec = importlib.util.spec_from_file_location('pvcontrol', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+pvcontrol = load_pvcontrol()
+mock_gobject.patch_gobject(pvcontrol.GLib)
+
+SERVICE = 'com.victronenergy.vebus.ttyS4'
+
+# Takes /Mode commands without echoing them, the test calls DeviceControl.watch
+# for the device reporting its mode.
+class ModeMonitor(object):
+
+    def __init__(self, reject=False):
+        self.reject = reject
+        self.sent = []
+
+    def get_value(self, service, path, default_value=None):
+        return {'/Mode': pvcontrol.mode_off, '/State': 0}.get(path, default_value)
+
+    def set_value_async(self, service, path, value, reply_handler=None, error_handler=None):
+        self.sent.append(value)
+        if self.reject:
+            error_handler(Exception('org.freedesktop.DBus.Error.UnknownObject'))
+        else:
+            reply_handler(0)
+
+class DeviceControlTest(unittest.TestCase):
+
+    def setUp(self):
+        mock_gobject.timer_manager.reset()
+        self.create()
+
+    def create(self, reject=False):
+        self.monitor = ModeMonitor(reject)
+        self.control = pvcontrol.DeviceControl(self.monitor, lambda: SERVICE,
+            pvcontrol.mode_off, pvcontrol.mode_on)
+
+    def run_for(self, seconds):
+        mock_gobject.timer_manager.run(seconds * 1000)
+
+    def give_up(self):
+        self.run_for(pvcontrol.MODE_CONFIRM_TIMEOUT * (pvcontrol.MODE_RETRIES + 1) + 1)
+
+    def test_confirmed(self):
+        self.assertTrue(self.control.turnOn())
+        self.assertTrue(self.control.isPending())
+        self.control.watch('/Mode', pvcontrol.mode_on)
+        self.assertFalse(self.control.isPending())
+        self.assertTrue(self.control.isOn())
+
+        self.run_for(pvcontrol.MODE_RESEND_INTERVAL * 2)
+        self.assertEqual(self.monitor.sent, [pvcontrol.mode_on])
+        self.assertEqual(mock_gobject.timer_manager._resources, [])
+
+    def test_same_mode(self):
+        self.assertFalse(self.control.turnOff())
+        self.assertEqual(self.monitor.sent, [])
+
+    def test_confirm_timeout(self):
+        self.control.turnOn()
+        self.run_for(pvcontrol.MODE_CONFIRM_TIMEOUT - 1)
+        self.assertEqual(self.monitor.sent, [pvcontrol.mode_on])
+
+        # Sent again when not confirmed in time, confirmed by the retry
+        self.run_for(1)
+        self.assertEqual(self.monitor.sent, [pvcontrol.mode_on] * 2)
+        self.control.watch('/Mode', pvcontrol.mode_on)
+        self.assertFalse(self.control.isPending())
+
+        self.run_for(pvcontrol.MODE_RESEND_INTERVAL * 2)
+        self.assertEqual(len(self.monitor.sent), 2)
+
+    def test_give_up(self):
+        self.control.turnOn()
+        self.give_up()
+        self.assertEqual(self.monitor.sent, [pvcontrol.mode_on] * (pvcontrol.MODE_RETRIES + 1))
+        self.assertFalse(self.control.isPending())
+        self.assertTrue(self.control.isOff())
+
+        # The command is not forgotten, it is sent again later with the same retries
+        self.run_for(pvcontrol.MODE_RESEND_INTERVAL)
+        self.assertEqual(len(self.monitor.sent), pvcontrol.MODE_RETRIES + 2)
+        self.assertTrue(self.control.isPending())
+        self.control.watch('/Mode', pvcontrol.mode_on)
+        self.assertFalse(self.control.isPending())
+
+    def test_rejected(self):
+        self.create(reject=True)
+        self.control.turnOn()
+        self.assertTrue(self.control.isPending())
+        self.give_up()
+        self.assertEqual(self.monitor.sent, [pvcontrol.mode_on] * (pvcontrol.MODE_RETRIES + 1))
+        self.assertFalse(self.control.isPending())
+
+        self.run_for(pvcontrol.MODE_RESEND_INTERVAL + pvcontrol.MODE_CONFIRM_TIMEOUT)
+        self.assertEqual(len(self.monitor.sent), pvcontrol.MODE_RETRIES + 3)
+
+    def test_give_up_then_reported(self):
+        # The device reports the mode late, nothing is sent again
+        self.control.turnOn()
+        self.give_up()
+        self.control.watch('/Mode', pvcontrol.mode_on)
+        self.run_for(pvcontrol.MODE_RESEND_INTERVAL * 2)
+        self.assertEqual(len(self.monitor.sent), pvcontrol.MODE_RETRIES + 1)
+        self.assertEqual(mock_gobject.timer_manager._resources, [])
+
+    def test_give_up_then_other_mode(self):
+        # A request for another mode replaces the one given up on
+        self.control.turnOn()
+        self.give_up()
+        self.assertFalse(self.control.turnOff())
+        self.run_for(pvcontrol.MODE_RESEND_INTERVAL * 2)
+        self.assertEqual(len(self.monitor.sent), pvcontrol.MODE_RETRIES + 1)
+        self.assertEqual(mock_gobject.timer_manager._resources, [])
+
+    def test_wanted_while_pending(self):
+        self.assertTrue(self.control.turnOn())
+        self.assertFalse(self.control.turnOff())
+        self.assertEqual(self.control.wanted, pvcontrol.mode_off)
+
+        # Asking for the pending mode again drops the wanted one
+        self.assertFalse(self.control.turnOn())
+        self.assertIsNone(self.control.wanted)
+
+        # The wanted mode is sent once the pending command is confirmed
+        self.control.turnOff()
+        self.control.watch('/Mode', pvcontrol.mode_on)
+        self.assertEqual(self.monitor.sent, [pvcontrol.mode_on, pvcontrol.mode_off])
+        self.assertEqual(self.control.pending, pvcontrol.mode_off)
+        self.control.watch('/Mode', pvcontrol.mode_off)
+        self.assertFalse(self.control.isPending())
+        self.assertTrue(self.control.isOff())
+
+    def test_wanted_after_give_up(self):
+        # The wanted mode is sent when the pending one is given up on, and
+        # the one given up on is not sent again
+        self.control.turnOn()
+        self.control.setMode(pvcontrol.mode_charger_only)
+        self.give_up()
+        self.assertEqual(self.monitor.sent,
+            [pvcontrol.mode_on] * (pvcontrol.MODE_RETRIES + 1) + [pvcontrol.mode_charger_only])
+        self.control.watch('/Mode', pvcontrol.mode_charger_only)
+        self.run_for(pvcontrol.MODE_RESEND_INTERVAL * 2)
+        self.assertEqual(len(self.monitor.sent), pvcontrol.MODE_RETRIES + 2)
+
+    def test_wanted_current_mode_after_give_up(self):
+        # Asked to go back to the current mode while pending: nothing is sent again
+        self.control.turnOn()
+        self.control.turnOff()
+        self.give_up()
+        self.run_for(pvcontrol.MODE_RESEND_INTERVAL * 2)
+        self.assertEqual(self.monitor.sent, [pvcontrol.mode_on] * (pvcontrol.MODE_RETRIES + 1))
+        self.assertEqual(mock_gobject.timer_manager._resources, [])
+
+if __name__ == "__main__":
+    unittest.main()
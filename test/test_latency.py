@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Tests the buckets and percentiles of LatencyHistogram.
+
+import importlib.util
+import os
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def load_pvcontrol():
+    path = os.path.join(here, '..', 'dbus-pvcontrol.py')
+    spec = importlib.util.spec_from_file_location('pvcontrol', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+pvcontrol = load_pvcontrol()
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.h = pvcontrol.LatencyHistogram()
+
+    def bucket(self, ns):
+        self.h.add(ns)
+        return [b for (b, c) in enumerate(self.h.counts) if c][-1]
+
+    def test_empty(self):
+        self.assertEqual(self.h.count, 0)
+        self.assertIsNone(self.h.percentile(0.5))
+        self.assertIsNone(self.h.percentile(0.99))
+
+    def test_bucket_edges(self):
+        # Four buckets per power of two, everything below 1 us in the first
+        self.assertEqual(self.bucket(0), 0)
+        self.assertEqual(self.bucket(1000), 0)
+        self.assertEqual(self.bucket(1180), 0)
+        self.assertEqual(self.bucket(1190), 1)
+        self.assertEqual(self.bucket(1999), 3)
+        self.assertEqual(self.bucket(2000), 4)
+        self.assertEqual(self.bucket(1024000), 40)
+
+    def test_overflow(self):
+        # Beyond 2^28 us all go in the last bucket, the percentiles stop at
+        # its edge, the max is still exact
+        self.h.add(10**15)
+        self.assertEqual(self.h.counts[-1], 1)
+        self.assertEqual(self.h.max, 10**12)
+        self.assertEqual(self.h.percentile(0.5), 2 ** 28)
+
+    def test_percentiles(self):
+        for i in range(90):
+            self.h.add(100000)
+        for i in range(10):
+            self.h.add(10000000)
+        self.assertEqual(self.h.count, 100)
+        self.assertEqual(self.h.max, 10000)
+
+        # The upper edge of the bucket, at most a quarter power of two off
+        p50 = self.h.percentile(0.5)
+        self.assertGreaterEqual(p50, 100)
+        self.assertLess(p50, 100 * 2 ** 0.25)
+        self.assertEqual(self.h.percentile(0.9), p50)
+
+        # Never above the largest sample
+        self.assertEqual(self.h.percentile(0.95), 10000)
+        self.assertEqual(self.h.percentile(1), 10000)
+
+    def test_single(self):
+        self.h.add(3000)
+        self.assertEqual(self.h.percentile(0.5), 3)
+        self.assertEqual(self.h.percentile(0.99), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Runs the checked-in trace through pvcontrol-replay.py and checks the
+# decisions PVControl takes on it.
+
+import csv
+import importlib.util
+import io
+import os
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def load_replay():
+    path = os.path.join(here, '..', 'pvcontrol-replay.py')
+    spec = importlib.util.spec_from_file_location('pvcontrol_replay', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class ReplayTest(unittest.TestCase):
+
+    def replay(self, trace, tail=0):
+        replay = load_replay()
+        out = io.StringIO()
+        with open(os.path.join(here, trace), newline='') as f:
+            r = replay.Replay(replay.load_pvcontrol(), replay.read_trace(f), csv.writer(out))
+            count = r.run(tail=tail)
+        return r, count, list(csv.reader(io.StringIO(out.getvalue())))
+
+    def test_decisions(self):
+        r, count, decisions = self.replay('replay-trace.csv')
+        self.assertEqual(count, 16)
+        self.assertEqual(decisions, [
+            ['20.000', 'com.victronenergy.vebus.ttyS4', 'on', '3200'],
+            ['3620.000', 'com.victronenergy.vebus.ttyS4', 'off', '500'],
+            ['4180.000', 'com.victronenergy.inverter.socketcan_can0_vi0_uc1', 'off', '500'],
+            ])
+
+    def test_latency(self):
+        # The virtual clock stands still while a change is handled
+        r, count, decisions = self.replay('replay-trace.csv')
+        self.assertGreater(r.pvc.latency['Dispatch'].count, 0)
+        self.assertGreater(r.pvc.latency['Total'].count, 0)
+        for name in ('Dispatch', 'Actuation', 'Total'):
+            for stat in ('P50', 'P99', 'Max'):
+                self.assertEqual(r.pvc._dbusservice[f'/Perf/Latency/{name}/{stat}'], 0)
+
+    def test_prediction_miss(self):
+        r, count, decisions = self.replay('replay-prediction.csv')
+        self.assertEqual(decisions, [
+            ['13.000', 'com.victronenergy.vebus.ttyS4', 'on', '2900'],
+            ['18.000', 'com.victronenergy.vebus.ttyS4', 'off', '1200'],
+            ])
+        self.assertEqual(r.pvc.predictionHits, 0)
+        self.assertEqual(r.pvc.predictionMisses, 1)
+
+    def test_stats_roll_while_power_is_flat(self):
+        r, count, decisions = self.replay('replay-prediction.csv', tail=120)
+        stats = r.pvc._dbusservice
+        self.assertEqual(stats['/Stats/Inverter/1m/Max'], 600)
+        self.assertEqual(stats['/Stats/Inverter/1m/Mean'], 600)
+        self.assertEqual(stats['/Stats/Inverter/15m/Max'], 2900)
+
+    def test_yield_handlers(self):
+        r, count, decisions = self.replay('replay-yield.csv', tail=20)
+        self.assertEqual(decisions, [])
+        self.assertEqual(r.pvc.pvyield.yields, {
+            'com.victronenergy.multi.ttyS0': 12,
+            'com.victronenergy.solarcharger.ttyS2': 3,
+            })
+        self.assertEqual(r.pvc._dbusservice['/TotalPVYield'], 15)
+
+    def test_power_filter(self):
+        r, count, decisions = self.replay('replay-filter.csv')
+        self.assertEqual(r.pvc._dbusservice['/A/P'], 530)
+        self.assertEqual(r.monitor.get_filter_stats(),
+            {'passed': 1, 'deadband': 3, 'interval': 0, 'trailing': 0})
+
+        r, count, decisions = self.replay('replay-filter.csv', tail=20)
+        self.assertEqual(r.pvc._dbusservice['/A/P'], 540)
+        self.assertEqual(r.monitor.get_filter_stats()['trailing'], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Tests the WakeupCounter on a main context of its own, the default one can be
+# patched by the other tests.
+
+import importlib.util
+import os
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def load_pvcontrol():
+    path = os.path.join(here, '..', 'dbus-pvcontrol.py')
+    spec = importlib.util.spec_from_file_location('pvcontrol', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+pvcontrol = load_pvcontrol()
+
+class WakeupCounterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = pvcontrol.GLib.MainContext()
+        self.counter = pvcontrol.WakeupCounter()
+        self.counter.attach(self.context)
+
+    def tearDown(self):
+        self.counter.destroy()
+
+    def test_iterations(self):
+        self.assertEqual(self.counter.wakeups, 0)
+        for i in range(5):
+            self.context.iteration(False)
+        self.assertEqual(self.counter.wakeups, 5)
+
+    def test_other_sources(self):
+        # A dispatched source is one wakeup, the counter itself never dispatches
+        calls = []
+        source = pvcontrol.GLib.idle_source_new()
+        source.set_callback(lambda *args: calls.append(1) or False)
+        source.attach(self.context)
+        self.context.iteration(False)
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.counter.wakeups, 1)
+
+        self.assertFalse(self.context.pending())
+
+if __name__ == "__main__":
+    unittest.main()